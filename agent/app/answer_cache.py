@@ -0,0 +1,107 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import AsyncGenerator, AsyncIterable, Dict, List, Optional
+
+import numpy as np
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class AnswerCache:
+    """Semantic cache of generated answers for /ask.
+
+    An answer is reused when a new query's embedding is within
+    similarity_threshold (cosine) of a cached query, the same documents were
+    retrieved for it from the same collection, and that collection has not
+    changed since the answer was generated. Answers are stored as the chunks
+    they were streamed in so a hit can be re-streamed the same way.
+    """
+
+    def __init__(self, similarity_threshold: float, max_entries: int):
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[int, dict]" = OrderedDict()
+        # Corpus version the entries of each collection were generated at (None is the default collection)
+        self.corpus_versions: Dict[Optional[str], int] = {}
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype='float32')
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _check_version(self, collection: Optional[str], corpus_version: int):
+        """Drop every entry of a collection once its corpus has changed"""
+        if self.corpus_versions.get(collection) != corpus_version:
+            stale = [entry_id for entry_id, entry in self.entries.items() if entry["collection"] == collection]
+            if stale:
+                logger.info(f"Corpus changed, invalidating {len(stale)} cached answers")
+            for entry_id in stale:
+                del self.entries[entry_id]
+            self.corpus_versions[collection] = corpus_version
+
+    def lookup(self, embedding: List[float], doc_ids: List[int], corpus_version: int,
+               collection: Optional[str]) -> Optional[List[str]]:
+        """Return the cached answer chunks for a similar query over the same documents, if any"""
+        query = self._normalize(embedding)
+        with self.lock:
+            self._check_version(collection, corpus_version)
+            candidates = [
+                (entry_id, entry) for entry_id, entry in self.entries.items()
+                if entry["collection"] == collection and entry["doc_ids"] == doc_ids
+            ]
+            if candidates:
+                matrix = np.stack([entry["embedding"] for _, entry in candidates])
+                similarities = matrix @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    entry_id, entry = candidates[best]
+                    self.entries.move_to_end(entry_id)
+                    self.hits += 1
+                    logger.info("Answer cache hit with similarity %.4f", similarities[best])
+                    return entry["chunks"]
+            self.misses += 1
+            return None
+
+    def store(self, embedding: List[float], doc_ids: List[int], corpus_version: int, collection: Optional[str],
+              chunks: List[str]):
+        with self.lock:
+            # The corpus changed while this answer was being generated
+            if corpus_version < self.corpus_versions.get(collection, corpus_version):
+                return
+            self._check_version(collection, corpus_version)
+            self.entries[self.next_id] = {
+                "collection": collection,
+                "embedding": self._normalize(embedding),
+                "doc_ids": list(doc_ids),
+                "chunks": chunks,
+            }
+            self.next_id += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    async def record_async(self, embedding: List[float], doc_ids: List[int], corpus_version: int,
+                           collection: Optional[str], chunks: AsyncIterable[str]) -> AsyncGenerator[str, None]:
+        """Pass an answer streamed by the async LLM client through, caching it once it has streamed completely"""
+        streamed = []
+        async for chunk in chunks:
+            streamed.append(chunk)
+            yield chunk
+        self.store(embedding, doc_ids, corpus_version, collection, streamed)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self.entries),
+            }
@@ -1,8 +1,9 @@
-import pickle
+import sqlite3
 from pathlib import Path
 import logging
 import sys
 import os
+from dotenv import load_dotenv
 
 # Set up logging
 logging.basicConfig(
@@ -12,28 +13,35 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def check_vector_db():
-    # Get the absolute path to the data directory
-    current_dir = Path(os.path.dirname(os.path.abspath(__file__)))
-    data_dir = current_dir.parent / "data"
-    doc_store_path = data_dir / "doc_store.pkl"
+def check_collection(data_dir: Path):
+    doc_store_path = data_dir / "docs.db"
+    legacy_path = data_dir / "doc_store.pkl"
     
     print(f"\nChecking database at: {doc_store_path}")
     
     try:
         if not doc_store_path.exists():
-            print(f"Document store file not found at: {doc_store_path}")
+            if legacy_path.exists():
+                # Imported into docs.db the first time the server loads the collection
+                print(f"Legacy document store at {legacy_path} has not been migrated to docs.db yet")
+            else:
+                print(f"Document store file not found at: {doc_store_path}")
             return
             
-        with open(doc_store_path, 'rb') as f:
-            doc_store = pickle.load(f)
+        conn = sqlite3.connect(str(doc_store_path))
+        doc_store = conn.execute(
+            "SELECT id, text, file_name, page_start, page_end FROM chunks ORDER BY id"
+        ).fetchall()
+        conn.close()
         
         print("\n=== Vector Database Contents ===")
         print(f"Total documents stored: {len(doc_store)}")
         print("\nDocument contents:")
         
-        for i, doc in enumerate(doc_store, 1):
-            print(f"\n--- Document {i} ---")
+        for doc_id, doc, file_name, page_start, page_end in doc_store:
+            print(f"\n--- Document {doc_id} ---")
+            if file_name:
+                print(f"File: {file_name}, pages {page_start}-{page_end}")
             # Print first 500 characters of each document
             preview = doc[:500] + "..." if len(doc) > 500 else doc
             print(preview)
@@ -45,5 +53,18 @@ def check_vector_db():
         if data_dir.exists():
             print(f"Files in data directory: {list(data_dir.glob('*'))}")
 
+def check_vector_db():
+    # Resolve DATA_DIR as app.config does, without its API key checks
+    load_dotenv()
+    current_dir = Path(os.path.dirname(os.path.abspath(__file__)))
+    data_dir = Path(os.getenv("DATA_DIR", str(current_dir.parent / "data")))
+    # The default collection lives in DATA_DIR itself, named ones under DATA_DIR/collections
+    check_collection(data_dir)
+    collections_dir = data_dir / "collections"
+    if collections_dir.is_dir():
+        for collection_dir in sorted(path for path in collections_dir.iterdir() if path.is_dir()):
+            print(f"\n=== Collection {collection_dir.name} ===")
+            check_collection(collection_dir)
+
 if __name__ == "__main__":
-    check_vector_db() 
\ No newline at end of file
+    check_vector_db()
@@ -0,0 +1,139 @@
+import re
+from collections import deque
+from typing import Iterable, Iterator, NamedTuple, Tuple
+
+from app.config import CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS, CHUNK_MIN_TOKENS
+
+# The Gemini tokenizer is not available offline, so tokens are approximated
+# as runs of word characters plus individual punctuation marks.
+TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+# Units end after sentence punctuation or at a blank line (paragraph break).
+# Single newlines are just PDF line wrapping and do not end a unit.
+BOUNDARY_RE = re.compile(r"(?<=[.!?])\s+|\n\s*\n\s*")
+
+
+class Chunk(NamedTuple):
+    text: str
+    page_start: int
+    page_end: int
+    # UTF-8 byte offsets into the document text (pages joined with "\n")
+    byte_start: int
+    byte_end: int
+    token_count: int
+
+
+class _Unit(NamedTuple):
+    text: str
+    page: int
+    byte_start: int
+    byte_end: int
+    tokens: int
+    paragraph_end: bool
+
+
+def _iter_units(pages: Iterable[Tuple[int, str]], max_tokens: int) -> Iterator[_Unit]:
+    """Split pages into sentence units, splitting any unit longer than a chunk at token boundaries"""
+    page_byte_base = 0
+    for page_number, page_text in pages:
+        ascii_only = page_text.isascii()
+        last_char = 0
+        last_byte = 0
+
+        def byte_offset(char_offset: int) -> int:
+            nonlocal last_char, last_byte
+            if ascii_only:
+                return page_byte_base + char_offset
+            last_byte += len(page_text[last_char:char_offset].encode("utf-8"))
+            last_char = char_offset
+            return page_byte_base + last_byte
+
+        spans = []
+        position = 0
+        for boundary in BOUNDARY_RE.finditer(page_text):
+            if boundary.start() > position:
+                spans.append((position, boundary.start(), "\n" in boundary.group()))
+            position = boundary.end()
+        if position < len(page_text):
+            spans.append((position, len(page_text), True))
+        if spans:
+            # A page break always ends a paragraph
+            spans[-1] = (spans[-1][0], spans[-1][1], True)
+
+        for start, end, paragraph_end in spans:
+            tokens = len(TOKEN_RE.findall(page_text, start, end))
+            if tokens == 0:
+                continue
+            if tokens <= max_tokens:
+                yield _Unit(" ".join(page_text[start:end].split()), page_number,
+                            byte_offset(start), byte_offset(end), tokens, paragraph_end)
+                continue
+
+            # Hard-split a run-on unit (no punctuation, tables, ...) every max_tokens tokens
+            token_starts = [match.start() for match in TOKEN_RE.finditer(page_text, start, end)]
+            for i in range(0, len(token_starts), max_tokens):
+                piece_start = token_starts[i]
+                piece_end = token_starts[i + max_tokens] if i + max_tokens < len(token_starts) else end
+                last_piece = piece_end == end
+                yield _Unit(" ".join(page_text[piece_start:piece_end].split()), page_number,
+                            byte_offset(piece_start), byte_offset(piece_end),
+                            min(max_tokens, len(token_starts) - i), paragraph_end and last_piece)
+
+        page_byte_base += len(page_text) if ascii_only else len(page_text.encode("utf-8"))
+        page_byte_base += 1  # the "\n" joining pages
+
+
+def iter_chunks(pages: Iterable[Tuple[int, str]], max_tokens: int = CHUNK_MAX_TOKENS,
+                overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> Iterator[Chunk]:
+    """Chunk a stream of (page_number, text) pages in a single pass.
+
+    Chunks hold at most max_tokens tokens of whole sentences, prefer to end at
+    a paragraph break once they reach CHUNK_MIN_TOKENS, and repeat up to
+    overlap_tokens tokens of trailing sentences at the start of the next chunk.
+    """
+    buffer = deque()
+    buffer_tokens = 0
+    fresh_units = 0  # units in the buffer that are not overlap from the previous chunk
+
+    def emit() -> Chunk:
+        return Chunk(
+            " ".join(unit.text for unit in buffer),
+            buffer[0].page,
+            buffer[-1].page,
+            buffer[0].byte_start,
+            buffer[-1].byte_end,
+            buffer_tokens,
+        )
+
+    def carry_overlap():
+        nonlocal buffer_tokens, fresh_units
+        kept = deque()
+        kept_tokens = 0
+        while buffer and kept_tokens + buffer[-1].tokens <= overlap_tokens:
+            unit = buffer.pop()
+            kept.appendleft(unit)
+            kept_tokens += unit.tokens
+        buffer.clear()
+        buffer.extend(kept)
+        buffer_tokens = kept_tokens
+        fresh_units = 0
+
+    for unit in _iter_units(pages, max_tokens):
+        if buffer_tokens + unit.tokens > max_tokens:
+            if fresh_units:
+                yield emit()
+                carry_overlap()
+            # Drop overlap that would leave no room for new text
+            while buffer and buffer_tokens + unit.tokens > max_tokens:
+                buffer_tokens -= buffer.popleft().tokens
+
+        buffer.append(unit)
+        buffer_tokens += unit.tokens
+        fresh_units += 1
+
+        if unit.paragraph_end and buffer_tokens >= CHUNK_MIN_TOKENS:
+            yield emit()
+            carry_overlap()
+
+    if fresh_units:
+        yield emit()
@@ -1,4 +1,5 @@
 import os
+from pathlib import Path
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -6,5 +7,168 @@ load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-if not GEMINI_API_KEY or not OPENAI_API_KEY:
+# Offline backends
+# Serve embeddings, answers and web search from deterministic local stand-ins
+# instead of Gemini and OpenAI; used by the benchmarks and needs no API keys
+FAKE_BACKENDS = os.getenv("FAKE_BACKENDS", "false").lower() == "true"
+# Simulated latency of the stand-ins, in milliseconds
+FAKE_EMBED_LATENCY_MS = float(os.getenv("FAKE_EMBED_LATENCY_MS", "0"))
+FAKE_LLM_FIRST_TOKEN_MS = float(os.getenv("FAKE_LLM_FIRST_TOKEN_MS", "0"))
+FAKE_LLM_TOKEN_MS = float(os.getenv("FAKE_LLM_TOKEN_MS", "0"))
+
+if not FAKE_BACKENDS and (not GEMINI_API_KEY or not OPENAI_API_KEY):
     raise ValueError("One or both API keys are missing!")
+
+# Storage
+# Directory holding the index, document store, embedding cache and job state
+DATA_DIR = Path(os.getenv("DATA_DIR", str(Path(__file__).resolve().parent.parent / "data")))
+
+# Vector store persistence
+# Number of write-ahead log records to accumulate before compacting into a snapshot
+WAL_COMPACT_THRESHOLD = int(os.getenv("WAL_COMPACT_THRESHOLD", "1000"))
+# Fraction of the index that may be deleted-but-not-yet-removed vectors before it is rebuilt
+TOMBSTONE_COMPACT_RATIO = float(os.getenv("TOMBSTONE_COMPACT_RATIO", "0.2"))
+
+# Hybrid retrieval
+# Fuse BM25 keyword matches with vector search results
+HYBRID_SEARCH_ENABLED = os.getenv("HYBRID_SEARCH_ENABLED", "true").lower() == "true"
+# Candidates taken from each of the keyword and vector searches before fusion
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "50"))
+# Reciprocal-rank fusion constant; larger values flatten the weight of top ranks
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# Embedding pipeline
+# Texts per batch embed request (the Gemini API accepts at most 100)
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "100"))
+# Batch requests allowed in flight at once
+EMBED_MAX_WORKERS = int(os.getenv("EMBED_MAX_WORKERS", "4"))
+# Attempts per batch before giving up on rate limit errors
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "5"))
+# Base and cap, in seconds, for the jittered exponential backoff
+EMBED_BACKOFF_BASE = float(os.getenv("EMBED_BACKOFF_BASE", "1.0"))
+EMBED_BACKOFF_MAX = float(os.getenv("EMBED_BACKOFF_MAX", "60.0"))
+
+# Vector index
+# Dimensionality of the Gemini embedding-001 vectors
+EMBEDDING_DIM = 768
+# One of: flat, ivf_flat, ivf_pq, hnsw, or flat_*, ivf_* and hnsw_* with fp16 (float16, half the
+# memory of float32) or sq8 (8-bit scalar quantization, a quarter) storage, e.g. hnsw_sq8
+INDEX_TYPE = os.getenv("INDEX_TYPE", "flat").lower()
+# cosine (normalized vectors, inner product; scores are cosine similarities) or l2
+INDEX_METRIC = os.getenv("INDEX_METRIC", "cosine").lower()
+# Number of IVF cells
+INDEX_NLIST = int(os.getenv("INDEX_NLIST", "256"))
+# Number of PQ sub-quantizers for ivf_pq (must divide EMBEDDING_DIM)
+INDEX_PQ_M = int(os.getenv("INDEX_PQ_M", "64"))
+# Neighbours per node for hnsw
+INDEX_HNSW_M = int(os.getenv("INDEX_HNSW_M", "32"))
+# Vectors required before an index that needs training (IVF, sq8) is built (faiss wants ~39 per IVF cell)
+INDEX_TRAIN_MIN = int(os.getenv("INDEX_TRAIN_MIN", str(INDEX_NLIST * 39)))
+# Default search-time recall/latency knobs, overridable per request
+INDEX_NPROBE = int(os.getenv("INDEX_NPROBE", "16"))
+INDEX_EF_SEARCH = int(os.getenv("INDEX_EF_SEARCH", "64"))
+# Keep a full-precision copy of every vector on disk (vectors.f32, memory-mapped) while INDEX_TYPE is
+# compressed (ivf_pq, *_fp16, *_sq8), and re-score the candidates found in the compressed index with it
+INDEX_RERANK = os.getenv("INDEX_RERANK", "true").lower() == "true"
+# Candidates taken from a compressed index per hit requested, for re-ranking
+INDEX_RERANK_FACTOR = int(os.getenv("INDEX_RERANK_FACTOR", "4"))
+# Partitions of the index, each searched in parallel and persisted as its own file. Chunks are
+# routed by file, so a search filtered to a few files only visits their shards. Only takes
+# effect for a new store; run python -m app.rebalance --shards N to reshard an existing one
+INDEX_SHARDS = int(os.getenv("INDEX_SHARDS", "1"))
+# Threads searching shards at once; FAISS releases the GIL while it searches
+SHARD_SEARCH_WORKERS = int(os.getenv("SHARD_SEARCH_WORKERS", str(os.cpu_count() or 1)))
+
+# Index sharing between worker processes
+# standalone: load, update and search a private copy of the index
+# writer: as standalone, and also publish read-only generations of the index
+# reader: search the newest published generation, memory-mapped and shared
+#         through the page cache with other readers; writes are rejected
+INDEX_MODE = os.getenv("INDEX_MODE", "standalone").lower()
+# Seconds between generations while the corpus keeps changing (writer)
+INDEX_PUBLISH_INTERVAL = float(os.getenv("INDEX_PUBLISH_INTERVAL", "30"))
+# Seconds between checks for a newer generation (reader), or for writes made by
+# other processes sharing DATA_DIR, such as ingestion (standalone and writer)
+INDEX_RELOAD_INTERVAL = float(os.getenv("INDEX_RELOAD_INTERVAL", "2"))
+# Generations kept on disk
+INDEX_GENERATIONS_KEPT = int(os.getenv("INDEX_GENERATIONS_KEPT", "3"))
+
+# Collections
+# Named collections (per organisation or workspace) each keep their own index, document store
+# and log under DATA_DIR/collections/<name>, loaded when first used. Once the estimated index
+# memory of the loaded ones exceeds this many MB, the least recently used are unloaded.
+# Requests without a collection use the default collection in DATA_DIR, which stays loaded
+COLLECTION_MEMORY_BUDGET_MB = float(os.getenv("COLLECTION_MEMORY_BUDGET_MB", "2048"))
+
+# Embedding cache
+EMBED_CACHE_ENABLED = os.getenv("EMBED_CACHE_ENABLED", "true").lower() == "true"
+# Entries kept in the in-memory LRU front
+EMBED_CACHE_MEMORY_ENTRIES = int(os.getenv("EMBED_CACHE_MEMORY_ENTRIES", "10000"))
+# Entries kept on disk before least recently used ones are evicted
+EMBED_CACHE_MAX_ENTRIES = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", "500000"))
+
+# Semantic answer cache for /ask
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+# Minimum cosine similarity between queries for a cached answer to be reused
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+
+# Request handling
+# Threads available to /ask for blocking work (embedding, FAISS search, web search)
+BLOCKING_MAX_WORKERS = int(os.getenv("BLOCKING_MAX_WORKERS", "32"))
+
+# Batch endpoints (/search-batch, /ask-batch)
+# Queries accepted per request
+BATCH_MAX_QUERIES = int(os.getenv("BATCH_MAX_QUERIES", "10000"))
+# Largest top_k a batch query may ask for
+BATCH_MAX_TOP_K = int(os.getenv("BATCH_MAX_TOP_K", "100"))
+# Queries embedded and searched together as one matrix; results stream back after each group
+BATCH_SEARCH_SIZE = int(os.getenv("BATCH_SEARCH_SIZE", "256"))
+# Answers /ask-batch generates at once
+ASK_BATCH_CONCURRENCY = int(os.getenv("ASK_BATCH_CONCURRENCY", "8"))
+
+# PDF ingestion
+# Files processed concurrently by the background ingestion workers
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+# Processes used to extract PDF pages in parallel
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+# Pages handed to each extraction task
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "16"))
+# Extraction tasks allowed in flight per document, bounding pages held in memory
+PDF_EXTRACT_WINDOW = int(os.getenv("PDF_EXTRACT_WINDOW", str(2 * PDF_EXTRACT_WORKERS)))
+# Memory-map downloaded PDFs for the parser instead of reading them through buffered I/O
+PDF_USE_MMAP = os.getenv("PDF_USE_MMAP", "false").lower() == "true"
+# Bytes read per streamed download chunk
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(1024 * 1024)))
+# Attempts per download; retries resume with a Range request where the server allows it
+DOWNLOAD_MAX_RETRIES = int(os.getenv("DOWNLOAD_MAX_RETRIES", "3"))
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", "60"))
+# Hours a finished ingestion job stays queryable before its state is deleted
+JOB_RETENTION_HOURS = float(os.getenv("JOB_RETENTION_HOURS", "168"))
+
+# Chunking (sizes in approximate model tokens)
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "256"))
+# Trailing tokens repeated at the start of the next chunk
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+# Size at which a chunk may end early at a paragraph break
+CHUNK_MIN_TOKENS = int(os.getenv("CHUNK_MIN_TOKENS", "128"))
+
+# Context assembly
+# OpenAI model used to generate answers
+GENERATION_MODEL = os.getenv("GENERATION_MODEL", "gpt-4")
+# Tokens of retrieved context sent per model, leaving room for the prompt and the answer
+CONTEXT_TOKEN_BUDGETS = {"gpt-4": 6000, "gpt-4-turbo": 100000, "gpt-4o": 100000, "gpt-3.5-turbo": 12000}
+# Overrides the budget for GENERATION_MODEL
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", str(CONTEXT_TOKEN_BUDGETS.get(GENERATION_MODEL, 6000))))
+# Chunks at least this cosine-similar to a higher-scoring chunk are dropped as near-duplicates
+CONTEXT_DEDUP_SIMILARITY = float(os.getenv("CONTEXT_DEDUP_SIMILARITY", "0.95"))
+
+# Observability
+# Also emit OpenTelemetry spans for timed stages (needs opentelemetry-api and a configured SDK)
+OTEL_ENABLED = os.getenv("OTEL_ENABLED", "false").lower() == "true"
+# Root log level
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# json (one object per line) or text
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+# Fraction of per-hit and per-item detail logs emitted at DEBUG level
+LOG_DETAIL_SAMPLE_RATE = float(os.getenv("LOG_DETAIL_SAMPLE_RATE", "0.01"))
@@ -0,0 +1,101 @@
+import logging
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from app.chunker import TOKEN_RE
+from app.config import CONTEXT_TOKEN_BUDGET, CONTEXT_DEDUP_SIMILARITY
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def count_tokens(text: str) -> int:
+    """Approximate token count, using the same tokenization as the chunker"""
+    return len(TOKEN_RE.findall(text))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Cut text after its first max_tokens tokens"""
+    if max_tokens <= 0:
+        return ""
+    for i, match in enumerate(TOKEN_RE.finditer(text), 1):
+        if i == max_tokens:
+            return text[:match.end()]
+    return text
+
+
+def pack_context(docs: List[Dict[str, Any]], vectors: Dict[int, np.ndarray],
+                 token_budget: int = CONTEXT_TOKEN_BUDGET,
+                 dedup_similarity: float = CONTEXT_DEDUP_SIMILARITY) -> Tuple[List[str], Dict[str, int]]:
+    """Choose which retrieved chunk texts to send to the model, and report what was saved.
+
+    Chunks are taken highest score first. A chunk whose vector is at least
+    dedup_similarity (cosine) to an already chosen one, e.g. the overlap
+    between neighbouring chunks, is dropped. Texts are added until
+    token_budget is used up, the last one cut at a token boundary.
+    """
+    stats = {
+        "chunks_retrieved": len(docs),
+        "chunks_used": 0,
+        "duplicates_dropped": 0,
+        "tokens_retrieved": 0,
+        "tokens_used": 0,
+    }
+    texts = []
+    chosen_vectors = []
+    chosen_texts = set()
+    remaining = token_budget
+    for doc in sorted(docs, key=lambda doc: doc["score"], reverse=True):
+        tokens = count_tokens(doc["text"])
+        stats["tokens_retrieved"] += tokens
+
+        vector = vectors.get(doc["id"])
+        unit = None
+        if vector is not None:
+            norm = np.linalg.norm(vector)
+            unit = vector / norm if norm > 0 else vector
+        duplicate = doc["text"] in chosen_texts or (
+            unit is not None and chosen_vectors
+            and float(np.max(np.stack(chosen_vectors) @ unit)) >= dedup_similarity
+        )
+        if duplicate:
+            stats["duplicates_dropped"] += 1
+            continue
+        if remaining <= 0:
+            continue
+
+        text = doc["text"]
+        if tokens > remaining:
+            text = truncate_tokens(text, remaining)
+            tokens = remaining
+        texts.append(text)
+        chosen_texts.add(doc["text"])
+        if unit is not None:
+            chosen_vectors.append(unit)
+        remaining -= tokens
+        stats["chunks_used"] += 1
+        stats["tokens_used"] += tokens
+
+    stats["tokens_saved"] = stats["tokens_retrieved"] - stats["tokens_used"]
+    logger.info(
+        "Packed %d/%d chunks into %d/%d tokens: %d near-duplicates dropped, %d tokens saved",
+        stats["chunks_used"], stats["chunks_retrieved"], stats["tokens_used"], token_budget,
+        stats["duplicates_dropped"], stats["tokens_saved"], extra=stats
+    )
+    return texts, stats
+
+
+def budget_web_context(web_context: str, share_with_db: bool,
+                       token_budget: int = CONTEXT_TOKEN_BUDGET) -> Tuple[str, int]:
+    """Fit web search results into the budget; they get half of it when DB results are also sent.
+
+    Returns the possibly truncated text and the tokens it uses.
+    """
+    limit = token_budget // 2 if share_with_db else token_budget
+    tokens = count_tokens(web_context)
+    if tokens > limit:
+        logger.info(f"Truncating web context from {tokens} to {limit} tokens")
+        return truncate_tokens(web_context, limit), limit
+    return web_context, tokens
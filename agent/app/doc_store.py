@@ -0,0 +1,245 @@
+import logging
+import re
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Metadata columns stored alongside each chunk's text
+METADATA_FIELDS = ("file_name", "page_start", "page_end", "byte_start", "byte_end", "source_url", "created_at",
+                   "content_hash")
+
+# Chunk labels written by PDFProcessor, used to recover metadata from the legacy pickle
+LABEL_RE = re.compile(r"^\[(?P<file_name>.+?) - Pages? (?P<page_start>\d+)(?:-(?P<page_end>\d+))?\] ")
+
+# Bytes of the database read-only stores map into memory, shared with other processes through the page cache
+READ_ONLY_MMAP_SIZE = 1 << 40
+
+# Words as the FTS5 unicode61 tokenizer sees them
+FTS_TERM_RE = re.compile(r"\w+")
+
+# Words left out of keyword queries; they occur in nearly every chunk, so matching
+# one of them says nothing about relevance
+STOPWORDS = frozenset("""
+a about above after again all also am an and any are as at be because been before being below between both
+but by can could did do does doing down during each few for from further had has have having he her here
+hers him his how i if in into is it its itself just me more most my no nor not of off on once only or other
+our ours out over own same she should so some such than that the their theirs them then there these they
+this those through to too under until up very was we were what when where which while who whom why will
+with would you your yours
+""".split())
+
+
+def fts_query(text: str) -> str:
+    """Turn free text into an FTS5 query matching any of its words other than stopwords.
+
+    Words joined by punctuation (part numbers like X-1234, file names) are
+    split by the tokenizer, so they are matched as a phrase of their parts.
+    """
+    terms = []
+    for word in text.split():
+        parts = FTS_TERM_RE.findall(word)
+        if parts and not all(part.lower() in STOPWORDS for part in parts):
+            terms.append('"' + " ".join(parts) + '"')
+    return " OR ".join(dict.fromkeys(terms))
+
+
+class DocStore:
+    """SQLite-backed chunk store keyed by FAISS vector id.
+
+    Only ids and metadata are needed to filter a search; chunk text is read
+    lazily, and only for the hits that are actually returned. An FTS5 index
+    over the text, kept in sync by triggers, serves keyword (BM25) search.
+
+    Writes share one connection and are serialized by a lock; each reading
+    thread gets a connection of its own, so with SQLite's write-ahead log
+    queries neither wait on each other nor on a write in progress, and only
+    ever see committed transactions.
+
+    A read_only store opens an existing database without write access and
+    memory-maps it, for processes that only search.
+    """
+
+    def __init__(self, path: Path, read_only: bool = False):
+        self.path = path
+        self.read_only = read_only
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        if read_only:
+            self.conn = self.connect()
+            return
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "id INTEGER PRIMARY KEY, text TEXT NOT NULL, file_name TEXT, page_start INTEGER, "
+            "page_end INTEGER, byte_start INTEGER, byte_end INTEGER, source_url TEXT, created_at TEXT, "
+            "content_hash TEXT)"
+        )
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(chunks)")]
+        if "content_hash" not in columns:
+            self.conn.execute("ALTER TABLE chunks ADD COLUMN content_hash TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS chunks_file_name ON chunks (file_name)")
+        fts_exists = self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'chunks_fts'").fetchone()
+        self.conn.executescript(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(text, content='chunks', content_rowid='id');"
+            "CREATE TRIGGER IF NOT EXISTS chunks_fts_insert AFTER INSERT ON chunks BEGIN "
+            "INSERT INTO chunks_fts (rowid, text) VALUES (new.id, new.text); END;"
+            "CREATE TRIGGER IF NOT EXISTS chunks_fts_delete AFTER DELETE ON chunks BEGIN "
+            "INSERT INTO chunks_fts (chunks_fts, rowid, text) VALUES ('delete', old.id, old.text); END;"
+        )
+        if not fts_exists:
+            # Index chunks stored before keyword search existed
+            self.conn.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('rebuild')")
+        # One row per fully ingested file, so re-uploading unchanged content can be skipped
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "file_name TEXT PRIMARY KEY, content_hash TEXT NOT NULL, chunk_count INTEGER, ingested_at TEXT)"
+        )
+        self.conn.commit()
+
+    def connect(self) -> sqlite3.Connection:
+        if self.read_only:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            conn.execute(f"PRAGMA mmap_size={READ_ONLY_MMAP_SIZE}")
+            return conn
+        return sqlite3.connect(str(self.path), check_same_thread=False)
+
+    def reader(self) -> sqlite3.Connection:
+        """This thread's connection for queries"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+        return conn
+
+    def __len__(self) -> int:
+        (count,) = self.reader().execute("SELECT COUNT(*) FROM chunks").fetchone()
+        return count
+
+    def all_ids(self) -> np.ndarray:
+        rows = self.reader().execute("SELECT id FROM chunks ORDER BY id").fetchall()
+        return np.array([row[0] for row in rows], dtype='int64')
+
+    def add_many(self, ids: Iterable[int], texts: Iterable[str], metadatas: Iterable[Optional[Dict[str, Any]]]):
+        """Insert chunks; ids that already exist are left untouched so log replay is idempotent"""
+        now = datetime.now().isoformat()
+        rows = []
+        for chunk_id, text, metadata in zip(ids, texts, metadatas):
+            metadata = metadata or {}
+            rows.append((int(chunk_id), text, *(
+                metadata.get(field, now if field == "created_at" else None) for field in METADATA_FIELDS
+            )))
+        with self.lock:
+            self.conn.executemany(
+                f"INSERT OR IGNORE INTO chunks (id, text, {', '.join(METADATA_FIELDS)}) "
+                f"VALUES ({', '.join('?' * (len(METADATA_FIELDS) + 2))})",
+                rows
+            )
+            self.conn.commit()
+
+    def delete_ids(self, ids: Iterable[int]) -> int:
+        """Remove chunks by id; ids that do not exist are ignored"""
+        ids = [int(chunk_id) for chunk_id in ids]
+        deleted = 0
+        with self.lock:
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                deleted += self.conn.execute(
+                    f"DELETE FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch
+                ).rowcount
+            self.conn.commit()
+        return deleted
+
+    def get_many(self, ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+        """Fetch text and metadata for the given ids"""
+        ids = [int(chunk_id) for chunk_id in ids]
+        found = {}
+        conn = self.reader()
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            rows = conn.execute(
+                f"SELECT id, text, {', '.join(METADATA_FIELDS)} FROM chunks "
+                f"WHERE id IN ({','.join('?' * len(batch))})",
+                batch
+            ).fetchall()
+            for row in rows:
+                found[row[0]] = {"text": row[1], **dict(zip(METADATA_FIELDS, row[2:]))}
+        return found
+
+    def ids_for_files(self, file_names: List[str]) -> np.ndarray:
+        """Vector ids of every chunk that came from one of the given files"""
+        rows = self.reader().execute(
+            f"SELECT id FROM chunks WHERE file_name IN ({','.join('?' * len(file_names))})",
+            file_names
+        ).fetchall()
+        return np.array([row[0] for row in rows], dtype='int64')
+
+    def file_names_by_id(self) -> Dict[int, Optional[str]]:
+        """File name of every chunk (None for chunks without one), by id"""
+        return dict(self.reader().execute("SELECT id, file_name FROM chunks").fetchall())
+
+    def keyword_search(self, query: str, limit: int,
+                       file_names: Optional[List[str]] = None) -> List[Tuple[int, float]]:
+        """BM25-ranked (id, score) matches for the query's words, best first; higher scores are better"""
+        match = fts_query(query)
+        if not match:
+            return []
+        sql = "SELECT rowid, -bm25(chunks_fts) FROM chunks_fts WHERE chunks_fts MATCH ?"
+        params = [match]
+        if file_names:
+            sql += f" AND rowid IN (SELECT id FROM chunks WHERE file_name IN ({','.join('?' * len(file_names))}))"
+            params.extend(file_names)
+        sql += " ORDER BY bm25(chunks_fts) LIMIT ?"
+        params.append(limit)
+        return [(row[0], row[1]) for row in self.reader().execute(sql, params).fetchall()]
+
+    def ids_for_version(self, file_name: str, content_hash: str, matching: bool = True) -> np.ndarray:
+        """Ids of a file's chunks whose content hash equals (or, if not matching, differs from) content_hash"""
+        rows = self.reader().execute(
+            f"SELECT id FROM chunks WHERE file_name = ? AND content_hash {'IS' if matching else 'IS NOT'} ?",
+            (file_name, content_hash)
+        ).fetchall()
+        return np.array([row[0] for row in rows], dtype='int64')
+
+    def file_hash(self, file_name: str) -> Optional[str]:
+        """Content hash of the last complete ingestion of a file, if any"""
+        row = self.reader().execute("SELECT content_hash FROM files WHERE file_name = ?", (file_name,)).fetchone()
+        return row[0] if row else None
+
+    def record_file(self, file_name: str, content_hash: str, chunk_count: int):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (file_name, content_hash, chunk_count, ingested_at) VALUES (?, ?, ?, ?)",
+                (file_name, content_hash, chunk_count, datetime.now().isoformat())
+            )
+            self.conn.commit()
+
+    def forget_file(self, file_name: str):
+        with self.lock:
+            self.conn.execute("DELETE FROM files WHERE file_name = ?", (file_name,))
+            self.conn.commit()
+
+    def import_texts(self, texts: List[str]):
+        """One-off import of the legacy pickled list of strings, recovering file and page from chunk labels"""
+        metadatas = []
+        for text in texts:
+            match = LABEL_RE.match(text)
+            if match:
+                page_start = int(match.group("page_start"))
+                metadatas.append({
+                    "file_name": match.group("file_name"),
+                    "page_start": page_start,
+                    "page_end": int(match.group("page_end") or page_start),
+                })
+            else:
+                metadatas.append(None)
+        self.add_many(range(len(texts)), texts, metadatas)
+        logger.info(f"Imported {len(texts)} documents from legacy document store")
@@ -1,32 +1,93 @@
-import google.generativeai as genai
 import logging
-from typing import List, Optional
-from app.config import GEMINI_API_KEY
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Optional
+from app.embedding_cache import EmbeddingCache, cache_key
+from app.metrics import CACHE_LOOKUPS, timed
+from app.config import (
+    GEMINI_API_KEY,
+    DATA_DIR,
+    FAKE_BACKENDS,
+    EMBED_BATCH_SIZE,
+    EMBED_MAX_WORKERS,
+    EMBED_MAX_RETRIES,
+    EMBED_BACKOFF_BASE,
+    EMBED_BACKOFF_MAX,
+    EMBED_CACHE_ENABLED,
+    EMBED_CACHE_MEMORY_ENTRIES,
+    EMBED_CACHE_MAX_ENTRIES,
+)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Configure Gemini API
-genai.configure(api_key=GEMINI_API_KEY)
+@lru_cache(maxsize=None)
+def embedding_client():
+    """The embed_content function of the configured backend, set up on first use.
 
-# Initialize the model
-model = genai.get_model("embedding-001")
+    The Gemini SDK is slow to import and configure, so this is deferred
+    until the first embedding is needed rather than done at import.
+    """
+    if FAKE_BACKENDS:
+        from app.fake_backends import embed_content
+        return embed_content
+    import google.generativeai as genai
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai.embed_content
+
+EMBEDDING_MODEL = "embedding-001"
+TASK_TYPE = "retrieval_document"
+
+# Cache embeddings on disk so re-embedding identical content is free
+embedding_cache = EmbeddingCache(
+    DATA_DIR / "embedding_cache.db",
+    EMBED_CACHE_MEMORY_ENTRIES,
+    EMBED_CACHE_MAX_ENTRIES
+) if EMBED_CACHE_ENABLED else None
+
+@lru_cache(maxsize=None)
+def rate_limit_errors() -> tuple:
+    """Errors the API returns when we are being rate limited (HTTP 429); the stand-ins never are"""
+    if FAKE_BACKENDS:
+        return ()
+    from google.api_core import exceptions as google_exceptions
+    return (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)
+
+# Shared backoff state: once any worker is rate limited, every worker holds
+# off until the cooldown expires instead of hammering the API in parallel.
+_cooldown_lock = threading.Lock()
+_cooldown_until = 0.0
 
 def get_embedding(text: str) -> Optional[List[float]]:
     """Get embedding for text using Gemini API"""
     try:
-        logger.info(f"Getting embedding for text of length {len(text)}")
+        logger.debug("Getting embedding for text of length %d", len(text))
+
+        key = cache_key(EMBEDDING_MODEL, TASK_TYPE, text)
+        if embedding_cache is not None:
+            cached = embedding_cache.get(key)
+            if cached is not None:
+                logger.debug("Embedding cache hit")
+                CACHE_LOOKUPS.labels("embedding", "hit").inc()
+                return cached
+            CACHE_LOOKUPS.labels("embedding", "miss").inc()
         
         # Get embedding
-        result = genai.embed_content(
-            model="embedding-001",
-            content=text,
-            task_type="retrieval_document"
-        )
+        with timed("embedding"):
+            result = embedding_client()(
+                model=EMBEDDING_MODEL,
+                content=text,
+                task_type=TASK_TYPE
+            )
         
         if result and "embedding" in result:
-            logger.info(f"Successfully generated embedding of length {len(result['embedding'])}")
+            logger.debug("Generated embedding of length %d", len(result["embedding"]))
+            if embedding_cache is not None:
+                embedding_cache.put(key, result["embedding"])
             return result["embedding"]
         else:
             logger.error("Failed to get embedding from model response")
@@ -35,3 +96,94 @@ def get_embedding(text: str) -> Optional[List[float]]:
     except Exception as e:
         logger.error(f"Error getting embedding: {str(e)}")
         return None
+
+def _wait_for_cooldown():
+    """Block until the shared rate limit cooldown has expired"""
+    while True:
+        with _cooldown_lock:
+            remaining = _cooldown_until - time.monotonic()
+        if remaining <= 0:
+            return
+        time.sleep(remaining)
+
+def _backoff(attempt: int):
+    """Push back the shared cooldown with full-jitter exponential backoff"""
+    global _cooldown_until
+    delay = random.uniform(0, min(EMBED_BACKOFF_MAX, EMBED_BACKOFF_BASE * (2 ** attempt)))
+    with _cooldown_lock:
+        _cooldown_until = max(_cooldown_until, time.monotonic() + delay)
+    logger.warning(f"Embedding API rate limited, backing off for {delay:.2f}s (attempt {attempt + 1}/{EMBED_MAX_RETRIES})")
+
+def _embed_batch(texts: List[str]) -> List[Optional[List[float]]]:
+    """Embed one batch with a single API call, retrying on rate limit errors"""
+    for attempt in range(EMBED_MAX_RETRIES):
+        _wait_for_cooldown()
+        try:
+            with timed("embedding_batch"):
+                result = embedding_client()(
+                    model=EMBEDDING_MODEL,
+                    content=texts,
+                    task_type=TASK_TYPE
+                )
+            embeddings = result.get("embedding") if result else None
+            if not embeddings or len(embeddings) != len(texts):
+                logger.error("Failed to get batch embeddings from model response")
+                return [None] * len(texts)
+            return embeddings
+        except rate_limit_errors():
+            _backoff(attempt)
+        except Exception as e:
+            logger.error(f"Error getting batch embeddings: {str(e)}")
+            return [None] * len(texts)
+
+    logger.error(f"Giving up on batch of {len(texts)} texts after {EMBED_MAX_RETRIES} rate limited attempts")
+    return [None] * len(texts)
+
+def get_embeddings(texts: List[str]) -> List[Optional[List[float]]]:
+    """Get embeddings for many texts using batched, concurrent Gemini API calls.
+
+    Returns one entry per input text, in order; entries are None for texts
+    whose batch could not be embedded.
+    """
+    if not texts:
+        return []
+
+    keys = [cache_key(EMBEDDING_MODEL, TASK_TYPE, text) for text in texts]
+    found: Dict[str, List[float]] = embedding_cache.get_many(keys) if embedding_cache is not None else {}
+
+    # Only send each distinct uncached text to the API once
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in found and key not in missing:
+            missing[key] = text
+    cache_misses = sum(key not in found for key in keys)
+    logger.debug("Embedding cache served %d/%d texts", len(texts) - cache_misses, len(texts))
+    if embedding_cache is not None:
+        CACHE_LOOKUPS.labels("embedding", "hit").inc(len(texts) - cache_misses)
+        CACHE_LOOKUPS.labels("embedding", "miss").inc(cache_misses)
+
+    if missing:
+        missing_keys = list(missing)
+        missing_texts = list(missing.values())
+        batches = [missing_texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(missing_texts), EMBED_BATCH_SIZE)]
+        logger.debug("Getting embeddings for %d texts in %d batches", len(missing_texts), len(batches))
+
+        new_embeddings = []
+        with ThreadPoolExecutor(max_workers=min(EMBED_MAX_WORKERS, len(batches))) as executor:
+            for batch_embeddings in executor.map(_embed_batch, batches):
+                new_embeddings.extend(batch_embeddings)
+
+        generated = {key: embedding for key, embedding in zip(missing_keys, new_embeddings) if embedding is not None}
+        if embedding_cache is not None:
+            embedding_cache.put_many(generated)
+        found.update(generated)
+
+    embeddings = [found.get(key) for key in keys]
+    logger.debug("Embeddings available for %d/%d texts", sum(e is not None for e in embeddings), len(texts))
+    return embeddings
+
+def cache_stats() -> Dict[str, float]:
+    """Hit/miss counters and sizes of the embedding cache"""
+    if embedding_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **embedding_cache.stats()}
@@ -0,0 +1,187 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for another process's write to the cache file before giving up
+BUSY_TIMEOUT_SECONDS = 5
+# A disk hit only refreshes the entry's recency once it is this many seconds old
+TOUCH_INTERVAL_SECONDS = 3600
+# Refreshed recencies held back and written with the next insert, or once this many are waiting
+MAX_PENDING_TOUCHES = 1000
+# Fraction of max_disk_entries eviction trims the disk tier down to, so it runs once per many inserts
+EVICTION_TARGET = 0.9
+
+
+def normalize_text(text: str) -> str:
+    """Collapse whitespace so trivially different copies of a text share a cache entry"""
+    return " ".join(text.split())
+
+
+def cache_key(model: str, task_type: str, text: str) -> str:
+    """Content address of an embedding: hash of model, task type and normalized text"""
+    digest = hashlib.sha256()
+    for part in (model, task_type, normalize_text(text)):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """Content-addressed embedding cache: an in-memory LRU in front of a SQLite file.
+
+    Both tiers are size bounded; the disk tier evicts the least recently used
+    entries once it grows past max_disk_entries. Several processes may share
+    the file. The cache is an optimisation only: disk errors are logged and
+    treated as misses or skipped writes, never raised to the caller.
+    """
+
+    def __init__(self, path: Path, max_memory_entries: int, max_disk_entries: int):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        # Disk hits whose recency is yet to be written, by key
+        self.touched: Dict[str, float] = {}
+
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.conn = sqlite3.connect(str(path), timeout=BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+        # Readers in other processes don't block this one's writes, nor the other way round
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, embedding BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.conn.commit()
+        # Kept up to date by this process's inserts; recounted before evicting, as other processes insert too
+        (self.disk_entries,) = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        logger.info(f"Embedding cache opened at {path}")
+
+    def _remember(self, key: str, embedding: List[float]):
+        self.memory[key] = embedding
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """Return the cached embeddings for whichever keys are present"""
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found[key] = self.memory[key]
+            disk_keys = [key for key in dict.fromkeys(keys) if key not in found]
+
+            if disk_keys:
+                rows = []
+                try:
+                    # Stay under SQLite's bound-parameter limit
+                    for start in range(0, len(disk_keys), 500):
+                        chunk = disk_keys[start:start + 500]
+                        placeholders = ",".join("?" * len(chunk))
+                        rows += self.conn.execute(
+                            f"SELECT key, embedding, last_used FROM embeddings WHERE key IN ({placeholders})", chunk
+                        ).fetchall()
+                except sqlite3.Error as e:
+                    logger.warning(f"Error reading embedding cache: {str(e)}")
+                now = time.time()
+                for key, blob, last_used in rows:
+                    embedding = np.frombuffer(blob, dtype='float32').tolist()
+                    found[key] = embedding
+                    self._remember(key, embedding)
+                    # Eviction only needs a rough recency, so recently used entries are not rewritten
+                    if now - last_used >= TOUCH_INTERVAL_SECONDS:
+                        self.touched[key] = now
+                if len(self.touched) >= MAX_PENDING_TOUCHES:
+                    self._write(lambda: None)
+                self.disk_hits += len(rows)
+
+            self.hits += sum(key in found for key in keys)
+            self.misses += sum(key not in found for key in keys)
+        return found
+
+    def get(self, key: str) -> Optional[List[float]]:
+        return self.get_many([key]).get(key)
+
+    def _write(self, write_fn: Callable[[], None]):
+        """Run write_fn and write the pending recencies in one transaction. Call with lock held.
+
+        A failed write is logged and dropped rather than raised.
+        """
+        try:
+            write_fn()
+            if self.touched:
+                self.conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(last_used, key) for key, last_used in self.touched.items()]
+                )
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Error writing to embedding cache: {str(e)}")
+            try:
+                self.conn.rollback()
+            except sqlite3.Error:
+                pass
+        self.touched.clear()
+
+    def _insert(self, entries: Dict[str, List[float]], now: float):
+        # Entries are content addressed, so one already on disk holds the same embedding
+        cursor = self.conn.executemany(
+            "INSERT OR IGNORE INTO embeddings (key, embedding, last_used) VALUES (?, ?, ?)",
+            [(key, np.asarray(embedding, dtype='float32').tobytes(), now) for key, embedding in entries.items()]
+        )
+        self.disk_entries += max(cursor.rowcount, 0)
+        if self.disk_entries > self.max_disk_entries:
+            (self.disk_entries,) = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            excess = self.disk_entries - int(self.max_disk_entries * EVICTION_TARGET)
+            if self.disk_entries > self.max_disk_entries and excess > 0:
+                self.conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                    (excess,)
+                )
+                self.disk_entries -= excess
+                logger.info(f"Evicted {excess} entries from embedding cache")
+
+    def put_many(self, entries: Dict[str, List[float]]):
+        """Store embeddings in both tiers, evicting the oldest disk entries if over budget"""
+        if not entries:
+            return
+        now = time.time()
+        with self.lock:
+            for key, embedding in entries.items():
+                self._remember(key, embedding)
+            self._write(lambda: self._insert(entries, now))
+
+    def put(self, key: str, embedding: List[float]):
+        self.put_many({key: embedding})
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "memory_hits": self.hits - self.disk_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "memory_entries": len(self.memory),
+                "disk_entries": self.disk_entries,
+            }
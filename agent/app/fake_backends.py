@@ -0,0 +1,110 @@
+import asyncio
+import hashlib
+import time
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+from app.chunker import TOKEN_RE
+from app.config import EMBEDDING_DIM, FAKE_EMBED_LATENCY_MS, FAKE_LLM_FIRST_TOKEN_MS, FAKE_LLM_TOKEN_MS
+
+# Local stand-ins for the Gemini and OpenAI clients, enabled with FAKE_BACKENDS.
+# They mimic just the parts of the client APIs this app calls, return the same
+# output for the same input on every run, and sleep for the configured latencies
+# so benchmarks can model a remote backend without one.
+
+# Words of the fake answer taken from the start of the context
+ANSWER_TOKENS = 64
+
+
+@lru_cache(maxsize=100000)
+def _token_slot(token: str) -> Tuple[int, float]:
+    """Dimension and sign a token is hashed to"""
+    digest = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+    return digest % EMBEDDING_DIM, 1.0 if digest >> 63 else -1.0
+
+
+def fake_embedding(text: str) -> List[float]:
+    """Unit-length hashed bag-of-words vector, so texts sharing words are cosine-similar"""
+    vector = np.zeros(EMBEDDING_DIM, dtype='float32')
+    for token in TOKEN_RE.findall(text.lower()):
+        slot, sign = _token_slot(token)
+        vector[slot] += sign
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        vector[0] = 1.0
+    else:
+        vector /= norm
+    return vector.tolist()
+
+
+def embed_content(model: str, content: Union[str, List[str]], task_type: str = None) -> Dict[str, list]:
+    """Stand-in for genai.embed_content: one latency per call, as for a batched request"""
+    if FAKE_EMBED_LATENCY_MS:
+        time.sleep(FAKE_EMBED_LATENCY_MS / 1000)
+    if isinstance(content, str):
+        return {"embedding": fake_embedding(content)}
+    return {"embedding": [fake_embedding(text) for text in content]}
+
+
+def _answer_tokens(messages: List[Dict[str, str]]) -> Tuple[List[str], int]:
+    """Words of the fake answer, and the prompt's token count"""
+    prompt = " ".join(message["content"] for message in messages)
+    context = messages[-1]["content"]
+    words = context.split()[:ANSWER_TOKENS] or ["No", "relevant", "information", "found."]
+    return [word + " " for word in words], len(TOKEN_RE.findall(prompt))
+
+
+def _chunk(content: str = None, usage: SimpleNamespace = None) -> SimpleNamespace:
+    choices = [] if content is None else [SimpleNamespace(delta=SimpleNamespace(content=content))]
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+def _usage(prompt_tokens: int, completion_tokens: int) -> SimpleNamespace:
+    return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                           total_tokens=prompt_tokens + completion_tokens)
+
+
+class _AsyncCompletions:
+    async def create(self, model: str, messages: List[Dict[str, str]], stream: bool = False,
+                     stream_options=None, **_):
+        words, prompt_tokens = _answer_tokens(messages)
+        if not stream:
+            await asyncio.sleep((FAKE_LLM_FIRST_TOKEN_MS + FAKE_LLM_TOKEN_MS * len(words)) / 1000)
+            message = SimpleNamespace(content="".join(words))
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)],
+                                   usage=_usage(prompt_tokens, len(words)))
+        return self._stream(words, prompt_tokens, bool(stream_options and stream_options.get("include_usage")))
+
+    async def _stream(self, words: List[str], prompt_tokens: int, include_usage: bool):
+        await asyncio.sleep(FAKE_LLM_FIRST_TOKEN_MS / 1000)
+        for i, word in enumerate(words):
+            # Yield to the event loop between tokens, as a network stream would
+            await asyncio.sleep(FAKE_LLM_TOKEN_MS / 1000 if i else 0)
+            yield _chunk(word)
+        if include_usage:
+            yield _chunk(usage=_usage(prompt_tokens, len(words)))
+
+
+class FakeAsyncOpenAI:
+    """Stand-in for openai.AsyncOpenAI (chat completions only)"""
+
+    def __init__(self, **_):
+        self.chat = SimpleNamespace(completions=_AsyncCompletions())
+
+
+class FakeGenerativeModel:
+    """Stand-in for the Gemini chat model used for web search"""
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+
+    def start_chat(self, history=None) -> "FakeGenerativeModel":
+        return self
+
+    def send_message(self, message: str) -> SimpleNamespace:
+        time.sleep(FAKE_LLM_FIRST_TOKEN_MS / 1000)
+        query = message.rsplit("\n\n", 1)[-1]
+        return SimpleNamespace(text=f"Simulated web results for: {query}")
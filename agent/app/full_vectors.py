@@ -0,0 +1,81 @@
+import os
+import threading
+import logging
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class FullVectors:
+    """Full-precision copies of a collection's vectors, kept on disk next to a compressed index.
+
+    The file holds one float32 row per chunk id, at offset chunk_id * dim * 4,
+    and is memory-mapped for reading, so rows stay on disk and in the page
+    cache (shared by every process using the collection) rather than in the
+    index's memory. Rows are only ever written for new chunk ids, so a row
+    never changes once written; rows never written, for chunks added while
+    the copies were not being kept, read back as zeros and count as missing.
+
+    Rows are written after the log record holding the same vector and only
+    flushed to disk before that log is truncated, so replaying the log
+    restores any a crash loses.
+    """
+
+    def __init__(self, path: Path, dim: int):
+        self.path = path
+        self.dim = dim
+        self.row_bytes = dim * 4
+        # Mapping of the rows the file held when last mapped; replaced when it has grown
+        self.mapped = np.zeros((0, dim), dtype='float32')
+        self.map_lock = threading.Lock()
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def write(self, ids: np.ndarray, vectors: np.ndarray):
+        """Store the rows of the given chunk ids"""
+        ids = np.asarray(ids, dtype='int64')
+        if not len(ids):
+            return
+        vectors = np.ascontiguousarray(vectors, dtype='float32')
+        # Chunk ids are assigned in runs, so most writes are a single contiguous block
+        breaks = np.flatnonzero(np.diff(ids) != 1) + 1
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'r+b') as f:
+            for start, end in zip([0, *breaks], [*breaks, len(ids)]):
+                f.seek(int(ids[start]) * self.row_bytes)
+                f.write(vectors[start:end].tobytes())
+
+    def sync(self):
+        """Flush written rows to disk"""
+        if self.exists():
+            with open(self.path, 'rb') as f:
+                os.fsync(f.fileno())
+
+    def mapping(self, rows_needed: int) -> np.ndarray:
+        """The file's rows, remapped if it may have grown past the current mapping"""
+        mapped = self.mapped
+        if len(mapped) >= rows_needed:
+            return mapped
+        with self.map_lock:
+            try:
+                rows = self.path.stat().st_size // self.row_bytes
+            except FileNotFoundError:
+                rows = 0
+            if rows > len(self.mapped):
+                self.mapped = np.memmap(self.path, dtype='float32', mode='r', shape=(rows, self.dim))
+            return self.mapped
+
+    def rows(self, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """The rows of the given chunk ids, and a mask of which of them were found"""
+        ids = np.asarray(ids, dtype='int64')
+        vectors = np.zeros((len(ids), self.dim), dtype='float32')
+        mapped = self.mapping(int(ids.max(initial=-1)) + 1)
+        inside = ids < len(mapped)
+        vectors[inside] = mapped[ids[inside]]
+        return vectors, inside & vectors.any(axis=1)
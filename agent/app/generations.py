@@ -0,0 +1,76 @@
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import faiss
+
+from app.persistence import atomic_write
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# A writer publishes read-only copies of its index as numbered generation
+# directories (one index file per shard plus meta.json). CURRENT names the
+# newest one and is replaced atomically, so readers only ever see complete
+# generations.
+CURRENT_FILE = "CURRENT"
+INDEX_FILE = "index.bin"
+META_FILE = "meta.json"
+
+
+def index_file(number: int, count: int) -> str:
+    """Name of one shard's index file within a generation"""
+    return INDEX_FILE if count == 1 else f"index.{number}.bin"
+
+
+def current_generation(generations_dir: Path) -> Optional[int]:
+    """Number of the newest published generation, if any"""
+    try:
+        return int((generations_dir / CURRENT_FILE).read_text().strip())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def publish_generation(generations_dir: Path, write_indexes: List[Callable[[str], None]], meta: Dict[str, Any],
+                       keep: int) -> int:
+    """Write a new generation, one index file per shard, point CURRENT at it and prune all but the newest keep generations.
+
+    Readers that still have a pruned generation mapped keep working: the
+    file stays alive until they unmap it.
+    """
+    generations_dir.mkdir(exist_ok=True, parents=True)
+    generation = (current_generation(generations_dir) or 0) + 1
+    staging = generations_dir / f".staging-{generation}"
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir()
+
+    for number, write_index in enumerate(write_indexes):
+        atomic_write(staging / index_file(number, len(write_indexes)), write_index)
+    atomic_write(staging / META_FILE, lambda path: Path(path).write_text(json.dumps({**meta, "generation": generation})))
+    final = generations_dir / str(generation)
+    shutil.rmtree(final, ignore_errors=True)
+    os.rename(staging, final)
+    atomic_write(generations_dir / CURRENT_FILE, lambda path: Path(path).write_text(str(generation)))
+
+    for old in generations_dir.iterdir():
+        if old.is_dir() and old.name.isdigit() and int(old.name) <= generation - keep:
+            shutil.rmtree(old, ignore_errors=True)
+    return generation
+
+
+def load_generation(generations_dir: Path, generation: int) -> Tuple[List[Any], Dict[str, Any]]:
+    """Open a published generation's shard indexes memory-mapped, with its metadata.
+
+    Only IVF inverted lists are mapped; other index types are read into
+    memory. The mapped indexes are read-only.
+    """
+    path = generations_dir / str(generation)
+    meta = json.loads((path / META_FILE).read_text())
+    # Generations published before sharding hold a single index
+    count = len(meta.get("shards", [meta]))
+    indexes = [faiss.read_index(str(path / index_file(number, count)), faiss.IO_FLAG_MMAP) for number in range(count)]
+    return indexes, meta
@@ -0,0 +1,312 @@
+import faiss
+import numpy as np
+import logging
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+from app.config import (
+    EMBEDDING_DIM,
+    INDEX_TYPE,
+    INDEX_METRIC,
+    INDEX_NLIST,
+    INDEX_PQ_M,
+    INDEX_HNSW_M,
+    INDEX_TRAIN_MIN,
+    INDEX_NPROBE,
+    INDEX_EF_SEARCH,
+)
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+INDEX_TYPES = ("flat", "flat_fp16", "flat_sq8", "ivf_flat", "ivf_fp16", "ivf_sq8", "ivf_pq",
+               "hnsw", "hnsw_fp16", "hnsw_sq8")
+# faiss scalar quantizers behind the _fp16 and _sq8 types: 2 bytes and 1 byte per dimension instead of 4
+SCALAR_QUANTIZERS = {"fp16": "SQfp16", "sq8": "SQ8"}
+INDEX_METRICS = {"cosine": faiss.METRIC_INNER_PRODUCT, "l2": faiss.METRIC_L2}
+
+if INDEX_TYPE not in INDEX_TYPES:
+    raise ValueError(f"INDEX_TYPE must be one of {', '.join(INDEX_TYPES)}, got {INDEX_TYPE!r}")
+if INDEX_METRIC not in INDEX_METRICS:
+    raise ValueError(f"INDEX_METRIC must be one of {', '.join(INDEX_METRICS)}, got {INDEX_METRIC!r}")
+
+
+def factory_string(index_type: str) -> str:
+    """Translate a configured index type into a faiss index_factory description"""
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "ivf_flat":
+        return f"IVF{INDEX_NLIST},Flat"
+    if index_type == "ivf_pq":
+        return f"IVF{INDEX_NLIST},PQ{INDEX_PQ_M}"
+    if index_type == "hnsw":
+        return f"HNSW{INDEX_HNSW_M},Flat"
+    family, _, storage = index_type.partition("_")
+    if storage in SCALAR_QUANTIZERS:
+        codes = SCALAR_QUANTIZERS[storage]
+        if family == "flat":
+            return codes
+        if family == "ivf":
+            return f"IVF{INDEX_NLIST},{codes}"
+        if family == "hnsw":
+            return f"HNSW{INDEX_HNSW_M},{codes}"
+    raise ValueError(f"Unknown index type: {index_type}")
+
+
+def base_index(index):
+    """The index that stores and searches the vectors underneath an IndexIDMap2.
+
+    faiss 1.7.4 rejects search parameters (and with them ID selectors) on
+    IndexIDMap2, so filtered searches run on the base index by position and
+    translate positions back to chunk ids through the id map.
+    """
+    if isinstance(index, faiss.IndexIDMap2):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def storage_suffix(index) -> str:
+    """_fp16 or _sq8 for an index storing scalar-quantized codes, empty for one storing float32 vectors"""
+    if isinstance(index, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return "_fp16" if index.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "_sq8"
+    return ""
+
+
+def index_type_of(index) -> str:
+    """Return the configured-type name that describes an existing index"""
+    index = base_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw" + storage_suffix(faiss.downcast_index(index.storage))
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf" + (storage_suffix(index) or "_flat")
+    return "flat" + storage_suffix(index)
+
+
+def compressed(index_type: str) -> bool:
+    """Whether indexes of this type keep lossy codes rather than the float32 vectors themselves"""
+    return index_type == "ivf_pq" or index_type.endswith(tuple("_" + storage for storage in SCALAR_QUANTIZERS))
+
+
+def metric_of(index) -> str:
+    """Return the configured-metric name that describes an existing index"""
+    return "cosine" if base_index(index).metric_type == faiss.METRIC_INNER_PRODUCT else "l2"
+
+
+def prepare_vectors(vectors, metric: str = INDEX_METRIC) -> np.ndarray:
+    """Convert embeddings to the contiguous float32 matrix an index of this metric expects.
+
+    Cosine indexes store unit vectors, so that inner product equals cosine
+    similarity; queries must be prepared the same way.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    if metric == "cosine":
+        vectors = vectors.copy()
+        faiss.normalize_L2(vectors)
+    return vectors
+
+
+def similarities(index, distances: np.ndarray) -> np.ndarray:
+    """Map raw search distances to similarity scores where higher is better"""
+    if metric_of(index) == "cosine":
+        return distances
+    # L2 distances have no fixed scale; squash them into (0, 1]
+    return 1 / (1 + distances)
+
+
+@lru_cache(maxsize=None)
+def min_training_vectors(index_type: str) -> int:
+    """Number of vectors that must exist before an index of this type can be built"""
+    return 0 if create_index(index_type).is_trained else INDEX_TRAIN_MIN
+
+
+def apply_default_search_params(index):
+    """Set the configured nprobe/efSearch defaults, which faiss does not persist"""
+    base = base_index(index)
+    index_type = index_type_of(base)
+    if index_type.startswith("ivf"):
+        faiss.extract_index_ivf(base).nprobe = INDEX_NPROBE
+    elif index_type.startswith("hnsw"):
+        base.hnsw.efSearch = INDEX_EF_SEARCH
+    return index
+
+
+def create_index(index_type: str = INDEX_TYPE):
+    """Create an empty, untrained index of the given type, keyed by stable chunk ids"""
+    index = faiss.index_factory(EMBEDDING_DIM, "IDMap2," + factory_string(index_type), INDEX_METRICS[INDEX_METRIC])
+    return apply_default_search_params(index)
+
+
+def empty_copy(index):
+    """An empty index of the same type that keeps the original's training"""
+    base = faiss.clone_index(base_index(index))
+    base.reset()
+    return apply_default_search_params(faiss.IndexIDMap2(base))
+
+
+def create_initial_index():
+    """Create the index for an empty store.
+
+    Index types that need training start out flat and are migrated once
+    enough vectors have been added.
+    """
+    if min_training_vectors(INDEX_TYPE) > 0:
+        return create_index("flat")
+    return create_index(INDEX_TYPE)
+
+
+def needs_migration(index, live_vectors: int, recoverable: bool = False) -> bool:
+    """Whether the index should be rebuilt as the configured type.
+
+    A compressed index only migrates when its original vectors are
+    recoverable from a full-precision copy kept elsewhere.
+    """
+    current_type = index_type_of(index)
+    if current_type == INDEX_TYPE or live_vectors < min_training_vectors(INDEX_TYPE):
+        return False
+    if compressed(current_type) and not recoverable:
+        logger.warning(f"Cannot migrate away from {current_type}: the original vectors are not recoverable")
+        return False
+    return True
+
+
+def stored_ids(index) -> np.ndarray:
+    """Chunk ids of every vector in the index, in position order.
+
+    Ids are only ever appended in increasing order and rebuilds keep that
+    order, so the result is sorted.
+    """
+    if isinstance(index, faiss.IndexIDMap2):
+        return faiss.vector_to_array(index.id_map)
+    return np.arange(index.ntotal, dtype='int64')
+
+
+def positions_of(index, ids: np.ndarray) -> np.ndarray:
+    """Positions in the base index of the given chunk ids; ids not in the index are dropped"""
+    all_ids = stored_ids(index)
+    positions = np.searchsorted(all_ids, ids)
+    positions = positions[positions < len(all_ids)]
+    return positions[np.isin(all_ids[positions], ids)].astype('int64')
+
+
+def reconstruct_vectors(index, start: int, count: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Read the ids and vectors at positions [start, start + count) back out of an index"""
+    base = base_index(index)
+    if count <= 0:
+        return np.empty(0, dtype='int64'), np.empty((0, index.d), dtype='float32')
+    ensure_direct_map(index)
+    return stored_ids(index)[start:start + count], base.reconstruct_n(start, count)
+
+
+def reconstruct_ids(index, ids: np.ndarray) -> Dict[int, np.ndarray]:
+    """Stored vectors of the given chunk ids; ids not in the index are left out"""
+    base = base_index(index)
+    ensure_direct_map(index)
+    all_ids = stored_ids(index)
+    return {int(all_ids[position]): base.reconstruct(int(position)) for position in positions_of(index, ids)}
+
+
+def index_memory_bytes(index) -> int:
+    """Approximate memory an index takes up: its codes and ids, plus centroids or graph links"""
+    base = base_index(index)
+    # IDMap2 keeps every id in its id map and again in a hash map
+    per_vector = 48 if isinstance(index, faiss.IndexIDMap2) else 0
+    fixed = 0
+    index_type = index_type_of(base)
+    if index_type.startswith("ivf"):
+        ivf = faiss.extract_index_ivf(base)
+        # Inverted lists hold an id next to each code
+        per_vector += ivf.code_size + 8
+        fixed += ivf.quantizer.ntotal * index.d * 4
+    elif index_type.startswith("hnsw"):
+        per_vector += faiss.downcast_index(base.storage).code_size
+        fixed += base.hnsw.neighbors.size() * 4
+    else:
+        per_vector += base.code_size
+    return index.ntotal * per_vector + fixed
+
+
+def direct_map_missing(index) -> bool:
+    """Whether reading vectors back out of the index first needs its IVF direct map built"""
+    base = base_index(index)
+    return index_type_of(base).startswith("ivf") and faiss.extract_index_ivf(base).direct_map.no()
+
+
+def ensure_direct_map(index):
+    """Build the IVF direct map reconstruction needs, once; later adds keep it up to date.
+
+    Building it modifies the index, so it must not race with searches.
+    """
+    if direct_map_missing(index):
+        faiss.extract_index_ivf(base_index(index)).make_direct_map()
+
+
+def assign_ids(index):
+    """Wrap an index saved before chunk ids were stable, when ids were positions"""
+    ids, vectors = reconstruct_vectors(index, 0, index.ntotal)
+    wrapped = empty_copy(index)
+    wrapped.add_with_ids(vectors, ids)
+    return wrapped
+
+
+def convert_metric(index):
+    """Rebuild an index with the configured metric, keeping its type and ids"""
+    index_type = index_type_of(index)
+    if compressed(index_type):
+        logger.warning(f"Converting the {index_type} index re-encodes its already compressed vectors")
+    ids, vectors = reconstruct_vectors(index, 0, index.ntotal)
+    if len(ids) < min_training_vectors(index_type):
+        index_type = "flat"
+    return build_index(prepare_vectors(vectors), ids, index_type)
+
+
+def build_index(vectors: np.ndarray, ids: np.ndarray, index_type: str = INDEX_TYPE):
+    """Build, train if necessary, and populate an index of the given type"""
+    index = create_index(index_type)
+    if not index.is_trained:
+        logger.info(f"Training {index_type} index on {len(vectors)} vectors")
+        index.train(vectors)
+    index.add_with_ids(vectors, ids)
+    return index
+
+
+def single_list_index(vectors: np.ndarray, ids: np.ndarray, metric: str = INDEX_METRIC):
+    """An exact index holding every vector in one IVF inverted list.
+
+    faiss only memory-maps the inverted lists of IVF indexes, so flat
+    indexes are published to read-only workers in this form. Probing the
+    single list scans every vector, so results match IndexFlat's.
+    """
+    index = faiss.index_factory(EMBEDDING_DIM, "IDMap2,IVF1,Flat", INDEX_METRICS[metric])
+    ivf = faiss.extract_index_ivf(index)
+    # Any centroid will do when there is only one list
+    ivf.quantizer.add(np.zeros((1, EMBEDDING_DIM), dtype='float32'))
+    ivf.is_trained = True
+    index.is_trained = True
+    index.add_with_ids(vectors, ids)
+    return index
+
+
+def search_params(index, nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                  selector=None):
+    """Build per-request faiss search parameters, or None to use the index defaults.
+
+    selector (a faiss.IDSelector) restricts the search to a subset of ids.
+    Search parameter objects replace the index defaults wholesale, so any
+    value not overridden is copied from the index. The parameters apply to
+    base_index(index), and selectors select positions rather than chunk ids.
+    """
+    index = base_index(index)
+    index_type = index_type_of(index)
+    if index_type.startswith("ivf") and (nprobe is not None or selector is not None):
+        if nprobe is None:
+            nprobe = faiss.extract_index_ivf(index).nprobe
+        return faiss.SearchParametersIVF(sel=selector, nprobe=nprobe)
+    if index_type.startswith("hnsw") and (ef_search is not None or selector is not None):
+        if ef_search is None:
+            ef_search = index.hnsw.efSearch
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=ef_search)
+    if selector is not None:
+        return faiss.SearchParameters(sel=selector)
+    return None
@@ -0,0 +1,175 @@
+import json
+import logging
+import queue
+import threading
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from app.persistence import atomic_write
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# File states that need no further work
+TERMINAL_FILE_STATES = ("done", "skipped", "failed")
+# Job states once every file has reached a terminal state
+TERMINAL_JOB_STATES = ("completed", "completed_with_errors", "failed")
+
+
+class JobStore:
+    """Durable job state: one JSON document per job under jobs_dir.
+
+    Finished jobs are deleted once they are older than retention_hours.
+    """
+
+    def __init__(self, jobs_dir: Path, retention_hours: float):
+        self.jobs_dir = jobs_dir
+        self.jobs_dir.mkdir(exist_ok=True, parents=True)
+        self.retention = timedelta(hours=retention_hours)
+        self.jobs: Dict[str, dict] = {}
+        self.lock = threading.RLock()
+        for path in sorted(self.jobs_dir.glob("*.json")):
+            try:
+                with open(path) as f:
+                    job = json.load(f)
+                self.jobs[job["id"]] = job
+                # Jobs saved before URLs were dropped from finished files
+                finished = [f for f in job["files"] if f["status"] in TERMINAL_FILE_STATES and "url" in f]
+                if finished:
+                    for file_state in finished:
+                        del file_state["url"]
+                    self._save(job)
+            except Exception as e:
+                logger.error(f"Error loading job state from {path}: {str(e)}")
+        logger.info(f"Loaded {len(self.jobs)} jobs from {jobs_dir}")
+        self.prune()
+
+    def _save(self, job: dict):
+        job["updated_at"] = datetime.now().isoformat()
+
+        def dump(path: str):
+            with open(path, 'w') as f:
+                json.dump(job, f)
+
+        atomic_write(self.jobs_dir / f"{job['id']}.json", dump)
+
+    def prune(self):
+        """Delete finished jobs older than the retention period"""
+        cutoff = (datetime.now() - self.retention).isoformat()
+        with self.lock:
+            expired = [
+                job_id for job_id, job in self.jobs.items()
+                if job["status"] in TERMINAL_JOB_STATES and job.get("updated_at", job["created_at"]) < cutoff
+            ]
+            for job_id in expired:
+                del self.jobs[job_id]
+                (self.jobs_dir / f"{job_id}.json").unlink(missing_ok=True)
+        if expired:
+            logger.info(f"Deleted {len(expired)} finished jobs older than {self.retention}")
+
+    def create(self, presigned_urls: List[str], file_names: List[str], collection: Optional[str] = None) -> dict:
+        self.prune()
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "collection": collection,
+            "created_at": datetime.now().isoformat(),
+            "files": [
+                {
+                    "file_name": file_name,
+                    "url": url,
+                    "status": "pending",
+                    "total_pages": None,
+                    "pages_extracted": 0,
+                    "chunks_total": None,
+                    "chunks_processed": 0,
+                    "chunks_embedded": 0,
+                    "chunks_failed": 0,
+                    "error": None,
+                }
+                for url, file_name in zip(presigned_urls, file_names)
+            ],
+        }
+        with self.lock:
+            self.jobs[job["id"]] = job
+            self._save(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return json.loads(json.dumps(job)) if job is not None else None
+
+    def update_file(self, job_id: str, file_index: int, persist: bool = True, **updates):
+        """Apply progress updates to one file of a job and roll them up into the job status"""
+        with self.lock:
+            job = self.jobs[job_id]
+            file_state = job["files"][file_index]
+            file_state.update(updates)
+            if file_state["status"] in TERMINAL_FILE_STATES:
+                # Presigned URLs are credentials, only needed until the file is processed
+                file_state.pop("url", None)
+            states = [f["status"] for f in job["files"]]
+            if all(state == "failed" for state in states):
+                job["status"] = "failed"
+            elif all(state in TERMINAL_FILE_STATES for state in states):
+                job["status"] = "completed_with_errors" if "failed" in states else "completed"
+            elif any(state != "pending" for state in states):
+                job["status"] = "running"
+            if persist:
+                self._save(job)
+
+    def unfinished(self) -> List[tuple]:
+        """(job id, file index) pairs that still need processing, e.g. after a restart"""
+        with self.lock:
+            return [
+                (job["id"], i)
+                for job in self.jobs.values()
+                for i, f in enumerate(job["files"])
+                if f["status"] not in TERMINAL_FILE_STATES
+            ]
+
+
+class JobQueue:
+    """Worker pool that processes one queued file per task"""
+
+    def __init__(self, store: JobStore, process_file: Callable[[str, int, dict], None], workers: int):
+        self.store = store
+        self.process_file = process_file
+        self.tasks: "queue.Queue[tuple]" = queue.Queue()
+        self.threads = [
+            threading.Thread(target=self._work, name=f"ingest-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self):
+        # Pick up files left unfinished by a previous run before accepting new work
+        resumed = self.store.unfinished()
+        for task in resumed:
+            self.tasks.put(task)
+        if resumed:
+            logger.info(f"Resuming {len(resumed)} unfinished files from previous run")
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, presigned_urls: List[str], file_names: List[str], collection: Optional[str] = None) -> dict:
+        job = self.store.create(presigned_urls, file_names, collection)
+        for i in range(len(job["files"])):
+            self.tasks.put((job["id"], i))
+        logger.info(f"Queued job {job['id']} with {len(job['files'])} files")
+        return job
+
+    def _work(self):
+        while True:
+            job_id, file_index = self.tasks.get()
+            try:
+                file_state = self.store.get(job_id)["files"][file_index]
+                self.process_file(job_id, file_index, file_state)
+            except Exception as e:
+                logger.error(f"Error processing file {file_index} of job {job_id}: {str(e)}")
+                self.store.update_file(job_id, file_index, status="failed", error=str(e))
+            finally:
+                self.tasks.task_done()
@@ -0,0 +1,137 @@
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class ReadWriteLock:
+    """Any number of readers or one writer.
+
+    A waiting writer holds back new readers, so a steady stream of searches
+    cannot starve ingestion. Both sides are re-entrant within a thread, and
+    the writing thread may also read.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._write_depth = 0
+        self._writers_waiting = 0
+        self._local = threading.local()
+
+    @contextmanager
+    def read(self):
+        me = threading.get_ident()
+        depth = getattr(self._local, "depth", 0)
+        if depth or self._writer == me:
+            # Already reading (or writing) on this thread; waiting here could deadlock behind a writer
+            self._local.depth = depth + 1
+            try:
+                yield
+            finally:
+                self._local.depth = depth
+            return
+        with self._cond:
+            while self._writer is not None or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        self._local.depth = 1
+        try:
+            yield
+        finally:
+            self._local.depth = 0
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                self._writers_waiting += 1
+                try:
+                    while self._writer is not None or self._readers:
+                        self._cond.wait()
+                finally:
+                    self._writers_waiting -= 1
+                self._writer = me
+            self._write_depth += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._write_depth -= 1
+                if not self._write_depth:
+                    self._writer = None
+                    self._cond.notify_all()
+
+
+class FileLock:
+    """Exclusive lock on a file, held by one process at a time and one thread within it.
+
+    Re-entrant within the owning thread. The lock file is only a handle and
+    is never written; it is opened once and kept open.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            if not self._depth:
+                if self._fd is None:
+                    self.path.parent.mkdir(exist_ok=True, parents=True)
+                    self._fd = os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o644)
+                lock_fd(self._fd)
+            self._depth += 1
+        except BaseException:
+            self._lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            self._depth -= 1
+            if not self._depth:
+                unlock_fd(self._fd)
+        finally:
+            self._lock.release()
+
+    def __del__(self):
+        # Nothing can hold the lock once nothing refers to it
+        if self._fd is not None:
+            os.close(self._fd)
+
+
+def lock_fd(fd: int):
+    """Block until this process holds the exclusive lock on fd"""
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return
+    while True:
+        try:
+            # Retries for ten seconds before raising
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue
+
+
+def unlock_fd(fd: int):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
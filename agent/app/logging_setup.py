@@ -0,0 +1,95 @@
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import uuid
+
+from app.config import LOG_LEVEL, LOG_FORMAT, LOG_DETAIL_SAMPLE_RATE
+
+# Correlation id of the request (or ingestion job) the current code is running for
+request_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+
+# Attributes every LogRecord has; anything else was passed through extra= and is logged as a field
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id"}
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s"
+
+_listener = None
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def sampled(rate: float = LOG_DETAIL_SAMPLE_RATE) -> bool:
+    """Whether to emit one instance of a high-volume detail log"""
+    return rate >= 1 or random.random() < rate
+
+
+class RequestIdFilter(logging.Filter):
+    """Stamp records with the correlation id of the thread or task that logged them"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Queue records without formatting them.
+
+    The stock QueueHandler renders the message in the logging thread; here
+    the listener thread does it, so a request thread only pays for a copy
+    and a queue put.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return copy.copy(record)
+
+
+def configure_logging(level: str = LOG_LEVEL, log_format: str = LOG_FORMAT):
+    """Route all logging through an unbounded queue to a background writer thread.
+
+    Replaces any handlers set up by the modules' basicConfig calls. Safe to
+    call more than once.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if log_format == "json" else logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+    # Flush what is still queued on shutdown
+    atexit.register(_listener.stop)
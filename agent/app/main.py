@@ -1,25 +1,61 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from app.search import search_similar, add_document
-from app.generator import generate_answer
+from pydantic import BaseModel, Field
+from typing import Any, AsyncGenerator, AsyncIterable, Dict, List, Optional, Tuple
+from app.search import (
+    search_similar,
+    search_similar_batch,
+    add_document,
+    check_collection_name,
+    delete_file,
+    get_chunk_vectors,
+    get_corpus_version,
+    get_search_stats,
+    is_ready,
+    start_loading,
+    store_status,
+)
+from app.generator import generate_answer_async
 from app.web_search import fetch_web_search_context
-from app.embedding import get_embedding
-import logging
-import sys
-
-# Set up logging with more detailed configuration
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
+from app.metrics import CACHE_LOOKUPS, CONTEXT_TOKENS_SAVED, metrics_payload, timed
+from app.embedding import get_embedding, get_embeddings, cache_stats
+from app.answer_cache import AnswerCache
+from app.context import budget_web_context, pack_context
+from app.logging_setup import configure_logging, new_request_id, request_id_var
+from app.config import (
+    ANSWER_CACHE_ENABLED,
+    ANSWER_CACHE_SIMILARITY,
+    ANSWER_CACHE_MAX_ENTRIES,
+    ASK_BATCH_CONCURRENCY,
+    BATCH_MAX_QUERIES,
+    BATCH_MAX_TOP_K,
+    BATCH_SEARCH_SIZE,
+    BLOCKING_MAX_WORKERS,
+    HYBRID_SEARCH_ENABLED,
+    INDEX_MODE,
+    CONTEXT_TOKEN_BUDGET,
 )
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+
+# Structured logs, written to stdout from a background thread (LOG_LEVEL, LOG_FORMAT)
+configure_logging()
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the index in the background so the server accepts connections (and
+    # answers /healthz) right away; /readyz reports when it can serve queries
+    start_loading()
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -28,113 +64,390 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Context-Tokens", "X-Context-Tokens-Saved", "X-Request-ID"],
 )
 
+@app.middleware("http")
+async def request_id_middleware(request: Request, call_next):
+    """Tag every log line written while serving a request with its id, taken from X-Request-ID if sent"""
+    request_id = request.headers.get("X-Request-ID") or new_request_id()
+    token = request_id_var.set(request_id)
+    try:
+        response = await call_next(request)
+    finally:
+        request_id_var.reset(token)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+# Bounded pool for the blocking embedding, FAISS and web search calls made from async endpoints
+blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_MAX_WORKERS, thread_name_prefix="blocking")
+
+# Reuse answers for near-identical questions over unchanged retrieved documents
+answer_cache = AnswerCache(
+    ANSWER_CACHE_SIMILARITY,
+    ANSWER_CACHE_MAX_ENTRIES
+) if ANSWER_CACHE_ENABLED else None
+
 class Query(BaseModel):
     query: str
     web_search: bool = False
+    similarity_threshold: float = 0.1  # minimum cosine similarity of vector hits (INDEX_METRIC=cosine)
+    nprobe: Optional[int] = None  # IVF cells to probe (ivf_* indexes)
+    ef_search: Optional[int] = None  # HNSW candidate list size (hnsw* indexes)
+    file_names: Optional[List[str]] = None  # only search chunks from these files
+    collection: Optional[str] = None  # search this collection instead of the default one
+
+class BatchQuery(BaseModel):
+    queries: List[str]
+    top_k: int = Field(default=5, gt=0, le=BATCH_MAX_TOP_K)  # results per query
     similarity_threshold: float = 0.1
+    nprobe: Optional[int] = None
+    ef_search: Optional[int] = None
+    file_names: Optional[List[str]] = None
+    collection: Optional[str] = None
 
 class EmbeddingRequest(BaseModel):
     text: str
 
 class DocumentRequest(BaseModel):
     content: str
+    collection: Optional[str] = None  # created on first use
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call on the bounded worker pool instead of the event loop"""
+    loop = asyncio.get_running_loop()
+    # Carry the request id (and any other context variables) over to the worker thread
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(blocking_executor, functools.partial(context.run, func, *args, **kwargs))
+
+def require_store(collection: Optional[str] = None):
+    """Reject requests to the default collection until its vector store has loaded.
+
+    Named collections are loaded by the request that first uses them, so
+    they do not wait for the default one.
+    """
+    if collection is None and not is_ready():
+        raise HTTPException(status_code=503, detail="Vector store is still loading", headers={"Retry-After": "1"})
+
+def require_writable():
+    """Reject writes on workers that serve a published, read-only index"""
+    if INDEX_MODE == "reader":
+        raise HTTPException(status_code=409, detail="This worker serves a read-only index; send writes to the writer")
+
+def check_collection(name: Optional[str]):
+    """Reject collection names that cannot be used as a directory name"""
+    if name is not None:
+        try:
+            check_collection_name(name)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+def check_batch(request: BatchQuery):
+    if len(request.queries) > BATCH_MAX_QUERIES:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_QUERIES} queries are accepted per request")
+
+def ndjson_line(item: Dict[str, Any]) -> bytes:
+    return (json.dumps(item) + "\n").encode('utf-8')
+
+def timed_web_search(query_text: str) -> str:
+    with timed("web_search"):
+        return fetch_web_search_context(query_text)
+
+async def pack_db_context(context_docs: List[Dict[str, Any]], token_budget: int,
+                          collection: Optional[str] = None) -> Tuple[str, int, int]:
+    """Drop near-duplicate chunks and fit the rest into the token budget: (context, tokens used, tokens saved)"""
+    vectors = await run_blocking(get_chunk_vectors, [doc["id"] for doc in context_docs], collection)
+    db_texts, context_stats = pack_context(context_docs, vectors, token_budget)
+    CONTEXT_TOKENS_SAVED.inc(context_stats["tokens_saved"])
+    return "\n".join(db_texts), context_stats["tokens_used"], context_stats["tokens_saved"]
+
+async def encode_chunks(chunks: AsyncIterable[str]) -> AsyncGenerator[bytes, None]:
+    async for chunk in chunks:
+        yield chunk.encode('utf-8')
+
+def stream_answer(context: str, query_text: str, cache_entry: Optional[tuple] = None,
+                  context_tokens: int = 0, tokens_saved: int = 0) -> StreamingResponse:
+    """Stream a generated answer, recording it in the answer cache when cache_entry is given"""
+    chunks = generate_answer_async(context, query_text)
+    if cache_entry is not None:
+        chunks = answer_cache.record_async(*cache_entry, chunks)
+    return StreamingResponse(
+        encode_chunks(chunks),
+        media_type="text/html",
+        headers={"X-Context-Tokens": str(context_tokens), "X-Context-Tokens-Saved": str(tokens_saved)}
+    )
 
 @app.post("/ask")
 async def ask(query: Query):
-    logger.info(f"Received web_search value: {query.web_search}, type: {type(query.web_search)}")
+    require_store(query.collection)
+    check_collection(query.collection)
     try:
         # Log the incoming request details
-        logger.info("=== New Query Request ===")
-        logger.info(f"Query text: {query.query}")
-        logger.info(f"Web search toggle: {query.web_search} (type: {type(query.web_search)})")
-        logger.info(f"Similarity threshold: {query.similarity_threshold}")
-        logger.info(f"Full query object: {query.dict()}")
-        
-        # Search for similar documents in vector DB
-        context_docs = search_similar(
-            query.query, 
-            top_k=5,
-            similarity_threshold=query.similarity_threshold
+        logger.info(
+            "New query request, web search %s, similarity threshold %s",
+            "on" if query.web_search else "off", query.similarity_threshold,
+            extra={"web_search": query.web_search, "query_length": len(query.query)}
         )
+        logger.debug("Query: %s", query.dict())
+
+        # Start the web search right away so it overlaps with the vector search
+        web_task = None
+        if query.web_search:
+            logger.debug("Web search is ON - fetching web results in parallel")
+            web_task = asyncio.ensure_future(run_blocking(timed_web_search, query.query))
+
+        # Web results change over time, so only DB-only answers are cached.
+        # Embed the query up front so retrieval and the cache lookup share it.
+        use_answer_cache = answer_cache is not None and not query.web_search
+        query_embedding = await run_blocking(get_embedding, query.query) if use_answer_cache else None
+        # Loads the collection if it is not in memory yet
+        corpus_version = await run_blocking(get_corpus_version, query.collection)
+
+        # Search for similar documents in vector DB
+        try:
+            context_docs = await run_blocking(
+                search_similar,
+                query.query, 
+                top_k=5,
+                similarity_threshold=query.similarity_threshold,
+                nprobe=query.nprobe,
+                ef_search=query.ef_search,
+                query_embedding=query_embedding,
+                file_names=query.file_names,
+                collection=query.collection
+            )
+        except BaseException:
+            if web_task is not None:
+                web_task.cancel()
+            raise
+
+        cache_entry = None
+        if use_answer_cache and query_embedding is not None:
+            doc_ids = [doc["id"] for doc in context_docs]
+            cached_chunks = answer_cache.lookup(query_embedding, doc_ids, corpus_version, query.collection)
+            CACHE_LOOKUPS.labels("answer", "miss" if cached_chunks is None else "hit").inc()
+            if cached_chunks is not None:
+                logger.info("Serving answer from answer cache")
+                return StreamingResponse(
+                    (chunk.encode('utf-8') for chunk in cached_chunks),
+                    media_type="text/html"
+                )
+            cache_entry = (query_embedding, doc_ids, corpus_version, query.collection)
         
         # Initialize context
         context = ""
+        context_tokens = 0
+        tokens_saved = 0
         
         # Case 1: No documents found in vector DB
         if not context_docs:
             logger.info("No documents found in vector DB")
             if not query.web_search:
-                logger.info("Web search is OFF - returning no results message")
-                logger.info("Passing empty context to generator")
-                return StreamingResponse(
-                    (chunk.encode('utf-8') for chunk in generate_answer(
-                        "",  # Empty context will trigger no results message
-                        query.query,
-                        stream=True
-                    )),
-                    media_type="text/html"
+                logger.debug("Web search is OFF - passing empty context to generator")
+                return stream_answer(
+                    "",  # Empty context will trigger no results message
+                    query.query,
+                    cache_entry
                 )
             else:
-                logger.info("Web search is ON - fetching web results")
-                web_context = fetch_web_search_context(query.query)
+                web_context, context_tokens = budget_web_context(await web_task, share_with_db=False)
                 context = f"Web search results:\n{web_context}"
-                logger.info(f"Web context length: {len(context)}")
+                logger.debug("Web search is ON - using web results, context length: %d", len(context))
         else:
             # Case 2: Documents found in vector DB
-            db_context = "\n".join([doc["text"] for doc in context_docs])
-            logger.info(f"Found {len(context_docs)} documents in vector DB")
-            logger.info(f"DB context preview: {db_context[:200]}...")  # Log first 200 chars
-            
+            web_context = None
+            web_tokens = 0
+            if query.web_search:
+                web_context, web_tokens = budget_web_context(await web_task, share_with_db=True)
+
+            db_context, db_tokens, tokens_saved = await pack_db_context(context_docs, CONTEXT_TOKEN_BUDGET - web_tokens,
+                                                                        query.collection)
+            context_tokens = db_tokens + web_tokens
+            logger.info("Found %d documents in vector DB", len(context_docs))
+            logger.debug("DB context preview: %.200s...", db_context)
+
             if not query.web_search:
                 # Only use DB results
-                logger.info("Web search is OFF - using only vector DB results")
                 context = f"Vector DB results:\n{db_context}"
-                logger.info(f"DB context length: {len(context)}")
-                logger.info("Passing only DB results to generator")
+                logger.debug("Web search is OFF - using only vector DB results, context length: %d", len(context))
             else:
                 # Combine DB and web results
-                logger.info("Web search is ON - combining with web results")
-                web_context = fetch_web_search_context(query.query)
                 context = f"Vector DB results:\n{db_context}\n\nWeb search results:\n{web_context}"
-                logger.info(f"Combined context length: {len(context)}")
-                logger.info("Passing combined results to generator")
+                logger.debug("Web search is ON - combining with web results, context length: %d", len(context))
         
         # Generate response
-        logger.info("Generating final response")
-        return StreamingResponse(
-            (chunk.encode('utf-8') for chunk in generate_answer(
-                context,
-                query.query,
-                stream=True
-            )),
-            media_type="text/html"
-        )
+        logger.debug("Generating final response")
+        return stream_answer(context, query.query, cache_entry, context_tokens, tokens_saved)
         
     except Exception as e:
-        logger.error(f"Error processing query: {str(e)}")
+        logger.error("Error processing query: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+async def search_batches(request: BatchQuery) -> AsyncGenerator[Tuple[int, List[str], list, List[list], int], None]:
+    """Retrieve for a batch request BATCH_SEARCH_SIZE queries at a time.
+
+    Yields the offset of each group in the request, its queries, their
+    embeddings, their search results and the corpus version searched. Each
+    group is one top_k kNN matrix search, so memory per group is bounded by
+    BATCH_SEARCH_SIZE x top_k hits rather than growing with the corpus.
+    """
+    for start in range(0, len(request.queries), BATCH_SEARCH_SIZE):
+        queries = request.queries[start:start + BATCH_SEARCH_SIZE]
+        embeddings = await run_blocking(get_embeddings, queries)
+        corpus_version = await run_blocking(get_corpus_version, request.collection)
+        results = await run_blocking(
+            search_similar_batch,
+            queries,
+            top_k=request.top_k,
+            similarity_threshold=request.similarity_threshold,
+            nprobe=request.nprobe,
+            ef_search=request.ef_search,
+            query_embeddings=embeddings,
+            file_names=request.file_names,
+            collection=request.collection
+        )
+        yield start, queries, embeddings, results, corpus_version
+
+@app.post("/search-batch")
+async def search_batch(request: BatchQuery):
+    """Retrieval only, for many queries: one NDJSON line per query, in request order.
+
+    Lines stream back after each group of BATCH_SEARCH_SIZE queries has
+    been embedded and searched.
+    """
+    require_store(request.collection)
+    check_batch(request)
+    check_collection(request.collection)
+    logger.info("New batch search request with %d queries", len(request.queries),
+                extra={"queries": len(request.queries)})
+
+    async def lines():
+        async for start, queries, _, results, _ in search_batches(request):
+            for offset, (query_text, docs) in enumerate(zip(queries, results)):
+                yield ndjson_line({"index": start + offset, "query": query_text, "results": docs})
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+async def answer_batch_query(semaphore: asyncio.Semaphore, position: int, query_text: str,
+                             context_docs: List[Dict[str, Any]], query_embedding: Optional[List[float]],
+                             corpus_version: int, collection: Optional[str]) -> Dict[str, Any]:
+    """Answer one query of an /ask-batch request from the documents retrieved for it"""
+    async with semaphore:
+        try:
+            doc_ids = [doc["id"] for doc in context_docs]
+            sources = [
+                {key: doc.get(key) for key in ("id", "file_name", "page_start", "page_end", "score")}
+                for doc in context_docs
+            ]
+            cache_entry = None
+            if answer_cache is not None and query_embedding is not None:
+                cached_chunks = answer_cache.lookup(query_embedding, doc_ids, corpus_version, collection)
+                CACHE_LOOKUPS.labels("answer", "miss" if cached_chunks is None else "hit").inc()
+                if cached_chunks is not None:
+                    return {"index": position, "query": query_text, "answer": "".join(cached_chunks),
+                            "sources": sources, "cached": True}
+                cache_entry = (query_embedding, doc_ids, corpus_version, collection)
+
+            context = ""
+            context_tokens = 0
+            if context_docs:
+                db_context, context_tokens, _ = await pack_db_context(context_docs, CONTEXT_TOKEN_BUDGET, collection)
+                context = f"Vector DB results:\n{db_context}"
+            chunks = generate_answer_async(context, query_text)
+            if cache_entry is not None:
+                chunks = answer_cache.record_async(*cache_entry, chunks)
+            answer = "".join([chunk async for chunk in chunks])
+            return {"index": position, "query": query_text, "answer": answer, "sources": sources,
+                    "context_tokens": context_tokens}
+        except Exception as e:
+            logger.error("Error answering batch query %d: %s", position, e)
+            return {"index": position, "query": query_text, "error": str(e)}
+
+@app.post("/ask-batch")
+async def ask_batch(request: BatchQuery):
+    """Answer many queries from the vector DB: one NDJSON line per query, as each answer completes.
+
+    Answers finish out of order, so each line carries the query's position
+    in the request as index. Up to ASK_BATCH_CONCURRENCY answers are
+    generated at once. Batches do not use web search.
+    """
+    require_store(request.collection)
+    check_batch(request)
+    check_collection(request.collection)
+    logger.info("New batch ask request with %d queries", len(request.queries),
+                extra={"queries": len(request.queries)})
+    semaphore = asyncio.Semaphore(ASK_BATCH_CONCURRENCY)
+
+    async def lines():
+        async for start, queries, embeddings, results, corpus_version in search_batches(request):
+            tasks = [
+                asyncio.ensure_future(answer_batch_query(
+                    semaphore, start + offset, query_text, docs, embedding, corpus_version, request.collection
+                ))
+                for offset, (query_text, docs, embedding) in enumerate(zip(queries, results, embeddings))
+            ]
+            try:
+                for task in asyncio.as_completed(tasks):
+                    yield ndjson_line(await task)
+            finally:
+                # The client went away; stop generating answers nobody will read
+                for task in tasks:
+                    task.cancel()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
 @app.post("/get-embedding")
 async def get_text_embedding(request: EmbeddingRequest):
     try:
-        logger.info(f"Received request for embedding text of length {len(request.text)}")
-        embedding = get_embedding(request.text)
+        logger.info("Received request for embedding text of length %d", len(request.text))
+        embedding = await run_blocking(get_embedding, request.text)
         if embedding is None:
             logger.error("Failed to generate embedding")
             raise HTTPException(status_code=500, detail="Failed to generate embedding")
-        logger.info(f"Successfully generated embedding of length {len(embedding)}")
+        logger.debug("Generated embedding of length %d", len(embedding))
         return {"embedding": embedding}
     except Exception as e:
         logger.error(f"Error generating embedding: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/embedding-cache/stats")
+async def embedding_cache_stats():
+    return cache_stats()
+
+@app.get("/answer-cache/stats")
+async def answer_cache_stats():
+    if answer_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **answer_cache.stats()}
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and its event loop is responding"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: the vector store has loaded and queries can be served"""
+    status = store_status()
+    return JSONResponse(status_code=200 if status["status"] == "ready" else 503, content=status)
+
+@app.get("/metrics")
+async def metrics():
+    body, content_type = metrics_payload()
+    return Response(content=body, headers={"Content-Type": content_type})
+
+@app.get("/search/stats")
+async def search_stats():
+    return {"hybrid": HYBRID_SEARCH_ENABLED, "latency": get_search_stats()}
+
 @app.post("/add-document")
 async def add_document_endpoint(request: DocumentRequest):
+    require_writable()
+    require_store(request.collection)
+    check_collection(request.collection)
     try:
         logger.info(f"Received request to add document of length {len(request.content)}")
-        success = add_document(request.content)
+        success = await run_blocking(add_document, request.content, collection=request.collection)
         if not success:
             logger.error("Failed to add document")
             raise HTTPException(status_code=500, detail="Failed to add document")
@@ -143,3 +456,21 @@ async def add_document_endpoint(request: DocumentRequest):
     except Exception as e:
         logger.error(f"Error adding document: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+
+@app.delete("/documents/{file_name:path}")
+async def delete_document_endpoint(file_name: str, collection: Optional[str] = None):
+    require_writable()
+    require_store(collection)
+    check_collection(collection)
+    try:
+        logger.info(f"Received request to delete document {file_name}")
+        deleted = await run_blocking(delete_file, file_name, collection)
+        if not deleted:
+            raise HTTPException(status_code=404, detail="Document not found")
+        logger.info(f"Deleted {deleted} chunks of {file_name}")
+        return {"status": "success", "message": "Document deleted successfully", "chunks_deleted": deleted}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error deleting document: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,68 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+from app.config import OTEL_ENABLED
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Spans go to whatever tracer provider the OpenTelemetry SDK is configured
+# with (e.g. via opentelemetry-instrument); the API alone makes them no-ops.
+tracer = None
+if OTEL_ENABLED:
+    try:
+        from opentelemetry import trace
+        tracer = trace.get_tracer("orggist")
+    except ImportError:
+        logger.warning("OTEL_ENABLED is set but opentelemetry-api is not installed; spans are disabled")
+
+# Buckets from 5ms to 1 minute cover everything from a cached embedding to a long answer stream
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = Histogram(
+    "orggist_stage_seconds",
+    "Time spent in each stage of a request (embedding, vector_search, web_search, "
+    "time_to_first_token, generation, ...)",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+CACHE_LOOKUPS = Counter("orggist_cache_lookups_total", "Cache lookups by cache and result", ["cache", "result"])
+LLM_TOKENS = Counter("orggist_llm_tokens_total", "Tokens sent to and received from the LLM", ["direction"])
+CONTEXT_TOKENS_SAVED = Counter("orggist_context_tokens_saved_total", "Retrieved tokens left out of LLM prompts")
+INDEX_VECTORS = Gauge("orggist_index_vectors", "Vectors in the FAISS index, including tombstones")
+INDEX_TOMBSTONES = Gauge("orggist_index_tombstones", "Deleted vectors awaiting removal from the index")
+COLLECTIONS_LOADED = Gauge("orggist_collections_loaded", "Named collections currently loaded in memory")
+COLLECTIONS_MEMORY_BYTES = Gauge("orggist_collections_memory_bytes", "Estimated index memory of the loaded named collections")
+COLLECTION_EVICTIONS = Counter("orggist_collection_evictions_total", "Named collections unloaded to stay within the memory budget")
+INGESTED_CHUNKS = Counter("orggist_ingested_chunks_total", "PDF chunks processed by ingestion", ["result"])
+INGEST_CHUNKS_PER_SECOND = Gauge("orggist_ingest_chunks_per_second", "Embedding throughput of the last ingested file")
+
+
+def observe_stage(stage: str, seconds: float):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+@contextmanager
+def timed(stage: str):
+    """Time a block into orggist_stage_seconds, inside an OpenTelemetry span when enabled"""
+    start = time.perf_counter()
+    if tracer is None:
+        try:
+            yield
+        finally:
+            observe_stage(stage, time.perf_counter() - start)
+        return
+    with tracer.start_as_current_span(stage):
+        try:
+            yield
+        finally:
+            observe_stage(stage, time.perf_counter() - start)
+
+
+def metrics_payload():
+    """Body and content type for a /metrics response"""
+    return generate_latest(), CONTENT_TYPE_LATEST
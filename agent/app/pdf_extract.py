@@ -0,0 +1,99 @@
+import logging
+import mmap
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import PyPDF2
+
+from app.config import PDF_EXTRACT_WORKERS, PDF_PAGES_PER_TASK, PDF_EXTRACT_WINDOW, PDF_USE_MMAP
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Kept free of app imports beyond config so pool workers stay cheap to start
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=PDF_EXTRACT_WORKERS)
+    return _executor
+
+
+@contextmanager
+def open_pdf(pdf_path: str):
+    """Open a PDF for reading, memory-mapped when PDF_USE_MMAP is set.
+
+    Mapping lets every pool worker read the same file through the page cache
+    instead of each buffering its own copy.
+    """
+    with open(pdf_path, 'rb') as f:
+        if not PDF_USE_MMAP:
+            yield f
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mapped
+        finally:
+            mapped.close()
+
+
+def count_pages(pdf_path: str) -> int:
+    with open_pdf(pdf_path) as f:
+        return len(PyPDF2.PdfReader(f).pages)
+
+
+def extract_page_range(pdf_path: str, start: int, end: int) -> List[str]:
+    """Extract the text of pages [start, end) of a PDF file; runs in a pool worker"""
+    with open_pdf(pdf_path) as f:
+        reader = PyPDF2.PdfReader(f)
+        return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+
+def iter_pages(pdf_path: str, on_page: Callable[[int, int], None] = None) -> Iterator[Tuple[int, str]]:
+    """Yield (page_number, text) in page order while later pages are still being extracted.
+
+    Page ranges are fanned out across a process pool, but at most
+    PDF_EXTRACT_WINDOW ranges are in flight at once, so memory stays bounded
+    to a window of pages however long the document is.
+    """
+    total_pages = count_pages(pdf_path)
+    logger.info(f"PDF has {total_pages} pages")
+    ranges = [
+        (start, min(start + PDF_PAGES_PER_TASK, total_pages))
+        for start in range(0, total_pages, PDF_PAGES_PER_TASK)
+    ]
+
+    def emit(start: int, texts: List[str]) -> Iterator[Tuple[int, str]]:
+        for offset, text in enumerate(texts):
+            page_number = start + offset + 1
+            logger.debug("Extracted text from page %d/%d, length: %d chars", page_number, total_pages, len(text))
+            if on_page:
+                on_page(page_number, total_pages)
+            yield page_number, text
+
+    # Not worth the inter-process round trip for short documents
+    if len(ranges) <= 1 or PDF_EXTRACT_WORKERS <= 1:
+        for start, end in ranges:
+            yield from emit(start, extract_page_range(pdf_path, start, end))
+        return
+
+    executor = _get_executor()
+    pending = deque()
+    next_range = 0
+    try:
+        while next_range < len(ranges) or pending:
+            while next_range < len(ranges) and len(pending) < PDF_EXTRACT_WINDOW:
+                start, end = ranges[next_range]
+                pending.append((start, executor.submit(extract_page_range, pdf_path, start, end)))
+                next_range += 1
+            start, future = pending.popleft()
+            yield from emit(start, future.result())
+    finally:
+        # The consumer stopped early or failed; don't leave queued work behind
+        for _, future in pending:
+            future.cancel()
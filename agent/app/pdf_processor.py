@@ -1,23 +1,59 @@
 import requests
-import PyPDF2
-import io
-from typing import List
+import hashlib
+import itertools
+import tempfile
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Callable, Iterator, List, Optional, Tuple
 import json
 import os
 from datetime import datetime
-from app.search import add_document
-from app.embedding import get_embedding
+from app.search import (
+    add_documents,
+    check_collection_name,
+    discard_partial_file,
+    get_file_hash,
+    replace_file,
+    start_loading,
+    store_status,
+)
+from app.embedding import get_embeddings
+from app.config import (
+    EMBED_BATCH_SIZE,
+    EMBED_MAX_WORKERS,
+    INGEST_WORKERS,
+    DOWNLOAD_CHUNK_SIZE,
+    DOWNLOAD_MAX_RETRIES,
+    DOWNLOAD_TIMEOUT,
+    JOB_RETENTION_HOURS,
+    DATA_DIR,
+)
+from app.jobs import JobStore, JobQueue
+from app.pdf_extract import iter_pages
+from app.chunker import Chunk, iter_chunks
+from app.metrics import INGESTED_CHUNKS, INGEST_CHUNKS_PER_SECOND, metrics_payload, observe_stage, timed
+from app.logging_setup import configure_logging, request_id_var
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import logging
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
+# Structured logs, written to stdout from a background thread (LOG_LEVEL, LOG_FORMAT)
+configure_logging()
 logger = logging.getLogger(__name__)
 
+data_dir = DATA_DIR
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Accept connections right away; ingestion starts once the index has loaded
+    start_loading(on_ready=start_ingestion)
+    yield
+
 # Create FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -32,154 +68,334 @@ app.add_middleware(
 class PDFProcessRequest(BaseModel):
     presigned_urls: List[str]
     file_names: List[str]
+    collection: Optional[str] = None  # ingest into this collection instead of the default one
 
 class PDFProcessor:
     def __init__(self):
-        self.processed_files = set()  # Keep track of processed files to avoid duplicates
+        # Pooled connections shared by the downloads of the ingestion workers, one file each
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=INGEST_WORKERS, pool_maxsize=INGEST_WORKERS)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
         logger.info("PDFProcessor initialized")
 
-    def download_pdf(self, presigned_url: str) -> bytes:
-        """Download PDF from presigned URL"""
-        try:
-            logger.info(f"Attempting to download PDF from URL: {presigned_url[:100]}...")
-            response = requests.get(presigned_url)
-            response.raise_for_status()
-            logger.info(f"Successfully downloaded PDF, size: {len(response.content)} bytes")
-            return response.content
-        except Exception as e:
-            logger.error(f"Error downloading PDF: {str(e)}")
-            return None
+    def download_pdf(self, presigned_url: str) -> Optional[str]:
+        """Stream a PDF from a presigned URL into a temporary file and return its path.
+
+        The body is written in DOWNLOAD_CHUNK_SIZE pieces, never held in memory
+        whole. A failed attempt is retried with a Range request for the
+        remaining bytes; servers that ignore or reject the Range restart
+        from the beginning.
+        """
+        logger.info(f"Attempting to download PDF from URL: {presigned_url[:100]}...")
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+            pdf_path = f.name
+        written = 0
+        for attempt in range(DOWNLOAD_MAX_RETRIES):
+            try:
+                headers = {"Range": f"bytes={written}-"} if written else {}
+                with self.session.get(presigned_url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                    response.raise_for_status()
+                    if written and response.status_code != 206:
+                        logger.warning("Server ignored range request, restarting download")
+                        written = 0
+                    with open(pdf_path, 'r+b' if written else 'wb') as f:
+                        f.seek(written)
+                        f.truncate()
+                        for block in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            f.write(block)
+                            written += len(block)
+                logger.info(f"Successfully downloaded PDF, size: {written} bytes")
+                return pdf_path
+            except Exception as e:
+                logger.error(f"Error downloading PDF (attempt {attempt + 1}/{DOWNLOAD_MAX_RETRIES}, {written} bytes so far): {str(e)}")
+                status = getattr(getattr(e, "response", None), "status_code", None)
+                if status == 416 and written:
+                    # The server cannot serve the remaining range (the object may have changed)
+                    logger.warning("Server rejected range request, restarting download")
+                    written = 0
+                    continue
+                # Client errors such as an expired presigned URL won't fix themselves
+                if status is not None and 400 <= status < 500:
+                    break
+        os.unlink(pdf_path)
+        return None
+
+    def hash_file(self, pdf_path: str) -> str:
+        """SHA-256 of a downloaded PDF, used to recognise re-uploads of unchanged content"""
+        digest = hashlib.sha256()
+        with open(pdf_path, 'rb') as f:
+            for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def iter_pdf_pages(self, pdf_path: str, on_page: Callable[[int, int], None] = None) -> Iterator[Tuple[int, str]]:
+        """Yield (page_number, text) in order as the process pool extracts pages"""
+        logger.info("Starting PDF text extraction")
+        return iter_pages(pdf_path, on_page)
+
+    def label_chunk(self, file_name: str, chunk: Chunk) -> str:
+        """Prefix a chunk with its source file and the page(s) it came from"""
+        if chunk.page_start == chunk.page_end:
+            return f"[{file_name} - Page {chunk.page_start}] {chunk.text}"
+        return f"[{file_name} - Pages {chunk.page_start}-{chunk.page_end}] {chunk.text}"
+
+    def process_pdf(self, url: str, file_name: str, report: Callable[..., None] = None, skip_chunks: int = 0,
+                    collection: Optional[str] = None) -> bool:
+        """Download, extract, chunk and embed one PDF into the vector DB.
+
+        Pages stream from the extraction pool into the chunker, so embedding
+        starts once the first window of chunks is ready rather than after the
+        whole document has been parsed.
+
+        report(persist=True, **fields) receives progress updates (status,
+        pages_extracted, chunks_processed, ...); chunk counts cover this call
+        only. skip_chunks resumes a file whose first chunks were already
+        added before a restart. collection names the collection to ingest
+        into, the default one if None.
+
+        A file whose content is unchanged since it was last ingested is
+        skipped without any embedding calls; changed content replaces the
+        file's previous chunks only once every new one has been added.
+        """
+        report = report or (lambda persist=True, **fields: None)
+        logger.info(f"\nProcessing file: {file_name}")
+
+        # Download PDF
+        logger.info(f"Downloading PDF from URL...")
+        report(status="downloading")
+        with timed("pdf_download"):
+            pdf_path = self.download_pdf(url)
+        if not pdf_path:
+            logger.error(f"Failed to download {file_name}")
+            report(status="failed", error="Failed to download PDF")
+            return False
+        logger.info(f"Successfully downloaded {file_name}")
+
+        content_hash = self.hash_file(pdf_path)
+        if get_file_hash(file_name, collection) == content_hash:
+            logger.info(f"File {file_name} already processed with identical content, skipping...")
+            os.unlink(pdf_path)
+            report(status="skipped")
+            return True
+        if not skip_chunks:
+            # Chunks of this exact content from an attempt that never finished
+            discarded = discard_partial_file(file_name, content_hash, collection)
+            if discarded:
+                logger.info(f"Discarded {discarded} chunks from an unfinished ingestion of {file_name}")
+
+        # Create metadata; the query string of a presigned URL is a short-lived credential
+        metadata = {
+            "file_name": file_name,
+            "created_at": datetime.now().isoformat(),
+            "source_url": url.split("?")[0],
+            "content_hash": content_hash
+        }
+        logger.info(f"Created metadata for {file_name}")
 
-    def extract_text_from_pdf(self, pdf_content: bytes) -> str:
-        """Extract text from PDF content"""
         try:
-            logger.info("Starting PDF text extraction")
-            pdf_file = io.BytesIO(pdf_content)
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
-            text = ""
-            total_pages = len(pdf_reader.pages)
-            logger.info(f"PDF has {total_pages} pages")
-            
-            for i, page in enumerate(pdf_reader.pages):
-                page_text = page.extract_text()
-                text += page_text + "\n"
-                logger.info(f"Extracted text from page {i+1}/{total_pages}, length: {len(page_text)} chars")
-            
-            logger.info(f"Total extracted text length: {len(text)} chars")
-            return text
-        except Exception as e:
-            logger.error(f"Error extracting text from PDF: {str(e)}")
-            return None
-
-    def chunk_text(self, text: str, chunk_size: int = 1000) -> List[str]:
-        """Split text into smaller chunks for better processing"""
-        logger.info(f"Starting text chunking, total text length: {len(text)} chars")
-        words = text.split()
-        chunks = []
-        current_chunk = []
-        current_size = 0
-
-        for word in words:
-            current_chunk.append(word)
-            current_size += len(word) + 1  # +1 for space
-            if current_size >= chunk_size:
-                chunks.append(" ".join(current_chunk))
-                current_chunk = []
-                current_size = 0
-
-        if current_chunk:
-            chunks.append(" ".join(current_chunk))
-
-        logger.info(f"Created {len(chunks)} chunks from text")
-        return chunks
-
-    def process_pdf_urls(self, presigned_urls: List[str], file_names: List[str]):
-        """Process multiple PDF URLs and store their contents in vector DB"""
-        logger.info("\n=== Starting PDF Processing ===")
-        logger.info(f"Received {len(presigned_urls)} files to process")
-        
-        for url, file_name in zip(presigned_urls, file_names):
-            logger.info(f"\nProcessing file: {file_name}")
-            if file_name in self.processed_files:
-                logger.info(f"File {file_name} already processed, skipping...")
-                continue
-
-            # Download PDF
-            logger.info(f"Downloading PDF from URL...")
-            pdf_content = self.download_pdf(url)
-            if not pdf_content:
-                logger.error(f"Failed to download {file_name}")
-                continue
-            logger.info(f"Successfully downloaded {file_name}")
-
-            # Extract text
-            logger.info(f"Extracting text from {file_name}...")
-            text = self.extract_text_from_pdf(pdf_content)
-            if not text:
-                logger.error(f"Failed to extract text from {file_name}")
-                continue
-            logger.info(f"Successfully extracted text from {file_name}")
-
-            # Create metadata
-            metadata = {
-                "file_name": file_name,
-                "processed_date": datetime.now().isoformat(),
-                "source_url": url
-            }
-            logger.info(f"Created metadata for {file_name}")
-
-            # Split text into chunks and add to vector DB
-            logger.info(f"Splitting text into chunks and adding to vector DB...")
-            chunks = self.chunk_text(text)
-            logger.info(f"Created {len(chunks)} chunks from {file_name}")
-            
+            # Extract and chunk lazily; nothing below holds more than one window of chunks
+            logger.info(f"Extracting text from {file_name} and adding chunks to vector DB...")
+            report(status="extracting")
+            ingest_start = time.perf_counter()
+            pages = self.iter_pdf_pages(
+                pdf_path,
+                on_page=lambda done, total: report(persist=False, pages_extracted=done, total_pages=total)
+            )
+            # Add metadata to each chunk
+            chunks_with_metadata = (
+                (self.label_chunk(file_name, chunk), {
+                    **metadata,
+                    "page_start": chunk.page_start,
+                    "page_end": chunk.page_end,
+                    "byte_start": chunk.byte_start,
+                    "byte_end": chunk.byte_end,
+                })
+                for chunk in iter_chunks(pages)
+            )
+            if skip_chunks:
+                logger.info(f"Resuming {file_name} after {skip_chunks} already embedded chunks")
+                chunks_with_metadata = itertools.islice(chunks_with_metadata, skip_chunks, None)
+
+            # Embed a window of batches concurrently, then add each batch to the
+            # vector DB as one stacked matrix
             successful_chunks = 0
-            for i, chunk in enumerate(chunks):
-                # Add metadata to each chunk
-                chunk_with_metadata = f"[{file_name} - Page {i+1}] {chunk}"
-                
+            failed_chunks = 0
+            processed = skip_chunks
+            window = EMBED_BATCH_SIZE * EMBED_MAX_WORKERS
+            while True:
+                window_chunks = list(itertools.islice(chunks_with_metadata, window))
+                if not window_chunks:
+                    break
+                report(status="embedding", persist=False)
                 try:
-                    # Get embedding for the chunk
-                    logger.info(f"Getting embedding for chunk {i+1}/{len(chunks)}")
-                    embedding = get_embedding(chunk_with_metadata)
-                    
-                    if embedding is None:
-                        logger.error(f"Failed to get embedding for chunk {i+1}")
-                        continue
-                        
-                    # Add to vector DB with embedding
-                    add_document(chunk_with_metadata, embedding)
-                    successful_chunks += 1
-                    logger.info(f"Added chunk {i+1}/{len(chunks)} from {file_name} to vector DB")
+                    logger.debug("Getting embeddings for chunks %d-%d", processed + 1, processed + len(window_chunks))
+                    embeddings = get_embeddings([text for text, _ in window_chunks])
                 except Exception as e:
-                    logger.error(f"Error processing chunk {i+1} from {file_name}: {str(e)}")
+                    logger.error(f"Error embedding chunks {processed + 1}-{processed + len(window_chunks)} "
+                                 f"from {file_name}: {str(e)}")
+                    embeddings = [None] * len(window_chunks)
 
-            logger.info(f"Successfully added {successful_chunks}/{len(chunks)} chunks to vector DB")
-            
-            # Mark as processed
-            self.processed_files.add(file_name)
-            logger.info(f"Successfully processed {file_name}")
+                # Each batch is committed on its own, so progress is recorded after every
+                # one: a resume after a crash must start right after the last batch added
+                for batch_start in range(0, len(window_chunks), EMBED_BATCH_SIZE):
+                    batch_chunks = window_chunks[batch_start:batch_start + EMBED_BATCH_SIZE]
+                    batch = [
+                        (text, embedding, chunk_metadata)
+                        for (text, chunk_metadata), embedding in zip(
+                            batch_chunks, embeddings[batch_start:batch_start + EMBED_BATCH_SIZE]
+                        )
+                        if embedding is not None
+                    ]
+                    if len(batch) < len(batch_chunks):
+                        logger.error(f"Failed to get embeddings for {len(batch_chunks) - len(batch)} chunks "
+                                     f"from {file_name}")
+                    added = 0
+                    if batch:
+                        texts, vectors, metadatas = zip(*batch)
+                        try:
+                            added = add_documents(list(texts), list(vectors), list(metadatas), collection)
+                        except Exception as e:
+                            logger.error(f"Error adding chunks {processed + 1}-{processed + len(batch_chunks)} "
+                                         f"from {file_name}: {str(e)}")
+                    # Only chunks that were not committed count as failed
+                    failed = len(batch_chunks) - added
+                    processed += len(batch_chunks)
+                    successful_chunks += added
+                    failed_chunks += failed
+                    INGESTED_CHUNKS.labels("embedded").inc(added)
+                    INGESTED_CHUNKS.labels("failed").inc(failed)
+                    report(
+                        chunks_processed=processed,
+                        chunks_embedded=successful_chunks,
+                        chunks_failed=failed_chunks
+                    )
+                logger.debug("Added %d chunks from %s to vector DB so far", successful_chunks, file_name)
+        except Exception as e:
+            logger.error(f"Error extracting text from {file_name}: {str(e)}")
+            report(status="failed", error=f"Failed to extract text from PDF: {str(e)}")
+            return False
+        finally:
+            os.unlink(pdf_path)
+
+        if processed == 0:
+            logger.error(f"Failed to extract text from {file_name}")
+            report(status="failed", error="Failed to extract text from PDF")
+            return False
+        if successful_chunks == 0 and not skip_chunks:
+            logger.error(f"Failed to add any of the {processed} chunks of {file_name}")
+            report(chunks_total=processed, status="failed", error="Failed to embed any chunks of the PDF")
+            return False
+
+        report(chunks_total=processed)
+        ingest_seconds = time.perf_counter() - ingest_start
+        observe_stage("pdf_ingest", ingest_seconds)
+        INGEST_CHUNKS_PER_SECOND.set(successful_chunks / ingest_seconds if ingest_seconds > 0 else 0.0)
+        logger.info(f"Successfully added {successful_chunks}/{processed - skip_chunks} chunks to vector DB "
+                    f"in {ingest_seconds:.1f}s")
         
-        logger.info("\n=== PDF Processing Complete ===\n")
+        # Mark as processed; a file with failed chunks keeps its previous version and is
+        # re-ingested if uploaded again
+        if replace_file(file_name, content_hash, processed, collection=collection) is None:
+            logger.error(f"Failed to add every chunk of {file_name}")
+            report(status="failed", error="Failed to embed every chunk of the PDF; any previous version was kept")
+            return False
+        report(status="done")
+        logger.info(f"Successfully processed {file_name}")
+        return True
 
 # Initialize PDF processor
 pdf_processor = PDFProcessor()
 
+def process_job_file(job_id: str, file_index: int, file_state: dict):
+    """Run one file of an ingestion job, recording its progress in the job store"""
+    # Worker threads are reused across jobs, so each file sets its own correlation id
+    request_id_var.set(f"{job_id}:{file_index}")
+    # Chunks embedded or failed before a restart still count towards this file
+    previous_embedded = file_state["chunks_embedded"]
+    previous_failed = file_state["chunks_failed"]
+
+    def report(persist: bool = True, **fields):
+        if "chunks_embedded" in fields:
+            fields["chunks_embedded"] += previous_embedded
+        if "chunks_failed" in fields:
+            fields["chunks_failed"] += previous_failed
+        job_store.update_file(job_id, file_index, persist=persist, **fields)
+
+    pdf_processor.process_pdf(
+        file_state["url"],
+        file_state["file_name"],
+        report,
+        skip_chunks=file_state["chunks_processed"],
+        # Jobs queued before collections existed have none
+        collection=job_store.get(job_id).get("collection")
+    )
+
+# Ingestion jobs run in the background; their state survives restarts
+job_store = JobStore(data_dir / "jobs", JOB_RETENTION_HOURS)
+job_queue = JobQueue(job_store, process_job_file, INGEST_WORKERS)
+# Set once the store has loaded and the workers have picked up unfinished files
+ingestion_ready = threading.Event()
+
+def start_ingestion():
+    job_queue.start()
+    ingestion_ready.set()
+
 @app.post("/process-pdfs")
 async def process_pdfs(request: PDFProcessRequest):
+    if not ingestion_ready.is_set():
+        raise HTTPException(status_code=503, detail="Vector store is still loading", headers={"Retry-After": "1"})
     try:
         logger.info(f"Received request to process {len(request.presigned_urls)} PDFs")
         if len(request.presigned_urls) != len(request.file_names):
             logger.error("Number of URLs and file names don't match")
             raise HTTPException(status_code=400, detail="Number of URLs and file names must match")
+        if request.collection is not None:
+            try:
+                check_collection_name(request.collection)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
         
-        pdf_processor.process_pdf_urls(request.presigned_urls, request.file_names)
-        logger.info("PDF processing completed successfully")
-        return {"message": "PDFs processed successfully"}
+        job = job_queue.submit(request.presigned_urls, request.file_names, request.collection)
+        logger.info(f"PDF processing queued as job {job['id']}")
+        return JSONResponse(
+            status_code=202,
+            content={"message": "PDFs queued for processing", "job_id": job["id"], "status": job["status"]}
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing PDFs: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and its event loop is responding"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: the vector store has loaded and the ingestion workers are running"""
+    status = store_status()
+    if status["status"] == "ready" and not ingestion_ready.is_set():
+        status = {"status": "starting"}
+    return JSONResponse(status_code=200 if status["status"] == "ready" else 503, content=status)
+
+@app.get("/metrics")
+async def metrics():
+    body, content_type = metrics_payload()
+    return Response(content=body, headers={"Content-Type": content_type})
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    # Presigned URLs are credentials; don't echo them back
+    for file_state in job["files"]:
+        file_state.pop("url", None)
+    return job
+
 if __name__ == "__main__":
     import uvicorn
     logger.info("Starting PDF processor server on port 8001")
@@ -0,0 +1,96 @@
+import os
+import pickle
+import struct
+import zlib
+import logging
+from pathlib import Path
+from typing import Any, Callable, Iterator, List, Tuple
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Every log record is framed as <payload length><crc32 of payload><payload>
+# so a write torn by a crash can be detected and dropped on replay.
+RECORD_HEADER = struct.Struct("<II")
+
+
+def atomic_write(path: Path, write_fn: Callable[[str], None]):
+    """Write a file through a temporary sibling and atomically rename it into place"""
+    tmp_path = path.with_name(path.name + ".tmp")
+    write_fn(str(tmp_path))
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    # Persist the rename itself
+    dir_fd = os.open(str(path.parent), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def append_records(log_path: Path, records: List[Any]) -> int:
+    """Append records to the write-ahead log and fsync them; returns the log's new size"""
+    if not records:
+        return log_path.stat().st_size if log_path.exists() else 0
+    buffer = bytearray()
+    for record in records:
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        buffer += RECORD_HEADER.pack(len(payload), zlib.crc32(payload))
+        buffer += payload
+    with open(log_path, 'ab') as f:
+        f.write(buffer)
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+
+def read_new_records(log_path: Path, offset: int) -> Tuple[List[Any], int]:
+    """Intact records appended after offset, and the offset just past the last of them"""
+    records = []
+    for record, offset in read_records_from(log_path, offset):
+        records.append(record)
+    return records, offset
+
+
+def read_records_from(log_path: Path, offset: int) -> Iterator[Tuple[Any, int]]:
+    """Yield (record, offset after it) for every intact record from offset on, stopping at a torn tail"""
+    if not log_path.exists():
+        return
+    with open(log_path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if not header:
+                return
+            if len(header) < RECORD_HEADER.size:
+                logger.warning(f"Ignoring truncated record header at end of {log_path}")
+                return
+            length, checksum = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                logger.warning(f"Ignoring torn record at end of {log_path}")
+                return
+            offset += RECORD_HEADER.size + length
+            yield pickle.loads(payload), offset
+
+
+def truncate_log(log_path: Path):
+    """Drop all records from the write-ahead log once they are covered by a snapshot"""
+    with open(log_path, 'wb') as f:
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def write_snapshot(snapshots: List[Tuple[Path, Callable[[str], None]]], log_path: Path):
+    """Compact the log into fresh snapshot files, given as (path, write function) pairs.
+
+    Each snapshot is atomically renamed into place before the log is
+    truncated, so a crash at any point leaves old snapshots plus the full log
+    or new snapshots plus a log whose records are already applied; replaying
+    records must therefore be idempotent.
+    """
+    for path, write_fn in snapshots:
+        atomic_write(path, write_fn)
+    truncate_log(log_path)
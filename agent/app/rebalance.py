@@ -0,0 +1,41 @@
+import argparse
+import logging
+import sys
+from typing import Optional
+
+from app.config import INDEX_SHARDS
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(message)s',
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+logger = logging.getLogger(__name__)
+
+def rebalance_index(count: int, collection: Optional[str] = None):
+    """Reshard the index of a collection (the default one in DATA_DIR if None) into count shards.
+
+    Safe to run while the servers are up: writers wait for it, and every
+    process picks up the new layout the next time it catches up with the log.
+    """
+    from app import search
+
+    store = search.get_collection(collection)
+    if store is None:
+        print(f"\nCollection {collection} does not exist")
+        sys.exit(1)
+    store.load_store()
+    print(f"\nIndex has {store.total_vectors()} vectors in {len(store.shards)} shards: "
+          f"{[shard.index.ntotal for shard in store.shards]}")
+    sizes = store.rebalance(count)
+    print(f"Rebalanced into {len(sizes)} shards: {sizes}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Redistribute the vector index over a number of shards")
+    parser.add_argument("--shards", type=int, default=INDEX_SHARDS,
+                        help="number of shards to split the index into (default: INDEX_SHARDS)")
+    parser.add_argument("--collection", default=None,
+                        help="collection to reshard (default: the default collection)")
+    args = parser.parse_args()
+    rebalance_index(args.shards, args.collection)
@@ -2,167 +2,1549 @@ import faiss
 import numpy as np
 import os
 import pickle
+import re
+import itertools
+from collections import OrderedDict
 from pathlib import Path
 import logging
-from typing import List, Dict, Any
-from .embedding import get_embedding
+import threading
+import time
+import contextvars
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+from .embedding import get_embedding, get_embeddings
+from .config import (
+    DATA_DIR,
+    EMBEDDING_DIM,
+    WAL_COMPACT_THRESHOLD,
+    TOMBSTONE_COMPACT_RATIO,
+    INDEX_TYPE,
+    INDEX_METRIC,
+    INDEX_RERANK,
+    INDEX_RERANK_FACTOR,
+    HYBRID_SEARCH_ENABLED,
+    HYBRID_CANDIDATES,
+    RRF_K,
+    INDEX_MODE,
+    INDEX_PUBLISH_INTERVAL,
+    INDEX_RELOAD_INTERVAL,
+    INDEX_GENERATIONS_KEPT,
+    INDEX_SHARDS,
+    SHARD_SEARCH_WORKERS,
+    COLLECTION_MEMORY_BUDGET_MB,
+)
+from .index_factory import (
+    apply_default_search_params,
+    assign_ids,
+    base_index,
+    build_index,
+    compressed,
+    convert_metric,
+    create_initial_index,
+    empty_copy,
+    direct_map_missing,
+    ensure_direct_map,
+    index_memory_bytes,
+    index_type_of,
+    metric_of,
+    min_training_vectors,
+    needs_migration,
+    positions_of,
+    prepare_vectors,
+    reconstruct_ids,
+    reconstruct_vectors,
+    search_params,
+    similarities,
+    single_list_index,
+    stored_ids,
+)
+from .full_vectors import FullVectors
+from .generations import current_generation, load_generation, publish_generation
+from .persistence import append_records, read_new_records, write_snapshot
+from .doc_store import DocStore
+from .shards import (
+    MANIFEST_FILE,
+    Shard,
+    file_identity,
+    manifest_snapshot,
+    merge_hits,
+    read_manifest,
+    shard_of,
+    shard_path,
+    shards_for_files,
+    write_manifest,
+)
+from .locks import FileLock, ReadWriteLock
+from .metrics import (
+    COLLECTION_EVICTIONS,
+    COLLECTIONS_LOADED,
+    COLLECTIONS_MEMORY_BYTES,
+    INDEX_TOMBSTONES,
+    INDEX_VECTORS,
+    observe_stage,
+)
+from .logging_setup import sampled
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Get the absolute path to the data directory
-current_dir = Path(os.path.dirname(os.path.abspath(__file__)))
-data_dir = current_dir.parent / "data"
+data_dir = DATA_DIR
 data_dir.mkdir(exist_ok=True, parents=True)
+# Named collections each keep their files in a directory of their own under here
+collections_dir = data_dir / "collections"
 
-# Define file paths
-index_path = data_dir / "faiss_index.bin"
-doc_store_path = data_dir / "doc_store.pkl"
+# Collection names become directory names, so only allow ones that are safe as such
+COLLECTION_NAME_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$")
 
-# Initialize or load FAISS index and document store
-def load_or_create_index():
-    """Load existing index and document store or create new ones"""
-    try:
-        # Check if both files exist and have content
-        if index_path.exists() and doc_store_path.exists():
+# Corpus versions come from one counter shared by every collection, so a
+# collection that is unloaded and loaded again never repeats an earlier version
+corpus_versions = itertools.count(1)
+
+# Runs the keyword leg of hybrid searches while the caller's thread embeds and searches vectors
+keyword_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="keyword-search")
+# Searches the shards of a multi-shard index in parallel. Threads rather than processes:
+# FAISS releases the GIL while it searches, and the shards stay in one address space
+shard_executor = ThreadPoolExecutor(max_workers=SHARD_SEARCH_WORKERS, thread_name_prefix="shard-search")
+
+# Per-leg latency totals reported by get_search_stats
+search_stats: Dict[str, Dict[str, float]] = {}
+search_stats_lock = threading.Lock()
+
+def ensure_writable():
+    if INDEX_MODE == "reader":
+        raise RuntimeError("This process serves a read-only index (INDEX_MODE=reader)")
+
+def add_records(index, records: List[Dict[str, Any]]):
+    if records:
+        index.add_with_ids(
+            prepare_vectors([record["embedding"] for record in records]),
+            np.array([record["id"] for record in records], dtype='int64')
+        )
+
+def load_shard(path: Path) -> Tuple[Any, bool]:
+    """Load one shard's snapshot, or create an empty index if it has none; returns it and whether its metric was converted"""
+    index = None
+    converted = False
+    # Check if the index exists and has content
+    if path.exists():
+        try:
+            logger.info(f"Loading existing index from {path}")
+            index = faiss.read_index(str(path))
+            if not isinstance(index, faiss.IndexIDMap2):
+                logger.info("Assigning stable chunk ids to index saved with positional ids")
+                index = assign_ids(index)
+            if index.ntotal > 0 and metric_of(index) != INDEX_METRIC:
+                logger.info(f"Converting {metric_of(index)} index with {index.ntotal} vectors to {INDEX_METRIC}")
+                index = convert_metric(index)
+                converted = True
+
+            # Verify that the index has content
+            if index.ntotal > 0:
+                apply_default_search_params(index)
+                logger.info(f"Successfully loaded {path.name} with {index.ntotal} vectors")
+            else:
+                logger.warning(f"Existing index {path.name} is empty, creating a new one")
+                index = None
+        except Exception as e:
+            logger.error(f"Error loading existing index {path.name}: {str(e)}")
+            raise
+    else:
+        logger.info(f"Index file {path.name} not found, creating a new one")
+
+    if index is None:
+        index = create_initial_index()
+    return index, converted
+
+def rebuild_target(shard: Shard, recoverable: bool = False) -> Optional[str]:
+    """The index type to rebuild a shard as, if it has outgrown its type or holds too many tombstones.
+
+    recoverable says whether full-precision copies of the vectors exist, without
+    which a compressed index cannot migrate to another type.
+    """
+    if needs_migration(shard.index, shard.index.ntotal - len(shard.tombstones), recoverable):
+        return INDEX_TYPE
+    if shard.tombstones and len(shard.tombstones) >= TOMBSTONE_COMPACT_RATIO * shard.index.ntotal:
+        return index_type_of(shard.index)
+    return None
+
+def tombstone_selector(shard: Shard) -> Tuple[Any, int, Any, Any]:
+    """The shard's index, with a selector excluding its tombstoned vectors in the last slot (None if there are none).
+
+    Call with the collection's index_lock held for reading. Keep the returned
+    tuple for as long as the selector is in use: IDSelectorNot does not own
+    the selector it wraps.
+    """
+    if not shard.tombstones:
+        return shard.index, 0, None, None
+    cache = shard.selector_cache
+    # Tombstones only accumulate until the shard is rebuilt or reloaded, so the count identifies the set
+    if cache is None or cache[0] is not shard.index or cache[1] != len(shard.tombstones):
+        dead = positions_of(shard.index, np.fromiter(shard.tombstones, dtype='int64', count=len(shard.tombstones)))
+        batch = faiss.IDSelectorBatch(dead)
+        cache = (shard.index, len(shard.tombstones), batch, faiss.IDSelectorNot(batch))
+        shard.selector_cache = cache
+    return cache
+
+def rerank_scores(index, full_vectors: FullVectors, query_vectors: np.ndarray, distances: np.ndarray,
+                  positions: np.ndarray) -> np.ndarray:
+    """Similarities of search candidates, exact where the candidate has a full-precision copy.
+
+    Candidates without one keep the approximate score the compressed index gave them.
+    """
+    scores = similarities(index, distances)
+    queries, columns = np.nonzero(positions >= 0)
+    ids = np.array([index.id_map.at(int(position)) for position in positions[queries, columns]], dtype='int64')
+    vectors, found = full_vectors.rows(ids)
+    queries, columns, vectors = queries[found], columns[found], vectors[found]
+    if metric_of(index) == "cosine":
+        scores[queries, columns] = np.einsum('ij,ij->i', query_vectors[queries], vectors)
+    else:
+        scores[queries, columns] = 1 / (1 + ((query_vectors[queries] - vectors) ** 2).sum(axis=1))
+    return scores
+
+def search_shard(shard: Shard, query_vectors: np.ndarray, top_k: int, similarity_threshold: float,
+                 nprobe: Optional[int], ef_search: Optional[int],
+                 allowed_ids: Optional[np.ndarray],
+                 full_vectors: Optional[FullVectors] = None) -> List[List[Tuple[int, float]]]:
+    """Hits of each query vector in one shard, best first. Call with the collection's index_lock held for reading.
+
+    Given full_vectors, hits from a compressed index are re-ranked by their
+    exact similarity to the query.
+    """
+    # Selectors work on positions in one particular index, so pin it for the search
+    if allowed_ids is not None:
+        current_index = shard.index
+        selector = faiss.IDSelectorBatch(positions_of(current_index, allowed_ids))
+    else:
+        # Holding the whole cache entry keeps the selector it wraps alive
+        selection = tombstone_selector(shard)
+        current_index, selector = selection[0], selection[3]
+
+    # Search in FAISS index
+    base = base_index(current_index)
+    params = search_params(current_index, nprobe, ef_search, selector)
+    hits = []
+    if full_vectors is not None and compressed(index_type_of(current_index)):
+        # Codes only approximate the vectors: take extra candidates and score them exactly before filtering
+        distances, all_positions = base.search(query_vectors, top_k * INDEX_RERANK_FACTOR, params=params)
+        all_scores = rerank_scores(current_index, full_vectors, query_vectors, distances, all_positions)
+        for query in range(len(query_vectors)):
+            keep = (all_positions[query] >= 0) & (all_scores[query] >= similarity_threshold)
+            scores, positions = all_scores[query][keep], all_positions[query][keep]
+            best = np.argsort(-scores, kind="stable")[:top_k]
+            hits.append((scores[best], positions[best]))
+    else:
+        # A range search would be bounded by the threshold alone, and real embeddings are similar enough
+        # that low thresholds match most of the corpus; kNN bounds the results to top_k per query
+        distances, all_positions = base.search(query_vectors, top_k, params=params)
+        all_scores = similarities(current_index, distances)
+        # IVF/HNSW pad missing hits with -1
+        keep = (all_positions >= 0) & (all_scores >= similarity_threshold)
+        logger.debug("Rejected %d hits below threshold %.6f", keep.size - int(keep.sum()), similarity_threshold)
+        hits = [(all_scores[query][keep[query]], all_positions[query][keep[query]])
+                for query in range(len(query_vectors))]
+
+    return [
+        [
+            (current_index.id_map.at(position), similarity_score)
+            for similarity_score, position in zip(scores.tolist(), positions.tolist())
+        ]
+        for scores, positions in hits
+    ]
+
+
+class Collection:
+    """One collection of documents: its index shards, document store and write-ahead log.
+
+    Everything a collection keeps on disk lives in its own directory (DATA_DIR
+    itself for the default collection), and it is loaded, locked, compacted,
+    published and unloaded independently of the others. Chunk ids are only
+    unique within a collection.
+    """
+
+    def __init__(self, name: Optional[str], data_dir: Path):
+        self.name = name
+        self.data_dir = data_dir
+
+        # Define file paths; each shard's index snapshot is named by shard_path
+        self.manifest_path = data_dir / MANIFEST_FILE
+        self.docs_db_path = data_dir / "docs.db"
+        # Pickled list of chunk texts used before docs.db; imported once if present
+        self.doc_store_path = data_dir / "doc_store.pkl"
+        self.wal_path = data_dir / "wal.log"
+        # Read-only copies of the index published for INDEX_MODE=reader processes
+        self.generations_dir = data_dir / "generations"
+
+        # Full-precision copies of the vectors, which searches re-rank the candidates of a compressed
+        # index with. Writes keep them up to date while INDEX_TYPE is compressed
+        self.full_vectors = FullVectors(data_dir / "vectors.f32", EMBEDDING_DIM)
+        self.keep_full_vectors = INDEX_RERANK and compressed(INDEX_TYPE)
+
+        # Number of records appended to the write-ahead log since the last snapshot
+        self.wal_records = 0
+        # Bytes of the write-ahead log applied to the in-memory state. Other processes
+        # sharing the data directory append to the same log; catch_up applies their records
+        self.wal_offset = 0
+        # Identity of the shard manifest as loaded or last written. Every compaction
+        # rewrites it, so a different one means another process has truncated the log
+        self.manifest_id = None
+
+        # Bumped on every change to the corpus so caches of derived results can tell they are stale
+        self.corpus_version = 0
+
+        # Searches hold the index for reading; writers hold it exclusively, and only
+        # for the in-memory update, never while embedding or writing to disk
+        self.index_lock = ReadWriteLock()
+        # One writer at a time across all threads and processes using the
+        # collection, from catching up with the log to updating the index
+        self.writer_lock = FileLock(data_dir / "writer.lock")
+        self.rebuild_thread = None
+
+        # Adds waiting to be committed. Whichever writer takes writer_lock next commits
+        # every add queued by then, so concurrent writers share one log fsync, one
+        # document store transaction and one index update
+        self.pending_adds: List[Dict[str, Any]] = []
+        self.pending_lock = threading.Lock()
+
+        # The index and document store are loaded by load_store, not on creation, so a
+        # process can start serving health checks before a large index is read
+        self.doc_store = None
+        # Partitions of the index; chunks are routed to them by shard_of
+        self.shards: List[Shard] = []
+        # Chunk ids are never reused while a vector or log record may still refer to them
+        self.next_chunk_id = 0
+
+        # Set once load_store has finished; load_error holds why it failed, if it did
+        self.store_ready = threading.Event()
+        self.load_error = None
+        self.load_lock = threading.Lock()
+        # Set once the collection is unloaded, which stops its background threads
+        self.closed = threading.Event()
+
+        # Generation loaded (reader) or last published (writer), and the corpus version it was published at
+        self.generation = None
+        self.published_version = None
+
+    def __str__(self) -> str:
+        return f"collection {self.name}" if self.name else "default collection"
+
+    def bump_corpus_version(self):
+        self.corpus_version = next(corpus_versions)
+
+    def total_vectors(self) -> int:
+        """Vectors in all shards, including tombstones"""
+        return sum(shard.index.ntotal for shard in self.shards)
+
+    def total_tombstones(self) -> int:
+        return sum(len(shard.tombstones) for shard in self.shards)
+
+    def memory_bytes(self) -> int:
+        """Estimated memory held by the collection's index"""
+        return sum(index_memory_bytes(shard.index) for shard in self.shards)
+
+    def copy_records(self, records: List[Dict[str, Any]]):
+        """Write the full-precision copies of replayed add records, if they are being kept"""
+        if self.keep_full_vectors and records:
+            self.full_vectors.write(np.array([record["id"] for record in records], dtype='int64'),
+                                    prepare_vectors([record["embedding"] for record in records]))
+
+    def recover_vectors(self, index, ids: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+        """The vectors to rebuild from, given those read back out of index.
+
+        A compressed index only gives back approximations, which are replaced
+        by their full-precision copies where those exist. An uncompressed index
+        gives back the originals, which backfill the copies while they are
+        being kept, as when migrating to a compressed INDEX_TYPE.
+        """
+        if compressed(index_type_of(index)) and self.full_vectors.exists():
+            rows, found = self.full_vectors.rows(ids)
+            vectors[found] = rows[found]
+            if not found.all():
+                logger.warning(f"{len(ids) - int(found.sum())} vectors have no full-precision copy, "
+                               "rebuilding them from their compressed codes")
+        elif self.keep_full_vectors:
+            self.full_vectors.write(ids, vectors)
+        return vectors
+
+    def replay_log(self, shard_list: List[Shard],
+                   records: List[Dict[str, Any]]) -> Tuple[Dict[int, List[Dict[str, Any]]], List[int]]:
+        """Apply write-ahead log records to the document store; returns the add records each shard is missing, by shard number, and the deleted ids.
+
+        Records may already be applied (a crash between writing a snapshot and
+        truncating the log, or rows written by the process that logged them), so
+        adds the index already holds are skipped, row inserts are ignored for
+        existing ids and deletes of missing rows are no-ops. Records are applied
+        in order so a later delete wins over an add.
+        """
+        index_ids = set()
+        for shard in shard_list:
+            index_ids.update(stored_ids(shard.index).tolist())
+        missing = {}
+        deleted = []
+        pending = []
+
+        def flush():
+            for record in pending:
+                if record["id"] not in index_ids:
+                    number = shard_of(record["id"], record.get("metadata"), len(shard_list))
+                    missing.setdefault(number, []).append(record)
+            index_ids.update(record["id"] for record in pending)
+            self.doc_store.add_many(
+                [record["id"] for record in pending],
+                [record["text"] for record in pending],
+                [record.get("metadata") for record in pending]
+            )
+            pending.clear()
+
+        for record in records:
+            if record.get("op") == "delete":
+                flush()
+                self.doc_store.delete_ids(record["ids"])
+                deleted.extend(record["ids"])
+            else:
+                pending.append(record)
+        flush()
+        return missing, deleted
+
+    def find_tombstones(self, shard_list: List[Shard]) -> List[set]:
+        """Reconcile the shards with the document store after loading; returns each shard's tombstones.
+
+        Rows whose vectors never reached the log cannot be searched and are
+        removed; vectors whose rows were deleted are tombstones, excluded from
+        searches until the shard is rebuilt without them.
+        """
+        shard_ids = [stored_ids(shard.index) for shard in shard_list]
+        doc_ids = self.doc_store.all_ids()
+        orphans = np.setdiff1d(doc_ids, np.concatenate(shard_ids))
+        if len(orphans):
+            self.doc_store.delete_ids(orphans)
+            logger.warning(f"Removed {len(orphans)} documents without vectors")
+        return [set(np.setdiff1d(ids, doc_ids).tolist()) for ids in shard_ids]
+
+    def shard_count_on_disk(self) -> int:
+        """Number of shards the index on disk is split into; a new collection takes INDEX_SHARDS"""
+        manifest = read_manifest(self.data_dir)
+        if manifest is not None:
+            return manifest["count"]
+        # Stores written before sharding have a single index and no manifest
+        if (shard_path(self.data_dir, 0, 1).exists() or len(self.doc_store)
+                or (self.wal_path.exists() and self.wal_path.stat().st_size)):
+            return 1
+        return INDEX_SHARDS
+
+    # Initialize or load FAISS index and document store
+    def load_shards(self, previous: Optional[List[Shard]] = None) -> Tuple[List[Shard], int, int]:
+        """Load every shard's index, then replay the write-ahead log into them and the document store.
+
+        Shards of previous whose snapshot file has not been replaced since are
+        kept as they are rather than read again. Returns the shards with the
+        number of log records and the log offset they cover.
+        """
+        # Carry over documents from the pickled list used before the SQLite store
+        if len(self.doc_store) == 0 and self.doc_store_path.exists():
             try:
-                logger.info(f"Loading existing index and document store from {data_dir}")
-                index = faiss.read_index(str(index_path))
-                with open(doc_store_path, 'rb') as f:
-                    doc_store = pickle.load(f)
-                
-                # Verify that both index and doc_store have content
-                if index.ntotal > 0 and len(doc_store) > 0:
-                    logger.info(f"Successfully loaded index with {index.ntotal} vectors and {len(doc_store)} documents")
-                    return index, doc_store
+                with open(self.doc_store_path, 'rb') as f:
+                    self.doc_store.import_texts(pickle.load(f))
+            except Exception as e:
+                logger.error(f"Error importing legacy document store: {str(e)}")
+
+        count = self.shard_count_on_disk()
+        if not self.manifest_path.exists():
+            write_manifest(self.data_dir, count)
+        if count != INDEX_SHARDS:
+            logger.warning(f"The index of the {self} has {count} shards on disk but INDEX_SHARDS is "
+                           f"{INDEX_SHARDS}; run python -m app.rebalance to reshard it")
+        try:
+            kept = {}
+            if previous is not None and len(previous) == count:
+                kept = {shard.number: shard for shard in previous
+                        if shard.file_id is not None and shard.file_id == file_identity(shard.path)}
+            paths = [shard_path(self.data_dir, number, count) for number in range(count)]
+            to_load = [number for number in range(count) if number not in kept]
+            # Shards are independent files, so they are read in parallel
+            with ThreadPoolExecutor(max_workers=max(1, min(len(to_load), SHARD_SEARCH_WORKERS))) as executor:
+                loaded = dict(zip(to_load, executor.map(load_shard, [paths[number] for number in to_load])))
+
+            shard_list = []
+            converted = False
+            for number in range(count):
+                if number in kept:
+                    shard_list.append(kept[number])
+                    continue
+                new_index, shard_converted = loaded[number]
+                shard = Shard(number, paths[number], new_index, file_id=file_identity(paths[number]))
+                shard.dirty = shard_converted
+                converted = converted or shard_converted
+                shard_list.append(shard)
+            if kept:
+                logger.info(f"Kept {len(kept)} of {count} shards whose snapshots were unchanged")
+
+            # Bring the snapshots up to date with anything appended since they were written
+            records, offset = read_new_records(self.wal_path, 0)
+            missing, _ = self.replay_log(shard_list, records)
+            self.copy_records([record for shard_records in missing.values() for record in shard_records])
+            # Kept shards may be being searched
+            with self.index_lock.write():
+                for number, shard_records in missing.items():
+                    add_records(shard_list[number].index, shard_records)
+                    shard_list[number].dirty = True
+            if missing:
+                logger.info(f"Replayed {sum(map(len, missing.values()))} vectors from {self.wal_path}")
+            if converted:
+                # Persist the conversion so it only happens once
+                self.compact(shard_list)
+                records, offset = [], 0
+            return shard_list, len(records), offset
+
+        except Exception as e:
+            # Empty shards would make load_index_state truncate the log and delete every
+            # document as an orphan, so the load fails and leaves the files as they are
+            logger.error(f"Unexpected error in load_shards: {str(e)}")
+            raise
+
+    def drop_torn_tail(self):
+        """Cut a record torn by a crash off the end of the log, so records appended after it stay readable.
+
+        Call with writer_lock held.
+        """
+        if self.wal_path.exists() and self.wal_path.stat().st_size > self.wal_offset:
+            logger.warning(f"Truncating torn record at end of {self.wal_path}")
+            os.truncate(self.wal_path, self.wal_offset)
+
+    def load_index_state(self):
+        """Load the shards from their snapshots and the log and swap them in. Call with writer_lock held.
+
+        Shards whose snapshot file has not been replaced since this process
+        loaded or wrote it are kept rather than read again.
+        """
+        new_shards, self.wal_records, self.wal_offset = self.load_shards(self.shards or None)
+        self.drop_torn_tail()
+        shard_tombstones = self.find_tombstones(new_shards)
+        with self.index_lock.write():
+            for shard, dead in zip(new_shards, shard_tombstones):
+                shard.tombstones = dead
+                shard.selector_cache = None
+            self.shards = new_shards
+            self.bump_corpus_version()
+        highest = max(int(stored_ids(shard.index).max(initial=-1)) for shard in new_shards)
+        self.next_chunk_id = max(self.next_chunk_id,
+                                 max(highest, int(self.doc_store.all_ids().max(initial=-1))) + 1)
+        self.manifest_id = file_identity(self.manifest_path)
+
+    def catch_up(self):
+        """Apply what other processes have written since this one last looked. Call with writer_lock held.
+
+        Records appended to the log are applied to the shards in place. When
+        another process has compacted the log (and so replaced the snapshots of
+        the shards it changed) those shards are loaded afresh and swapped in.
+        """
+        if not self.log_changed():
+            return
+        if file_identity(self.manifest_path) != self.manifest_id:
+            logger.info("Log was compacted by another process, reloading replaced shards")
+            self.load_index_state()
+            return
+        records, end = read_new_records(self.wal_path, self.wal_offset)
+        if records:
+            missing, deleted = self.replay_log(self.shards, records)
+            self.copy_records([record for shard_records in missing.values() for record in shard_records])
+            with self.index_lock.write():
+                for number, shard_records in missing.items():
+                    add_records(self.shards[number].index, shard_records)
+                    self.shards[number].dirty = True
+                self.add_tombstones(deleted)
+                self.bump_corpus_version()
+            added = [record["id"] for record in records if record.get("op") != "delete"]
+            self.next_chunk_id = max([self.next_chunk_id, *(chunk_id + 1 for chunk_id in added)])
+            self.wal_records += len(records)
+            logger.info("Applied %d log records written by another process", len(records))
+        self.wal_offset = end
+        self.drop_torn_tail()
+
+    def log_changed(self) -> bool:
+        size = self.wal_path.stat().st_size if self.wal_path.exists() else 0
+        return size != self.wal_offset or file_identity(self.manifest_path) != self.manifest_id
+
+    def add_tombstones(self, ids: List[int]):
+        """Mark the vectors of deleted chunks as tombstones in the shards holding them. Call with index_lock held for writing."""
+        ids = np.unique(np.array(ids, dtype='int64'))
+        if len(ids):
+            for shard in self.shards:
+                shard.tombstones.update(np.intersect1d(stored_ids(shard.index), ids, assume_unique=True).tolist())
+
+    def follow_log(self):
+        # Searches see other processes' writes within INDEX_RELOAD_INTERVAL, not only once this one writes
+        while not self.closed.wait(INDEX_RELOAD_INTERVAL):
+            try:
+                if self.log_changed():
+                    with self.writer_lock:
+                        self.catch_up()
+            except Exception as e:
+                logger.error(f"Error applying writes from other processes: {str(e)}")
+
+    def publish_index(self) -> int:
+        """Publish the current shards as a new read-only generation for reader processes.
+
+        Flat indexes are copied into a single-list IVF index, without their
+        tombstones, so readers can memory-map them; other types are published
+        as they are, with their tombstones listed for readers to exclude.
+        """
+        copies = []
+        with self.index_lock.read():
+            version = self.corpus_version
+            for shard in self.shards:
+                dead = np.array(sorted(shard.tombstones), dtype='int64')
+                if index_type_of(shard.index) == "flat":
+                    copies.append((shard.index, dead, reconstruct_vectors(shard.index, 0, shard.index.ntotal)))
                 else:
-                    logger.warning("Existing index or document store is empty, creating new ones")
+                    copies.append((shard.index, dead, faiss.serialize_index(shard.index)))
+
+        write_indexes = []
+        shard_meta = []
+        for current, dead, data in copies:
+            if isinstance(data, tuple):
+                ids, vectors = data
+                keep = ~np.isin(ids, dead)
+                published = single_list_index(vectors[keep], ids[keep], metric_of(current))
+                write_indexes.append(lambda path, published=published: faiss.write_index(published, path))
+                dead = dead[:0]
+            else:
+                write_indexes.append(data.tofile)
+            shard_meta.append({
+                "index_type": index_type_of(current),
+                "vectors": int(current.ntotal),
+                "tombstones": dead.tolist(),
+            })
+        self.generation = publish_generation(self.generations_dir, write_indexes, {"shards": shard_meta},
+                                             INDEX_GENERATIONS_KEPT)
+        self.published_version = version
+        logger.info("Published %s generation %d with %d vectors in %d shards",
+                    self, self.generation, sum(meta["vectors"] for meta in shard_meta), len(shard_meta))
+        return self.generation
+
+    def run_publisher(self):
+        # A generation covers every change up to its publication, so bursts of writes share one
+        while not self.closed.is_set():
+            if self.corpus_version != self.published_version:
+                try:
+                    self.publish_index()
+                except Exception as e:
+                    logger.error(f"Error publishing index generation: {str(e)}")
+            self.closed.wait(INDEX_PUBLISH_INTERVAL)
+
+    def load_published(self, number: int):
+        """Swap in a published generation (reader)"""
+        indexes, meta = load_generation(self.generations_dir, number)
+        new_shards = []
+        for shard_number, (new_index, shard_meta) in enumerate(zip(indexes, meta.get("shards", [meta]))):
+            apply_default_search_params(new_index)
+            new_shards.append(Shard(shard_number, None, new_index, set(shard_meta["tombstones"])))
+        with self.index_lock.write():
+            self.shards = new_shards
+            self.generation = number
+            self.bump_corpus_version()
+        logger.info("Loaded %s generation %d with %d vectors in %d shards",
+                    self, number, self.total_vectors(), len(new_shards))
+
+    def follow_generations(self):
+        # Searches in flight keep the generation they started with
+        while not self.closed.wait(INDEX_RELOAD_INTERVAL):
+            try:
+                latest = current_generation(self.generations_dir)
+                if latest is not None and latest != self.generation:
+                    self.load_published(latest)
+            except Exception as e:
+                logger.error(f"Error loading index generation: {str(e)}")
+
+    def load_reader_store(self):
+        """Wait for a writer's first generation, then open it and the document store read-only"""
+        waiting_logged = False
+        while current_generation(self.generations_dir) is None or not self.docs_db_path.exists():
+            if not waiting_logged:
+                logger.info(f"Waiting for a writer to publish an index generation in {self.generations_dir}")
+                waiting_logged = True
+            time.sleep(INDEX_RELOAD_INTERVAL)
+        self.doc_store = DocStore(self.docs_db_path, read_only=True)
+        self.load_published(current_generation(self.generations_dir))
+        threading.Thread(target=self.follow_generations, name="generation-follower", daemon=True).start()
+
+    def load_store(self):
+        """Open the document store and load the index, replaying the write-ahead log. Safe to call more than once.
+
+        With INDEX_MODE=reader the newest published generation is loaded instead
+        and followed as new ones appear.
+        """
+        with self.load_lock:
+            if self.store_ready.is_set():
+                return
+            try:
+                start = time.perf_counter()
+                if INDEX_MODE == "reader":
+                    self.load_reader_store()
+                else:
+                    with self.writer_lock:
+                        self.doc_store = DocStore(self.docs_db_path)
+                        self.load_index_state()
+                    threading.Thread(target=self.follow_log, name="log-follower", daemon=True).start()
+                    if INDEX_MODE == "writer":
+                        threading.Thread(target=self.run_publisher, name="index-publisher", daemon=True).start()
+                self.load_error = None
+                self.store_ready.set()
+                observe_stage("index_load", time.perf_counter() - start)
+                logger.info("Vector store for the %s ready with %d vectors in %d shards in %.2fs",
+                            self, self.total_vectors(), len(self.shards), time.perf_counter() - start)
             except Exception as e:
-                logger.error(f"Error loading existing index or document store: {str(e)}")
-                logger.info("Creating new index and document store")
+                self.load_error = str(e)
+                logger.error(f"Error loading vector store for the {self}: {str(e)}")
+                raise
+
+        # Pick up an INDEX_TYPE change, a corpus that grew past the training threshold,
+        # or tombstones left by deletions before a restart
+        self.maybe_rebuild_index()
+
+    def close(self):
+        """Stop the background threads of an unloaded collection.
+
+        Its writes are already durable in the log; a writer also publishes
+        them so readers are not left behind until the collection is next used.
+        """
+        self.closed.set()
+        if INDEX_MODE == "writer" and self.store_ready.is_set() and self.corpus_version != self.published_version:
+            try:
+                self.publish_index()
+            except Exception as e:
+                logger.error(f"Error publishing index generation: {str(e)}")
+
+    def compact(self, shard_list: List[Shard]):
+        """Write the snapshot of every shard that changed, then truncate the log. Call with writer_lock held."""
+        dirty = [shard for shard in shard_list if shard.dirty]
+        # Copies written since the last snapshot are only durable through the log, so flush them before truncating it
+        self.full_vectors.sync()
+        write_snapshot(
+            [(shard.path, lambda path, index=shard.index: faiss.write_index(index, path)) for shard in dirty]
+            # Rewritten every time, so other processes can tell the log was truncated
+            + [manifest_snapshot(self.data_dir, len(shard_list))],
+            self.wal_path
+        )
+        for shard in dirty:
+            shard.dirty = False
+            shard.file_id = file_identity(shard.path)
+        self.wal_records = 0
+        self.wal_offset = 0
+        self.manifest_id = file_identity(self.manifest_path)
+
+    def save_index_and_docs(self):
+        """Compact the write-ahead log into snapshots of the shards it changed"""
+        try:
+            logger.info("Saving index to disk")
+            # Ensure directory exists
+            self.data_dir.mkdir(exist_ok=True, parents=True)
+
+            # Holding writer_lock keeps the shards unchanged while they are written, without blocking searches
+            with self.writer_lock:
+                self.catch_up()
+                self.compact(self.shards)
+
+            logger.info(f"Saved index with {self.total_vectors()} vectors and {len(self.doc_store)} documents")
+        except Exception as e:
+            logger.error(f"Error saving index and docs: {str(e)}")
+            raise
+
+    def rebuild_index(self, shard: Shard, index_type: str) -> bool:
+        """Rebuild a shard's index as index_type without its tombstones and swap it in.
+
+        The rebuild works on a copy of the vectors present when it starts, so
+        searches and writes keep using the old index meanwhile; vectors added
+        during the rebuild are caught up under the lock just before the swap,
+        and chunks deleted meanwhile stay tombstones in the new index.
+        """
+        try:
+            source = shard.index
+            if direct_map_missing(source):
+                with self.index_lock.write():
+                    ensure_direct_map(source)
+            with self.index_lock.read():
+                count = source.ntotal
+                ids, vectors = reconstruct_vectors(source, 0, count)
+                dropped = np.fromiter(shard.tombstones, dtype='int64', count=len(shard.tombstones))
+            live = ~np.isin(ids, dropped)
+            vectors = self.recover_vectors(source, ids, vectors)
+            logger.info(
+                f"Rebuilding shard {shard.number} {index_type_of(source)} index as {index_type}: "
+                f"keeping {int(live.sum())} of {count} vectors"
+            )
+            if index_type == index_type_of(source):
+                # Same type: reuse the trained quantizers instead of retraining
+                new_index = empty_copy(source)
+                new_index.add_with_ids(vectors[live], ids[live])
+            else:
+                new_index = build_index(vectors[live], ids[live], index_type)
+
+            with self.writer_lock:
+                # Another process may have rebuilt the shard or resharded the index meanwhile
+                self.catch_up()
+                if (shard.number >= len(self.shards) or self.shards[shard.number] is not shard
+                        or shard.index is not source):
+                    logger.warning(f"Shard {shard.number} changed during rebuild, discarding rebuilt index")
+                    return False
+                if source.ntotal > count:
+                    added_ids, added_vectors = reconstruct_vectors(source, count, source.ntotal - count)
+                    new_index.add_with_ids(self.recover_vectors(source, added_ids, added_vectors), added_ids)
+                with self.index_lock.write():
+                    shard.index = new_index
+                    shard.tombstones.difference_update(dropped.tolist())
+                    shard.dirty = True
+                self.save_index_and_docs()
+            logger.info(f"Shard {shard.number} rebuild complete with {new_index.ntotal} vectors")
+            return True
+        except Exception as e:
+            logger.error(f"Error rebuilding shard {shard.number}: {str(e)}")
+            return False
+
+    def next_rebuild(self) -> Optional[Tuple[Shard, str]]:
+        """The first shard that needs rebuilding, with the type to rebuild it as"""
+        for shard in self.shards:
+            index_type = rebuild_target(shard, self.full_vectors.exists())
+            if index_type is not None:
+                return shard, index_type
+        return None
+
+    def run_rebuilds(self):
+        # Writes that arrive during a rebuild can make another one necessary
+        while not self.closed.is_set():
+            target = self.next_rebuild()
+            if target is None or not self.rebuild_index(*target):
+                return
+
+    def maybe_rebuild_index(self):
+        """Start a background rebuild if one is needed and none is running"""
+        if INDEX_MODE == "reader" or (self.rebuild_thread is not None and self.rebuild_thread.is_alive()):
+            return
+        if self.next_rebuild() is not None:
+            self.rebuild_thread = threading.Thread(target=self.run_rebuilds, name="index-rebuild", daemon=True)
+            self.rebuild_thread.start()
+
+    def rebalance(self, count: int) -> List[int]:
+        """Redistribute the index over count shards and persist the new layout; returns each shard's size.
+
+        Every live chunk is routed afresh and the shards are built from scratch
+        (flat until they are large enough to train INDEX_TYPE), dropping
+        tombstones. Writers in every process wait meanwhile; the new shard
+        files are written before the manifest that makes them current, and other
+        processes switch to them when they next catch up. Searches keep using
+        the old shards until the swap. Compressed shards are rebuilt from the
+        full-precision copies of their vectors where those exist, and from their
+        compressed codes otherwise, as in any rebuild.
+        """
+        ensure_writable()
+        if count < 1:
+            raise ValueError(f"Shard count must be at least 1, got {count}")
+        with self.writer_lock:
+            self.catch_up()
+            old_count = len(self.shards)
+            # IVF indexes need a direct map to give their vectors back
+            with self.index_lock.write():
+                for shard in self.shards:
+                    ensure_direct_map(shard.index)
+            parts = []
+            with self.index_lock.read():
+                for shard in self.shards:
+                    ids, vectors = reconstruct_vectors(shard.index, 0, shard.index.ntotal)
+                    live = ~np.isin(ids, np.fromiter(shard.tombstones, dtype='int64', count=len(shard.tombstones)))
+                    parts.append((shard.index, ids[live], vectors[live]))
+            parts = [(ids, self.recover_vectors(index, ids, vectors)) for index, ids, vectors in parts]
+            ids = np.concatenate([part[0] for part in parts])
+            vectors = np.concatenate([part[1] for part in parts])
+            # Each shard must hold its ids in increasing order
+            order = np.argsort(ids, kind="stable")
+            ids, vectors = ids[order], vectors[order]
+
+            file_names = self.doc_store.file_names_by_id()
+            numbers = np.array([shard_of(int(chunk_id), {"file_name": file_names.get(int(chunk_id))}, count)
+                                for chunk_id in ids], dtype='int64')
+            new_shards = []
+            for number in range(count):
+                mine = numbers == number
+                index_type = INDEX_TYPE if mine.sum() >= min_training_vectors(INDEX_TYPE) else "flat"
+                logger.info(f"Building shard {number} of {count} as {index_type} with {int(mine.sum())} vectors")
+                shard = Shard(number, shard_path(self.data_dir, number, count),
+                              build_index(vectors[mine], ids[mine], index_type))
+                shard.dirty = True
+                new_shards.append(shard)
+
+            self.compact(new_shards)
+            with self.index_lock.write():
+                self.shards = new_shards
+                self.bump_corpus_version()
+            if count != old_count:
+                # Nothing reads the files of the old layout once the manifest has moved on
+                for number in range(old_count):
+                    shard_path(self.data_dir, number, old_count).unlink(missing_ok=True)
+        sizes = [shard.index.ntotal for shard in new_shards]
+        logger.info(f"Rebalanced the {self} from {old_count} to {count} shards: {sizes}")
+        return sizes
+
+    def commit_batch(self, batch: List[Dict[str, Any]]):
+        """Durably add the chunks of a batch of queued adds and assign their ids. Call with writer_lock held."""
+        self.catch_up()
+        texts = [text for add in batch for text in add["texts"]]
+        metadatas = [metadata for add in batch for metadata in add["metadatas"]]
+        vectors = np.vstack([add["vectors"] for add in batch])
+        ids = np.arange(self.next_chunk_id, self.next_chunk_id + len(texts), dtype='int64')
+
+        # Append to the write-ahead log before touching the in-memory state, in a single append
+        self.wal_offset = append_records(self.wal_path, [
+            {"id": int(doc_id), "embedding": vector, "text": text, "metadata": metadata}
+            for doc_id, vector, text, metadata in zip(ids, vectors, texts, metadatas)
+        ])
+        self.wal_records += len(texts)
+        self.next_chunk_id += len(texts)
+        if self.keep_full_vectors:
+            self.full_vectors.write(ids, vectors)
+
+        # Rows go in before vectors, so every vector a search finds has its text
+        self.doc_store.add_many(ids, texts, metadatas)
+        numbers = np.array([shard_of(int(doc_id), metadata, len(self.shards))
+                            for doc_id, metadata in zip(ids, metadatas)])
+        with self.index_lock.write():
+            for shard in self.shards:
+                mine = numbers == shard.number
+                if mine.any():
+                    shard.index.add_with_ids(vectors[mine], ids[mine])
+                    shard.dirty = True
+            self.bump_corpus_version()
+
+        start = 0
+        for add in batch:
+            add["ids"] = ids[start:start + len(add["texts"])].tolist()
+            start += len(add["texts"])
+
+        # Fold the log into a snapshot once it has grown large enough
+        if self.wal_records >= WAL_COMPACT_THRESHOLD:
+            try:
+                self.save_index_and_docs()
+            except Exception:
+                # The adds are already durable in the log; compaction is retried on the next write
+                pass
+
+    def commit_adds(self, texts: List[str], vectors: np.ndarray,
+                    metadatas: List[Optional[Dict[str, Any]]]) -> List[int]:
+        """Add prepared chunks to the collection, committed together with any adds queued alongside; returns their ids"""
+        add = {"texts": texts, "vectors": vectors, "metadatas": metadatas, "ids": None, "error": None}
+        with self.pending_lock:
+            self.pending_adds.append(add)
+        with self.writer_lock:
+            # An earlier writer may already have committed this add with its own
+            if add["ids"] is None and add["error"] is None:
+                with self.pending_lock:
+                    batch = self.pending_adds[:]
+                    self.pending_adds.clear()
+                try:
+                    self.commit_batch(batch)
+                except Exception as e:
+                    for queued in batch:
+                        queued["error"] = e
+        if add["error"] is not None:
+            raise add["error"]
+        return add["ids"]
+
+    def delete_chunks(self, ids) -> int:
+        """Delete chunks by id; returns the number of chunks removed.
+
+        Vectors stay in the index as tombstones, excluded from searches, until
+        enough accumulate for a background rebuild to drop them.
+        """
+        ensure_writable()
+        ids = [int(chunk_id) for chunk_id in ids]
+        if not ids:
+            return 0
+        with self.writer_lock:
+            self.catch_up()
+            self.wal_offset = append_records(self.wal_path, [{"op": "delete", "ids": ids}])
+            self.wal_records += 1
+            # Tombstone the vectors before the rows go, so searches never find a vector without its text
+            with self.index_lock.write():
+                self.add_tombstones(ids)
+                self.bump_corpus_version()
+            deleted = self.doc_store.delete_ids(ids)
+
+            if self.wal_records >= WAL_COMPACT_THRESHOLD:
+                self.save_index_and_docs()
+        self.maybe_rebuild_index()
+        logger.info(f"Deleted {deleted} chunks, {self.total_tombstones()} tombstones awaiting compaction")
+        return deleted
+
+    def delete_file(self, file_name: str) -> int:
+        """Delete every chunk of a file and forget that it was ingested"""
+        with self.writer_lock:
+            self.doc_store.forget_file(file_name)
+            return self.delete_chunks(self.doc_store.ids_for_files([file_name]))
+
+    def replace_file(self, file_name: str, content_hash: str, chunk_count: int) -> Optional[int]:
+        """Delete chunks from earlier versions of a file once all chunk_count chunks of a new version have been added.
+
+        The new chunks are added before the old ones are removed, so searches
+        never see the file missing while it is being re-ingested. Returns the
+        number of chunks replaced, or None if the new version is incomplete:
+        an earlier version then stays searchable and recorded, and the new
+        chunks are removed so the two are not mixed. Without an earlier
+        version the new chunks are kept but not recorded, so the same content
+        is ingested afresh when it arrives again.
+        """
+        with self.writer_lock:
+            added = self.doc_store.ids_for_version(file_name, content_hash)
+            earlier = self.doc_store.ids_for_version(file_name, content_hash, matching=False)
+            if len(added) == 0 or len(added) < chunk_count:
+                if len(earlier):
+                    self.delete_chunks(added)
+                    logger.warning(f"Kept the earlier version of {file_name}; only {len(added)} of "
+                                   f"{chunk_count} chunks of the new one were added")
+                return None
+            replaced = self.delete_chunks(earlier)
+            self.doc_store.record_file(file_name, content_hash, chunk_count)
+        if replaced:
+            logger.info(f"Replaced {replaced} chunks from an earlier version of {file_name}")
+        return replaced
+
+    def get_chunk_vectors(self, ids: List[int]) -> Dict[int, np.ndarray]:
+        """Stored (normalized, for cosine indexes) vectors of the given chunks"""
+        ids = np.unique(np.array(ids, dtype='int64'))
+        while True:
+            with self.index_lock.read():
+                if not any(direct_map_missing(shard.index) for shard in self.shards):
+                    vectors = {}
+                    for shard in self.shards:
+                        vectors.update(reconstruct_ids(shard.index, ids))
+                    break
+            # IVF indexes need a direct map built once, which changes the index
+            with self.index_lock.write():
+                for shard in self.shards:
+                    ensure_direct_map(shard.index)
+        # Compressed indexes only give back approximations of the vectors
+        if INDEX_RERANK and vectors and self.full_vectors.exists():
+            found_ids = np.fromiter(vectors, dtype='int64', count=len(vectors))
+            rows, found = self.full_vectors.rows(found_ids)
+            vectors.update(zip(found_ids[found].tolist(), rows[found]))
+        return vectors
+
+    def vector_scores(self, query_embedding: List[float], ids: List[int]) -> Dict[int, float]:
+        """Similarity of the query to each of the given chunks, on the scale of vector search scores"""
+        vectors = self.get_chunk_vectors(ids)
+        if not vectors:
+            return {}
+        with self.index_lock.read():
+            index = self.shards[0].index
+        query = prepare_vectors([query_embedding], metric_of(index))[0]
+        found = list(vectors)
+        matrix = np.stack([vectors[chunk_id] for chunk_id in found])
+        if metric_of(index) == "cosine":
+            distances = matrix @ query
         else:
-            logger.info("Index or document store files not found, creating new ones")
-        
-        # Create new index and document store
-        index = faiss.IndexFlatL2(768)
-        doc_store = []
-        logger.info("Created new empty index and document store")
-        return index, doc_store
-        
-    except Exception as e:
-        logger.error(f"Unexpected error in load_or_create_index: {str(e)}")
-        # If there's an error, create a new index
-        index = faiss.IndexFlatL2(768)
-        doc_store = []
-        return index, doc_store
+            distances = ((matrix - query) ** 2).sum(axis=1)
+        return dict(zip(found, similarities(index, distances).tolist()))
 
-# Load or create index and document store
-index, doc_store = load_or_create_index()
+    def vector_search_batch(self, query_embeddings: List[List[float]], top_k: int, similarity_threshold: float,
+                            nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                            file_names: Optional[List[str]] = None) -> List[List[Tuple[int, float]]]:
+        """vector_search for many queries at once, one hit list per query.
 
-def save_index_and_docs():
-    """Save the current index and document store to disk"""
-    try:
-        logger.info("Saving index and document store to disk")
-        # Ensure directory exists
-        data_dir.mkdir(exist_ok=True, parents=True)
-        
-        # Save index
-        faiss.write_index(index, str(index_path))
-        
-        # Save document store
-        with open(doc_store_path, 'wb') as f:
-            pickle.dump(doc_store, f)
-            
-        logger.info(f"Saved index with {index.ntotal} vectors and {len(doc_store)} documents")
-    except Exception as e:
-        logger.error(f"Error saving index and docs: {str(e)}")
-        raise
+        The queries go to FAISS as one matrix, which it splits across its
+        threads, instead of one search call per query. Each shard answers the
+        matrix with a single top_k kNN search, so its results take queries x
+        top_k entries however large the corpus is. With several shards the
+        matrix goes to each shard in parallel and their hits are merged.
+        """
+        # Restrict the search to the requested files; deleted chunks have no rows,
+        # so tombstones only need excluding explicitly for unfiltered searches.
+        if file_names:
+            allowed_ids = self.doc_store.ids_for_files(file_names)
+            if len(allowed_ids) == 0:
+                logger.info("No documents found for files: %s", file_names)
+                return [[] for _ in query_embeddings]
+
+        # Searches run concurrently with each other, but never with an update to the index
+        with self.index_lock.read():
+            # A file's chunks all live in one shard, so a filtered search skips the others
+            targets = ([self.shards[number] for number in shards_for_files(file_names, len(self.shards))]
+                       if file_names else self.shards)
+            query_vectors = prepare_vectors(query_embeddings, metric_of(targets[0].index))
+            search = partial(search_shard, query_vectors=query_vectors, top_k=top_k,
+                             similarity_threshold=similarity_threshold, nprobe=nprobe, ef_search=ef_search,
+                             allowed_ids=allowed_ids if file_names else None,
+                             full_vectors=self.full_vectors if INDEX_RERANK else None)
+            if len(targets) == 1:
+                return search(targets[0])
+            # The shard threads search under this thread's read lock; they must not take it themselves
+            per_shard = list(shard_executor.map(search, targets))
+            return [merge_hits(query_hits, top_k) for query_hits in zip(*per_shard)]
+
+
+# Used by requests that name no collection; lives in DATA_DIR itself and is never unloaded
+default_collection = Collection(None, data_dir)
+# Named collections in memory, least recently used first
+loaded_collections: "OrderedDict[str, Collection]" = OrderedDict()
+collections_lock = threading.Lock()
+
+load_thread = None
+load_lock = threading.Lock()
+
+def check_collection_name(name: str):
+    """Raise ValueError unless name is usable as a collection name"""
+    if not COLLECTION_NAME_RE.match(name):
+        raise ValueError(f"Invalid collection name {name!r}: use up to 64 letters, digits, '.', '_' or '-'")
+
+def collection_exists(name: str) -> bool:
+    """Whether a named collection has been written to (or, for readers, published)"""
+    if INDEX_MODE == "reader":
+        return current_generation(collections_dir / name / "generations") is not None
+    return (collections_dir / name).is_dir()
+
+def get_collection(name: Optional[str] = None, create: bool = False) -> Optional[Collection]:
+    """The collection of that name (the default one for None), loading a named one on first use.
+
+    A named collection that does not exist yet is created if create is set;
+    otherwise None is returned, so reads never create collections.
+    """
+    if name is None:
+        return default_collection
+    check_collection_name(name)
+    with collections_lock:
+        collection = loaded_collections.get(name)
+        if collection is None:
+            if not create and not collection_exists(name):
+                return None
+            collection = Collection(name, collections_dir / name)
+            loaded_collections[name] = collection
+        loaded_collections.move_to_end(name)
+    collection.load_store()
+    evict_collections()
+    return collection
+
+def evict_collections():
+    """Unload the least recently used collections until the loaded ones fit in COLLECTION_MEMORY_BUDGET_MB.
+
+    The most recently used collection stays loaded even if it alone is over
+    the budget. An unloaded collection's files stay on disk, and requests
+    still using it finish against the copy they hold.
+    """
+    budget = COLLECTION_MEMORY_BUDGET_MB * 2 ** 20
+    evicted = []
+    with collections_lock:
+        sizes = {name: collection.memory_bytes() for name, collection in loaded_collections.items()}
+        total = sum(sizes.values())
+        for name in list(loaded_collections)[:-1]:
+            if total <= budget:
+                break
+            # One that is still loading holds nothing yet
+            if not loaded_collections[name].store_ready.is_set():
+                continue
+            evicted.append(loaded_collections.pop(name))
+            total -= sizes[name]
+    for collection in evicted:
+        collection.close()
+        COLLECTION_EVICTIONS.inc()
+        logger.info(f"Unloaded the {collection} to stay within the {COLLECTION_MEMORY_BUDGET_MB:g}MB collection budget")
+
+def all_collections() -> List[Collection]:
+    """The default collection and every loaded named one"""
+    with collections_lock:
+        return [default_collection, *loaded_collections.values()]
+
+def load_store():
+    """Load the default collection. Safe to call more than once; named collections load when first used."""
+    default_collection.load_store()
+
+def start_loading(on_ready=None) -> threading.Thread:
+    """Load the store in a background thread, then call on_ready; returns the thread"""
+    global load_thread
+
+    def run():
+        try:
+            load_store()
+        except Exception:
+            return
+        if on_ready is not None:
+            on_ready()
+
+    with load_lock:
+        if load_thread is None:
+            load_thread = threading.Thread(target=run, name="store-load", daemon=True)
+            load_thread.start()
+        return load_thread
+
+def is_ready() -> bool:
+    return default_collection.store_ready.is_set()
+
+def store_status() -> Dict[str, Any]:
+    """Readiness details for health endpoints"""
+    if default_collection.store_ready.is_set():
+        return {
+            "status": "ready",
+            "mode": INDEX_MODE,
+            "vectors": default_collection.total_vectors(),
+            "shards": [shard.index.ntotal for shard in default_collection.shards],
+            "generation": default_collection.generation,
+            # Vectors of each named collection currently in memory
+            "collections": {
+                collection.name: collection.total_vectors()
+                for collection in all_collections()[1:] if collection.store_ready.is_set()
+            },
+        }
+    if default_collection.load_error is not None:
+        return {"status": "failed", "error": default_collection.load_error}
+    return {"status": "loading"}
+
+# Read at scrape time, so they follow index swaps and collection loads without touching the write path
+INDEX_VECTORS.set_function(lambda: sum(collection.total_vectors() for collection in all_collections()))
+INDEX_TOMBSTONES.set_function(lambda: sum(collection.total_tombstones() for collection in all_collections()))
+COLLECTIONS_LOADED.set_function(lambda: len(loaded_collections))
+COLLECTIONS_MEMORY_BYTES.set_function(lambda: sum(collection.memory_bytes() for collection in all_collections()[1:]))
 
-def add_document(text: str, embedding: List[float] = None):
-    """Add a document to the vector store"""
+def rebalance(count: int, collection: Optional[str] = None) -> List[int]:
+    """Redistribute a collection's index over count shards; returns each shard's size"""
+    store = get_collection(collection)
+    if store is None:
+        raise ValueError(f"Collection {collection!r} does not exist")
+    return store.rebalance(count)
+
+def add_document(text: str, embedding: List[float] = None, metadata: Optional[Dict[str, Any]] = None,
+                 collection: Optional[str] = None):
+    """Add a document and its optional metadata (file_name, page_start, ...) to a collection, creating it if needed"""
     try:
-        logger.info(f"Adding document to vector store, text length: {len(text)}")
-        logger.info(f"Current index size before adding: {index.ntotal} vectors")
-        logger.info(f"Current document store size before adding: {len(doc_store)} documents")
-        
+        ensure_writable()
+        logger.debug("Adding document to vector store, text length: %d", len(text))
+
         # If embedding is not provided, get it
         if embedding is None:
             embedding = get_embedding(text)
             if embedding is None:
                 logger.error("Failed to get embedding for document")
                 return False
-            logger.info(f"Generated embedding of length: {len(embedding)}")
-
-        # Add to FAISS index
-        index.add(np.array([embedding]))
-        
-        # Add to document store
-        doc_store.append(text)
-        
-        # Save to disk
-        save_index_and_docs()
-        
-        logger.info(f"Successfully added document to vector store")
-        logger.info(f"New index size: {index.ntotal} vectors")
-        logger.info(f"New document store size: {len(doc_store)} documents")
-        logger.info(f"Document preview: {text[:200]}...")
+            logger.debug("Generated embedding of length: %d", len(embedding))
+
+        store = get_collection(collection, create=True)
+        (doc_id,) = store.commit_adds([text], prepare_vectors([embedding]), [metadata])
+        store.maybe_rebuild_index()
+
+        logger.info("Added document %d to the %s, index size: %d vectors", doc_id, store, store.total_vectors())
+        if logger.isEnabledFor(logging.DEBUG) and sampled():
+            logger.debug("Document %d preview: %.200s...", doc_id, text)
         return True
     except Exception as e:
         logger.error(f"Error adding document to vector store: {str(e)}")
         return False
 
-def search_similar(query: str, top_k: int = 5, similarity_threshold: float = 0.05) -> List[Dict[str, Any]]:
-    """Search for similar documents"""
+def add_documents(texts: List[str], embeddings: List[List[float]],
+                  metadatas: Optional[List[Optional[Dict[str, Any]]]] = None,
+                  collection: Optional[str] = None) -> int:
+    """Add a batch of pre-embedded documents to a collection with a single index update"""
     try:
-        logger.info(f"Searching for similar documents to query: {query[:100]}...")
-        logger.info(f"Using similarity threshold: {similarity_threshold}")
-        logger.info(f"Current index size: {index.ntotal} vectors")
-        logger.info(f"Current document store size: {len(doc_store)} documents")
-        
-        if index.ntotal == 0:
+        ensure_writable()
+        metadatas = metadatas or [None] * len(texts)
+        if not len(texts) == len(embeddings) == len(metadatas):
+            raise ValueError("Number of texts, embeddings and metadatas must match")
+        if not texts:
+            return 0
+
+        logger.debug("Adding %d documents to vector store", len(texts))
+
+        store = get_collection(collection, create=True)
+        store.commit_adds(texts, prepare_vectors(embeddings), metadatas)
+        store.maybe_rebuild_index()
+
+        logger.info("Added %d documents to the %s, index size: %d vectors", len(texts), store, store.total_vectors())
+        return len(texts)
+    except Exception as e:
+        logger.error(f"Error adding documents to vector store: {str(e)}")
+        return 0
+
+def delete_file(file_name: str, collection: Optional[str] = None) -> int:
+    """Delete every chunk of a file and forget that it was ingested"""
+    store = get_collection(collection)
+    return store.delete_file(file_name) if store is not None else 0
+
+def get_file_hash(file_name: str, collection: Optional[str] = None) -> Optional[str]:
+    """Content hash of the last complete ingestion of a file, if any"""
+    store = get_collection(collection)
+    return store.doc_store.file_hash(file_name) if store is not None else None
+
+def discard_partial_file(file_name: str, content_hash: str, collection: Optional[str] = None) -> int:
+    """Delete chunks left behind by an unfinished ingestion of this exact file content"""
+    store = get_collection(collection)
+    if store is None:
+        return 0
+    return store.delete_chunks(store.doc_store.ids_for_version(file_name, content_hash))
+
+def replace_file(file_name: str, content_hash: str, chunk_count: int,
+                 collection: Optional[str] = None) -> Optional[int]:
+    """Delete chunks from earlier versions of a file once a new version has been ingested in full;
+    None if it was not, in which case an earlier version is kept"""
+    return get_collection(collection, create=True).replace_file(file_name, content_hash, chunk_count)
+
+def get_chunk_vectors(ids: List[int], collection: Optional[str] = None) -> Dict[int, np.ndarray]:
+    """Stored (normalized, for cosine indexes) vectors of the given chunks of a collection"""
+    store = get_collection(collection)
+    return store.get_chunk_vectors(ids) if store is not None else {}
+
+def get_corpus_version(collection: Optional[str] = None) -> int:
+    """Current corpus version of a collection; changes whenever its documents are added or deleted"""
+    store = get_collection(collection)
+    return store.corpus_version if store is not None else 0
+
+def record_latency(leg: str, seconds: float):
+    observe_stage(f"{leg}_search", seconds)
+    with search_stats_lock:
+        stats = search_stats.setdefault(leg, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+        stats["count"] += 1
+        stats["total_ms"] += seconds * 1000
+        stats["max_ms"] = max(stats["max_ms"], seconds * 1000)
+
+def get_search_stats() -> Dict[str, Any]:
+    """Latency of each retrieval leg since startup"""
+    with search_stats_lock:
+        return {
+            leg: {
+                "count": stats["count"],
+                "avg_ms": stats["total_ms"] / stats["count"],
+                "max_ms": stats["max_ms"],
+            }
+            for leg, stats in search_stats.items()
+        }
+
+def vector_search(query_embedding: List[float], top_k: int, similarity_threshold: float,
+                  nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                  file_names: Optional[List[str]] = None,
+                  collection: Optional[str] = None) -> List[Tuple[int, float]]:
+    """(chunk id, similarity) of the top_k nearest vectors that score at least similarity_threshold, best first"""
+    store = get_collection(collection)
+    if store is None:
+        return []
+    accepted = store.vector_search_batch([query_embedding], top_k, similarity_threshold, nprobe, ef_search,
+                                         file_names)[0]
+    # Per-hit detail is only worth its cost for a sample of debug-level searches
+    if logger.isEnabledFor(logging.DEBUG) and sampled():
+        for rank, (idx, similarity_score) in enumerate(accepted, 1):
+            logger.debug("Vector hit %d: document %d, similarity %.6f", rank, idx, similarity_score)
+    return accepted
+
+def timed_keyword_search(doc_store: DocStore, query: str, limit: int,
+                         file_names: Optional[List[str]]) -> Tuple[List[Tuple[int, float]], float]:
+    """Keyword leg of a hybrid search: BM25 hits and the seconds they took"""
+    start = time.perf_counter()
+    hits = doc_store.keyword_search(query, limit, file_names)
+    seconds = time.perf_counter() - start
+    record_latency("keyword", seconds)
+    return hits, seconds
+
+def gate_keyword_hits(store: Collection, query_embedding: Optional[List[float]],
+                      vector_hits: List[Tuple[int, float]], keyword_hits: List[Tuple[int, float]],
+                      similarity_threshold: float) -> List[Tuple[int, float]]:
+    """Keyword hits whose vectors also score at least similarity_threshold against the query.
+
+    Hits the vector leg already accepted pass as they are; the rest are scored
+    from their stored vectors, so a chunk that only shares a word with the
+    query is not fused in. Without a query embedding there is nothing to
+    score against and every keyword hit passes.
+    """
+    if query_embedding is None or not keyword_hits:
+        return keyword_hits
+    accepted = dict(vector_hits)
+    scores = store.vector_scores(query_embedding, [idx for idx, _ in keyword_hits if idx not in accepted])
+    return [(idx, score) for idx, score in keyword_hits
+            if idx in accepted or scores.get(idx, float("-inf")) >= similarity_threshold]
+
+def reciprocal_rank_fusion(rankings: List[List[int]], k: int = RRF_K) -> Dict[int, float]:
+    """Fuse ranked id lists: each id scores the sum of 1 / (k + rank) over the lists it appears in"""
+    fused = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, 1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return fused
+
+def rank_hits(vector_hits: List[Tuple[int, float]], keyword_hits: Optional[List[Tuple[int, float]]],
+              top_k: int) -> List[Tuple[int, float]]:
+    """The top_k (id, score) of a search, fusing the keyword ranking in when there is one"""
+    if keyword_hits is None:
+        return vector_hits[:top_k]
+    fused = reciprocal_rank_fusion([[idx for idx, _ in vector_hits], [idx for idx, _ in keyword_hits]])
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+def build_results(ranked: List[Tuple[int, float]], documents: Dict[int, Dict[str, Any]],
+                  vector_hits: List[Tuple[int, float]],
+                  keyword_hits: Optional[List[Tuple[int, float]]]) -> List[Dict[str, Any]]:
+    """Search results for ranked hits, with their text and metadata from documents"""
+    vector_scores = dict(vector_hits)
+    keyword_scores = dict(keyword_hits or [])
+    results = []
+    detail = logger.isEnabledFor(logging.DEBUG) and sampled()
+    for rank, (idx, score) in enumerate(ranked, 1):
+        if idx not in documents:
+            logger.warning("Invalid index %d found in search results", idx)
+            continue
+        if detail:
+            logger.debug("Document %d preview: %.200s...", idx, documents[idx]["text"])
+        result = {
+            "id": idx,
+            **documents[idx],
+            "score": score,
+            "rank": rank
+        }
+        if keyword_hits is not None:
+            result["vector_score"] = vector_scores.get(idx)
+            result["keyword_score"] = keyword_scores.get(idx)
+        results.append(result)
+    return results
+
+def search_similar(query: str, top_k: int = 5, similarity_threshold: float = 0.05,
+                   nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                   query_embedding: Optional[List[float]] = None,
+                   file_names: Optional[List[str]] = None,
+                   collection: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Search for similar documents.
+
+    nprobe (IVF indexes) and ef_search (HNSW indexes) override the configured
+    defaults for this request, trading recall for latency. Pass
+    query_embedding if the caller has already embedded the query.
+    file_names restricts the search to chunks from those files; the filter
+    is applied inside FAISS so top_k is not wasted on other files.
+    collection searches a named collection instead of the default one; one
+    that does not exist has no results.
+
+    With HYBRID_SEARCH_ENABLED, a BM25 keyword search runs alongside the
+    vector search and the two rankings are fused with reciprocal-rank
+    fusion, so exact identifiers and names are found even when their
+    embeddings are not close to the query's. similarity_threshold applies
+    to both legs: a keyword hit is only fused in if its vector also scores
+    at least that much. score is then the fused score, with vector_score
+    and keyword_score (None if that leg missed) alongside.
+    """
+    try:
+        logger.debug("Searching for similar documents to query: %.100s...", query)
+
+        store = get_collection(collection)
+        if store is None or store.total_vectors() == 0:
             logger.warning("No documents in the index")
             return []
 
-        # Get embedding for the query
-        query_embedding = get_embedding(query)
-        if query_embedding is None:
-            logger.error("Failed to get embedding for query")
-            return []
+        # The keyword leg only needs the query text, so start it before embedding
+        candidates = max(top_k, HYBRID_CANDIDATES) if HYBRID_SEARCH_ENABLED else top_k
+        keyword_future = None
+        if HYBRID_SEARCH_ENABLED:
+            # Run in a copy of this context so the keyword leg logs under the request's id
+            keyword_future = keyword_executor.submit(contextvars.copy_context().run, timed_keyword_search,
+                                                     store.doc_store, query, candidates, file_names)
 
-        # Search in FAISS index
-        distances, indices = index.search(np.array([query_embedding]), top_k)
-        
-        # Get the corresponding documents
-        results = []
-        logger.info("=== Detailed Search Results ===")
-        for i, (distance, idx) in enumerate(zip(distances[0], indices[0])):
-            if idx < len(doc_store):  # Ensure index is valid
-                similarity_score = float(1 / (1 + distance))  # Convert distance to similarity score
-                logger.info(f"\nResult {i+1}:")
-                logger.info(f"  Distance: {distance:.6f}")
-                logger.info(f"  Similarity Score: {similarity_score:.6f}")
-                logger.info(f"  Threshold: {similarity_threshold:.6f}")
-                logger.info(f"  Document Index: {idx}")
-                logger.info(f"  Document Preview: {doc_store[idx][:200]}...")
-                
-                if similarity_score >= similarity_threshold:
-                    results.append({
-                        "text": doc_store[idx],
-                        "score": similarity_score,
-                        "rank": i + 1
-                    })
-                    logger.info(f"  ✓ Match accepted (score >= threshold)")
-                else:
-                    logger.info(f"  ✗ Match rejected (score < threshold)")
+        try:
+            vector_start = time.perf_counter()
+            # Get embedding for the query
+            if query_embedding is None:
+                query_embedding = get_embedding(query)
+            if query_embedding is None:
+                logger.error("Failed to get embedding for query")
+                vector_hits = []
             else:
-                logger.warning(f"Invalid index {idx} found in search results")
+                vector_hits = vector_search(query_embedding, candidates, similarity_threshold,
+                                            nprobe, ef_search, file_names, collection)
+            vector_seconds = time.perf_counter() - vector_start
+            record_latency("vector", vector_seconds)
+        except BaseException:
+            if keyword_future is not None:
+                keyword_future.cancel()
+            raise
+
+        keyword_hits = None
+        if keyword_future is not None:
+            keyword_hits, keyword_seconds = keyword_future.result()
+            keyword_hits = gate_keyword_hits(store, query_embedding, vector_hits, keyword_hits,
+                                             similarity_threshold)
+            logger.debug(
+                "Hybrid search: %d vector hits in %.1fms, %d keyword hits in %.1fms, %d in both",
+                len(vector_hits), vector_seconds * 1000, len(keyword_hits), keyword_seconds * 1000,
+                len(dict(vector_hits).keys() & dict(keyword_hits).keys())
+            )
+        ranked = rank_hits(vector_hits, keyword_hits, top_k)
+
+        # Get the corresponding documents
+        documents = store.doc_store.get_many([idx for idx, _ in ranked])
+        results = build_results(ranked, documents, vector_hits, keyword_hits)
 
-        logger.info(f"\nSearch Summary:")
-        logger.info(f"Total results found: {len(results)}")
-        logger.info(f"Results above threshold: {len(results)}")
-        logger.info(f"Results below threshold: {top_k - len(results)}")
+        logger.info(
+            "Search returned %d of top %d results (threshold %s)",
+            len(results), top_k, similarity_threshold,
+            extra={"results": len(results), "top_k": top_k}
+        )
         return results
     except Exception as e:
         logger.error(f"Error searching for similar documents: {str(e)}")
         return []
+
+def search_similar_batch(queries: List[str], top_k: int = 5, similarity_threshold: float = 0.05,
+                         nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                         query_embeddings: Optional[List[Optional[List[float]]]] = None,
+                         file_names: Optional[List[str]] = None,
+                         collection: Optional[str] = None) -> List[List[Dict[str, Any]]]:
+    """search_similar for many queries at once, one result list per query, in order.
+
+    The queries are embedded in batches and searched as one matrix, and the
+    documents for every hit are fetched in one go. With
+    HYBRID_SEARCH_ENABLED the keyword legs run on the keyword search
+    threads meanwhile. A query that cannot be embedded gets only keyword hits.
+    """
+    try:
+        if not queries:
+            return []
+        store = get_collection(collection)
+        if store is None or store.total_vectors() == 0:
+            logger.warning("No documents in the index")
+            return [[] for _ in queries]
+
+        candidates = max(top_k, HYBRID_CANDIDATES) if HYBRID_SEARCH_ENABLED else top_k
+        keyword_futures = []
+        if HYBRID_SEARCH_ENABLED:
+            keyword_futures = [
+                keyword_executor.submit(contextvars.copy_context().run, timed_keyword_search,
+                                        store.doc_store, query, candidates, file_names)
+                for query in queries
+            ]
+
+        try:
+            vector_start = time.perf_counter()
+            if query_embeddings is None:
+                query_embeddings = get_embeddings(queries)
+            embedded = [i for i, embedding in enumerate(query_embeddings) if embedding is not None]
+            if len(embedded) < len(queries):
+                logger.error("Failed to get embeddings for %d of %d queries", len(queries) - len(embedded), len(queries))
+            vector_hits = [[] for _ in queries]
+            if embedded:
+                found = store.vector_search_batch([query_embeddings[i] for i in embedded], candidates,
+                                                  similarity_threshold, nprobe, ef_search, file_names)
+                for i, hits in zip(embedded, found):
+                    vector_hits[i] = hits
+            record_latency("vector_batch", time.perf_counter() - vector_start)
+        except BaseException:
+            for future in keyword_futures:
+                future.cancel()
+            raise
+
+        keyword_hits = [
+            gate_keyword_hits(store, embedding, vector, future.result()[0], similarity_threshold)
+            for future, embedding, vector in zip(keyword_futures, query_embeddings, vector_hits)
+        ] or [None] * len(queries)
+        ranked = [rank_hits(vector, keyword, top_k) for vector, keyword in zip(vector_hits, keyword_hits)]
+        documents = store.doc_store.get_many({idx for hits in ranked for idx, _ in hits})
+        batch_results = [
+            build_results(hits, documents, vector, keyword)
+            for hits, vector, keyword in zip(ranked, vector_hits, keyword_hits)
+        ]
+
+        logger.info(
+            "Batch search of %d queries returned %d results (top %d, threshold %s)",
+            len(queries), sum(len(results) for results in batch_results), top_k, similarity_threshold,
+            extra={"queries": len(queries), "top_k": top_k}
+        )
+        return batch_results
+    except Exception as e:
+        logger.error(f"Error in batch search: {str(e)}")
+        return [[] for _ in queries]
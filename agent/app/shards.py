@@ -0,0 +1,93 @@
+import hashlib
+import json
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from app.persistence import atomic_write
+
+# Records the shard count of the index files on disk. It is rewritten by
+# every compaction, so other processes can tell the log was truncated.
+MANIFEST_FILE = "shards.json"
+
+
+class Shard:
+    """One partition of the vector index, with the state kept alongside it.
+
+    tombstones holds the ids of deleted chunks whose vectors are still in
+    this shard's index. dirty is set while the index holds vectors its
+    snapshot file does not, and file_id identifies the snapshot file the
+    index was loaded from or last written to.
+    """
+
+    def __init__(self, number: int, path: Optional[Path], index, tombstones: Optional[set] = None,
+                 file_id: Optional[Tuple[int, int, int]] = None):
+        self.number = number
+        self.path = path
+        self.index = index
+        self.tombstones = set() if tombstones is None else tombstones
+        self.dirty = False
+        self.file_id = file_id
+        # Selector excluding tombstones, with the index and tombstone count it was built for
+        self.selector_cache = None
+
+
+def shard_path(data_dir: Path, number: int, count: int) -> Path:
+    """Snapshot file of one shard.
+
+    A single shard keeps the historical faiss_index.bin. Every shard count
+    has its own file names, so a rebalance never overwrites the files of the
+    layout it is replacing.
+    """
+    if count == 1:
+        return data_dir / "faiss_index.bin"
+    return data_dir / f"faiss_index.{number}-of-{count}.bin"
+
+
+def shard_of(chunk_id: int, metadata: Optional[Dict[str, Any]], count: int) -> int:
+    """Shard a chunk belongs to: all chunks of a file share one, chunks without a file are spread by id"""
+    if count == 1:
+        return 0
+    file_name = (metadata or {}).get("file_name")
+    key = f"file:{file_name}" if file_name else f"id:{chunk_id}"
+    # CRC32's low bits barely differ between similar names, so use a real hash
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % count
+
+
+def shards_for_files(file_names: Iterable[str], count: int) -> List[int]:
+    """The shards that can hold chunks of the given files"""
+    return sorted({shard_of(0, {"file_name": file_name}, count) for file_name in file_names})
+
+
+def file_identity(path: Path) -> Optional[Tuple[int, int, int]]:
+    """Identifies a file's current contents; it changes whenever the file is replaced"""
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def read_manifest(data_dir: Path) -> Optional[Dict[str, Any]]:
+    try:
+        return json.loads((data_dir / MANIFEST_FILE).read_text())
+    except FileNotFoundError:
+        return None
+
+
+def manifest_snapshot(data_dir: Path, count: int) -> Tuple[Path, Callable[[str], None]]:
+    """Path and write function of a manifest for count shards, for persistence.write_snapshot"""
+    manifest = {"count": count, "written_at": datetime.now().isoformat()}
+    return data_dir / MANIFEST_FILE, lambda path: Path(path).write_text(json.dumps(manifest))
+
+
+def write_manifest(data_dir: Path, count: int):
+    atomic_write(*manifest_snapshot(data_dir, count))
+
+
+def merge_hits(hit_lists: Iterable[List[Tuple[int, float]]], top_k: int) -> List[Tuple[int, float]]:
+    """The top_k best (id, score) hits out of several shards' hit lists"""
+    merged = [hit for hits in hit_lists for hit in hits]
+    merged.sort(key=lambda hit: hit[1], reverse=True)
+    return merged[:top_k]
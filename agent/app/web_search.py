@@ -1,18 +1,25 @@
-from app.config import GEMINI_API_KEY
-import google.generativeai as genai
+from app.config import GEMINI_API_KEY, FAKE_BACKENDS
+from functools import lru_cache
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel("gemini-2.0-flash")
+@lru_cache(maxsize=None)
+def get_model():
+    """The web search chat model, created on first use"""
+    if FAKE_BACKENDS:
+        from app.fake_backends import FakeGenerativeModel
+        return FakeGenerativeModel("gemini-2.0-flash")
+    import google.generativeai as genai
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai.GenerativeModel("gemini-2.0-flash")
 
 def fetch_web_search_context(query: str) -> str:
     try:
         logger.info(f"Starting web search for query: {query}")
-        chat = model.start_chat(history=[])
+        chat = get_model().start_chat(history=[])
         response = chat.send_message(f"Search the web for this query and summarize key points:\n\n{query}")
         logger.info("Web search completed successfully")
         return response.text
@@ -0,0 +1,151 @@
+"""Deterministic synthetic data for the benchmarks: chunk texts, clustered
+embedding vectors, queries with exact nearest neighbours, and PDFs."""
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+# Distinct words in the synthetic vocabulary, drawn with a Zipf-like skew
+VOCABULARY_SIZE = 20000
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "pe", "da", "gu", "fe", "zo", "ha", "ji", "wa"]
+
+# Clusters the synthetic vectors are drawn around; queries come from the same
+# mixture, so every query has genuine near neighbours as real ones do
+CLUSTERS = 256
+# Spread of vectors around their cluster centre (cosine to the centre is about 0.8)
+CLUSTER_NOISE = 0.75
+
+
+@lru_cache(maxsize=None)
+def vocabulary() -> np.ndarray:
+    """The same shuffled word list on every run"""
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(2, 5, size=VOCABULARY_SIZE)
+    syllables = rng.integers(0, len(SYLLABLES), size=(VOCABULARY_SIZE, 4))
+    words = {"".join(SYLLABLES[s] for s in row[:length]) for row, length in zip(syllables, lengths)}
+    return rng.permutation(sorted(words))
+
+
+class TextGenerator:
+    """Sentences of synthetic words; frequent words dominate, as in real text"""
+
+    def __init__(self, seed: int = 0):
+        self.words = vocabulary()
+        self.rng = np.random.default_rng(seed)
+        ranks = np.arange(1, len(self.words) + 1)
+        self.weights = 1.0 / ranks
+        self.weights /= self.weights.sum()
+
+    def text(self, word_count: int) -> str:
+        words = self.rng.choice(self.words, size=word_count, p=self.weights)
+        # Sentences of 8 to 20 words
+        sentences = []
+        position = 0
+        while position < word_count:
+            length = int(self.rng.integers(8, 21))
+            sentence = " ".join(words[position:position + length])
+            sentences.append(sentence[0].upper() + sentence[1:] + ".")
+            position += length
+        return " ".join(sentences)
+
+    def texts(self, count: int, word_count: int) -> List[str]:
+        return [self.text(word_count) for _ in range(count)]
+
+
+class VectorGenerator:
+    """Unit vectors drawn from a fixed mixture of clusters"""
+
+    def __init__(self, dim: int, seed: int = 0):
+        self.dim = dim
+        # Shared by every seed, so queries and corpus come from the same mixture
+        self.centres = np.random.default_rng(10 ** 6).standard_normal((CLUSTERS, dim)).astype('float32')
+        self.rng = np.random.default_rng(seed)
+
+    def vectors(self, count: int) -> np.ndarray:
+        clusters = self.rng.integers(0, CLUSTERS, size=count)
+        vectors = self.centres[clusters] + CLUSTER_NOISE * self.rng.standard_normal((count, self.dim)).astype('float32')
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors
+
+
+def corpus_batches(size: int, dim: int, batch_size: int, seed: int = 0,
+                   words_per_chunk: int = 60) -> Iterator[Tuple[List[str], np.ndarray]]:
+    """Chunk texts and their vectors, batch_size at a time"""
+    texts = TextGenerator(seed)
+    vectors = VectorGenerator(dim, seed)
+    for start in range(0, size, batch_size):
+        count = min(batch_size, size - start)
+        yield texts.texts(count, words_per_chunk), vectors.vectors(count)
+
+
+class ExactNeighbours:
+    """Running exact top-k (by cosine) of a fixed query set over a corpus seen in batches"""
+
+    def __init__(self, queries: np.ndarray, k: int, threshold: float):
+        self.queries = queries
+        self.k = k
+        self.threshold = threshold
+        self.scores = np.full((len(queries), 0), -np.inf, dtype='float32')
+        self.ids = np.zeros((len(queries), 0), dtype='int64')
+
+    def add(self, ids: np.ndarray, vectors: np.ndarray):
+        scores = self.queries @ vectors.T
+        scores[scores < self.threshold] = -np.inf
+        all_scores = np.concatenate([self.scores, scores], axis=1)
+        all_ids = np.concatenate([self.ids, np.broadcast_to(ids, scores.shape)], axis=1)
+        keep = np.argsort(-all_scores, axis=1, kind="stable")[:, :self.k]
+        self.scores = np.take_along_axis(all_scores, keep, axis=1)
+        self.ids = np.take_along_axis(all_ids, keep, axis=1)
+
+    def recall(self, results: List[List[int]]) -> float:
+        """Fraction of the true neighbours found, over all queries"""
+        found = 0
+        expected = 0
+        for true_ids, true_scores, result in zip(self.ids, self.scores, results):
+            truth = set(true_ids[np.isfinite(true_scores)].tolist())
+            expected += len(truth)
+            found += len(truth & set(result))
+        return found / expected if expected else 1.0
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path: Path, pages: int, seed: int = 0, lines_per_page: int = 50, words_per_line: int = 12):
+    """Write a text-only PDF of synthetic paragraphs that PyPDF2 can extract"""
+    generator = TextGenerator(seed)
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # page tree, filled in once the page objects are numbered
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_refs = []
+    for _ in range(pages):
+        words = generator.text(lines_per_page * words_per_line).split()
+        lines = []
+        for start in range(0, len(words), words_per_line):
+            lines.append(f"({_pdf_escape(' '.join(words[start:start + words_per_line]))}) Tj T*")
+            # A blank line every ten lines starts a new paragraph
+            if (start // words_per_line) % 10 == 9:
+                lines.append("T*")
+        stream = ("BT /F1 10 Tf 14 TL 50 800 Td\n" + "\n".join(lines) + "\nET").encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(None)
+        page_refs.append(len(objects))
+        objects[-1] = (b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (len(objects) - 1))
+    kids = b" ".join(b"%d 0 R" % ref for ref in page_refs)
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, pages)
+
+    body = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(body))
+        body += b"%d 0 obj\n%s\nendobj\n" % (number, obj)
+    xref = len(body)
+    body += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    body += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    body += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    path.write_bytes(bytes(body))
@@ -0,0 +1,253 @@
+"""Offline benchmarks for ingestion, retrieval and /ask.
+
+Gemini and OpenAI are replaced by the deterministic local stand-ins in
+app/fake_backends.py (FAKE_BACKENDS=true), so no API keys or network access
+are needed and runs are comparable. Each scenario and corpus size runs in its
+own process against a throwaway DATA_DIR.
+
+Run from the agent directory:
+
+    python -m benchmarks.run --scenarios search,memory --sizes 10k,100k,1m
+    python -m benchmarks.run --scenarios quantization --sizes 100k --index-types flat,flat_sq8,ivf_pq
+    python -m benchmarks.run --compare benchmarks/results/<earlier run>.json
+
+Latency of the stand-ins is set with --embed-latency-ms, --llm-first-token-ms
+and --llm-token-ms; any other app setting is passed with --env NAME=VALUE
+(e.g. --env INDEX_TYPE=hnsw). A 10M-chunk corpus needs roughly 60 GB of
+memory and twice that in free disk space for the index and write-ahead log.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+AGENT_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+# Bumped when the report layout changes incompatibly
+REPORT_VERSION = 1
+
+
+def parse_size(text: str) -> int:
+    """10000, 10k, 1.5m"""
+    text = text.strip().lower()
+    multiplier = {"k": 10 ** 3, "m": 10 ** 6}.get(text[-1:], 1)
+    return int(float(text.rstrip("km")) * multiplier)
+
+
+def int_list(text: str) -> List[int]:
+    return [parse_size(part) for part in text.split(",") if part.strip()]
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default="ingest,search,concurrency,ask,memory",
+                        help="comma separated: ingest, search, concurrency, ask, memory, quantization")
+    parser.add_argument("--sizes", type=int_list, default=[10000],
+                        help="synthetic corpus sizes in chunks, e.g. 10k,100k,1m,10m")
+    parser.add_argument("--queries", type=int, default=200, help="timed queries per search measurement")
+    parser.add_argument("--writes", type=int, default=100, help="timed single add_document calls")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--threshold", type=float, default=0.1, help="minimum cosine similarity of vector hits")
+    parser.add_argument("--threads", type=int_list, default=[1, 2, 4, 8, 16],
+                        help="concurrent search_similar callers (concurrency scenario)")
+    parser.add_argument("--ask-concurrency", type=int_list, default=[1, 4, 16],
+                        help="concurrent /ask requests (ask scenario)")
+    parser.add_argument("--ask-requests", type=int, default=64, help="timed /ask requests per concurrency level")
+    parser.add_argument("--index-types", default="flat,flat_fp16,flat_sq8,ivf_flat,ivf_sq8,ivf_pq,hnsw,hnsw_sq8",
+                        help="comma separated index types compared (quantization scenario)")
+    parser.add_argument("--pdf-files", type=int, default=4, help="generated PDFs (ingest scenario)")
+    parser.add_argument("--pdf-pages", type=int, default=50, help="pages per generated PDF")
+    parser.add_argument("--embed-latency-ms", type=float, default=0, help="simulated latency per embedding call")
+    parser.add_argument("--llm-first-token-ms", type=float, default=0, help="simulated time to first answer token")
+    parser.add_argument("--llm-token-ms", type=float, default=0, help="simulated time between answer tokens")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="app setting for the benchmarked code, may be repeated")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="report path (default benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--compare", type=Path, help="earlier report to compare this run against")
+    parser.add_argument("--compare-only", action="store_true", help="with --compare and --output, just compare")
+    parser.add_argument("--keep-data", action="store_true", help="keep each run's DATA_DIR for inspection")
+    # Internal: run one scenario in this process and write its metrics to --result
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--result", type=Path, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def app_settings(args: argparse.Namespace) -> Dict[str, str]:
+    """Environment the benchmarked app code runs with"""
+    settings = {
+        "FAKE_BACKENDS": "true",
+        "FAKE_EMBED_LATENCY_MS": str(args.embed_latency_ms),
+        "FAKE_LLM_FIRST_TOKEN_MS": str(args.llm_first_token_ms),
+        "FAKE_LLM_TOKEN_MS": str(args.llm_token_ms),
+        "LOG_LEVEL": "WARNING",
+        # Populating writes every chunk to the log; snapshot once at the end instead of every 1000
+        "WAL_COMPACT_THRESHOLD": str(10 ** 12),
+    }
+    for item in args.env:
+        name, _, value = item.partition("=")
+        settings[name] = value
+    return settings
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=AGENT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment() -> Dict[str, Any]:
+    versions = {}
+    for module in ("faiss", "numpy", "fastapi", "PyPDF2"):
+        try:
+            versions[module] = getattr(__import__(module), "__version__", None)
+        except ImportError:
+            versions[module] = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        **versions,
+    }
+
+
+def run_worker(args: argparse.Namespace, scenario: str, size: Optional[int]) -> Dict[str, Any]:
+    """Run one scenario in a child process with a fresh DATA_DIR"""
+    data_dir = Path(tempfile.mkdtemp(prefix=f"orggist-bench-{scenario}-"))
+    result_path = data_dir / "result.json"
+    env = {**os.environ, **app_settings(args), "DATA_DIR": str(data_dir / "data")}
+    command = [sys.executable, "-m", "benchmarks.run", *sys.argv[1:], "--worker", scenario,
+               "--result", str(result_path)]
+    if size is not None:
+        command += ["--size", str(size)]
+    start = time.perf_counter()
+    try:
+        completed = subprocess.run(command, cwd=AGENT_DIR, env=env)
+        if completed.returncode != 0 or not result_path.exists():
+            return {"error": f"worker exited with code {completed.returncode}"}
+        metrics = json.loads(result_path.read_text())
+    finally:
+        if args.keep_data:
+            print(f"Kept data for {scenario} in {data_dir}")
+        else:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    metrics["wall_seconds"] = time.perf_counter() - start
+    return metrics
+
+
+def worker_main(args: argparse.Namespace):
+    from app.logging_setup import configure_logging
+    from benchmarks.scenarios import SCENARIOS, peak_rss_mb
+
+    configure_logging()
+
+    metrics = SCENARIOS[args.worker](args, args.size)
+    metrics["peak_rss_mb"] = peak_rss_mb()
+    args.result.write_text(json.dumps(metrics))
+
+
+def result_key(result: Dict[str, Any]) -> str:
+    return f"{result['scenario']}@{result['corpus_size']}" if result["corpus_size"] else result["scenario"]
+
+
+def flatten(metrics: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    """Numeric metrics keyed by dotted path, e.g. levels.4.p99_ms"""
+    flat = {}
+    for name, value in metrics.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + name] = value
+    return flat
+
+
+def print_report(report: Dict[str, Any]):
+    for result in report["results"]:
+        print(f"\n{result_key(result)}")
+        if "error" in result["metrics"]:
+            print(f"  error: {result['metrics']['error']}")
+            continue
+        for name, value in flatten(result["metrics"]).items():
+            print(f"  {name:40} {value:14.3f}")
+
+
+def compare_reports(baseline: Dict[str, Any], current: Dict[str, Any]):
+    """Print each metric present in both reports with its relative change"""
+    baseline_results = {result_key(result): flatten(result["metrics"]) for result in baseline["results"]}
+    print(f"\nCompared with {baseline.get('git_commit')} ({baseline.get('started_at')})")
+    if baseline.get("settings") != current.get("settings"):
+        print("  note: the runs used different settings")
+    for result in current["results"]:
+        key = result_key(result)
+        lines = []
+        for name, value in flatten(result["metrics"]).items():
+            old = baseline_results.get(key, {}).get(name)
+            if old is None:
+                continue
+            change = f"{(value - old) / old * 100:+8.1f}%" if old else "       -"
+            lines.append(f"  {name:40} {old:14.3f} -> {value:14.3f} {change}")
+        if lines:
+            print(f"\n{key}")
+            print("\n".join(lines))
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    if args.worker:
+        worker_main(args)
+        return
+
+    if args.compare_only:
+        if not (args.compare and args.output):
+            sys.exit("--compare-only needs --compare and --output")
+        compare_reports(json.loads(args.compare.read_text()), json.loads(args.output.read_text()))
+        return
+
+    from benchmarks.scenarios import SCENARIOS, SIZED_SCENARIOS
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(unknown)}")
+
+    report = {
+        "version": REPORT_VERSION,
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "environment": environment(),
+        "settings": app_settings(args),
+        "parameters": {
+            name: value for name, value in vars(args).items()
+            if name not in ("output", "compare", "compare_only", "keep_data", "worker", "size", "result", "env")
+        },
+        "results": [],
+    }
+    for scenario in scenarios:
+        for size in (args.sizes if scenario in SIZED_SCENARIOS else [None]):
+            label = f"{scenario} with {size} chunks" if size else scenario
+            print(f"Running {label}...", flush=True)
+            report["results"].append({"scenario": scenario, "corpus_size": size,
+                                      "metrics": run_worker(args, scenario, size)})
+
+    output = args.output or RESULTS_DIR / f"{report['started_at'].replace(':', '')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print_report(report)
+    print(f"\nReport written to {output}")
+    if args.compare:
+        compare_reports(json.loads(args.compare.read_text()), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+"""Benchmark scenarios. Each runs in a fresh worker process whose environment
+(FAKE_BACKENDS, DATA_DIR, ...) was set up by benchmarks.run before any app
+module is imported, and returns a dict of metrics."""
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+import requests
+
+from benchmarks.corpus import ExactNeighbours, TextGenerator, VectorGenerator, corpus_batches, write_pdf
+
+# Chunks added per add_documents call while populating the store
+POPULATE_BATCH = 10000
+# Chunks per synthetic file_name, so filtered searches have something to filter
+CHUNKS_PER_FILE = 1000
+WARMUP_QUERIES = 10
+
+
+def latency_summary(seconds: List[float], prefix: str = "") -> Dict[str, float]:
+    ms = np.array(seconds) * 1000
+    return {
+        f"{prefix}p50_ms": float(np.percentile(ms, 50)),
+        f"{prefix}p90_ms": float(np.percentile(ms, 90)),
+        f"{prefix}p99_ms": float(np.percentile(ms, 99)),
+        f"{prefix}mean_ms": float(ms.mean()),
+        f"{prefix}max_ms": float(ms.max()),
+    }
+
+
+def current_rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20
+
+
+def make_queries(args, dim: int):
+    """Query texts and vectors, and the exact neighbours tracker to fill while populating"""
+    texts = TextGenerator(args.seed + 1).texts(args.queries + WARMUP_QUERIES, 8)
+    vectors = VectorGenerator(dim, args.seed + 1).vectors(args.queries + WARMUP_QUERIES)
+    truth = ExactNeighbours(vectors[WARMUP_QUERIES:], args.top_k, args.threshold)
+    return texts, vectors, truth
+
+
+def populate(size: int, seed: int, truth: ExactNeighbours = None) -> Dict[str, float]:
+    """Fill a fresh store with size synthetic chunks through add_documents, then snapshot it"""
+    from app import search
+    from app.config import EMBEDDING_DIM
+
+    search.load_store()
+    start = time.perf_counter()
+    for batch_number, (texts, vectors) in enumerate(corpus_batches(size, EMBEDDING_DIM, POPULATE_BATCH, seed)):
+        first_id = search.default_collection.next_chunk_id
+        metadatas = [
+            {"file_name": f"synthetic-{(batch_number * POPULATE_BATCH + i) // CHUNKS_PER_FILE}.pdf"}
+            for i in range(len(texts))
+        ]
+        if search.add_documents(texts, vectors, metadatas) != len(texts):
+            raise RuntimeError("add_documents failed while populating the benchmark store")
+        if truth is not None:
+            truth.add(np.arange(first_id, first_id + len(texts), dtype='int64'), vectors)
+    seconds = time.perf_counter() - start
+
+    search.default_collection.save_index_and_docs()
+    # Searches should see the index type the corpus size calls for, not the flat one it started as
+    thread = search.default_collection.rebuild_thread
+    if thread is not None:
+        thread.join()
+    return {"populate_seconds": seconds, "populate_chunks_per_second": size / seconds}
+
+
+def run_queries(queries: List[Callable[[], Any]], threads: int) -> Dict[str, float]:
+    latencies = [0.0] * len(queries)
+
+    def run(i: int):
+        start = time.perf_counter()
+        queries[i]()
+        latencies[i] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if threads == 1:
+        for i in range(len(queries)):
+            run(i)
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(run, range(len(queries))))
+    wall = time.perf_counter() - start
+    return {"queries_per_second": len(queries) / wall, **latency_summary(latencies)}
+
+
+def search_scenario(args, size: int) -> Dict[str, Any]:
+    """Latency of search_similar and add_document on a populated store, batch search throughput and vector recall"""
+    from app import search
+    from app.config import BATCH_SEARCH_SIZE, EMBEDDING_DIM
+    from app.index_factory import index_type_of
+
+    texts, vectors, truth = make_queries(args, EMBEDDING_DIM)
+    metrics = populate(size, args.seed, truth)
+    metrics["index_type"] = index_type_of(search.default_collection.shards[0].index)
+    metrics["shards"] = len(search.default_collection.shards)
+
+    for text, vector in zip(texts[:WARMUP_QUERIES], vectors[:WARMUP_QUERIES]):
+        search.search_similar(text, args.top_k, args.threshold, query_embedding=vector.tolist())
+    queries = [
+        partial(search.search_similar, text, args.top_k, args.threshold, query_embedding=vector.tolist())
+        for text, vector in zip(texts[WARMUP_QUERIES:], vectors[WARMUP_QUERIES:])
+    ]
+    metrics.update(run_queries(queries, 1))
+
+    # The same queries through search_similar_batch, one matrix search per group
+    batch_texts = texts[WARMUP_QUERIES:]
+    batch_vectors = [vector.tolist() for vector in vectors[WARMUP_QUERIES:]]
+    start = time.perf_counter()
+    for group in range(0, len(batch_texts), BATCH_SEARCH_SIZE):
+        search.search_similar_batch(batch_texts[group:group + BATCH_SEARCH_SIZE], args.top_k, args.threshold,
+                                    query_embeddings=batch_vectors[group:group + BATCH_SEARCH_SIZE])
+    metrics["batch_queries_per_second"] = len(batch_texts) / (time.perf_counter() - start)
+
+    # Recall of the vector leg alone; hybrid fusion reorders by design
+    results = [
+        [doc_id for doc_id, _ in search.vector_search(vector.tolist(), args.top_k, args.threshold)]
+        for vector in vectors[WARMUP_QUERIES:]
+    ]
+    metrics[f"recall_at_{args.top_k}"] = truth.recall(results)
+
+    # Single-chunk writes, including their write-ahead log fsync
+    new_texts = TextGenerator(args.seed + 2).texts(args.writes, 60)
+    new_vectors = VectorGenerator(EMBEDDING_DIM, args.seed + 2).vectors(args.writes)
+    write_latencies = []
+    for text, vector in zip(new_texts, new_vectors):
+        start = time.perf_counter()
+        search.add_document(text, vector.tolist())
+        write_latencies.append(time.perf_counter() - start)
+    metrics.update(latency_summary(write_latencies, "add_document_"))
+    return metrics
+
+
+def concurrency_scenario(args, size: int) -> Dict[str, Any]:
+    """search_similar throughput and latency as concurrent callers are added"""
+    from app import search
+    from app.config import EMBEDDING_DIM
+
+    texts, vectors, _ = make_queries(args, EMBEDDING_DIM)
+    metrics = populate(size, args.seed)
+    queries = [
+        partial(search.search_similar, text, args.top_k, args.threshold, query_embedding=vector.tolist())
+        for text, vector in zip(texts, vectors)
+    ]
+    run_queries(queries[:WARMUP_QUERIES], 1)
+    metrics["levels"] = {str(threads): run_queries(queries[WARMUP_QUERIES:], threads) for threads in args.threads}
+    return metrics
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_server(url: str, process: subprocess.Popen, timeout: float = 300):
+    """Poll url until it answers 200"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode} before becoming ready")
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.02)
+    raise RuntimeError(f"Server did not become ready within {timeout}s")
+
+
+def ask_scenario(args, size: int) -> Dict[str, Any]:
+    """End-to-end /ask latency over HTTP (embedding, retrieval, packing, streamed answer) by concurrency"""
+    from app.config import EMBEDDING_DIM
+
+    metrics = populate(size, args.seed)
+    # Every request asks something new, so neither cache can answer it
+    total = args.ask_requests * len(args.ask_concurrency) + WARMUP_QUERIES
+    texts = TextGenerator(args.seed + 3).texts(total, 8)
+
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=Path(__file__).resolve().parent.parent,
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        # Cold start: until the server accepts connections, then until the index has loaded
+        wait_for_server(f"{base_url}/healthz", server)
+        metrics["server_live_seconds"] = time.perf_counter() - start
+        wait_for_server(f"{base_url}/readyz", server)
+        metrics["server_ready_seconds"] = time.perf_counter() - start
+        session = requests.Session()
+        session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=max(args.ask_concurrency)))
+
+        def ask(text: str):
+            start = time.perf_counter()
+            with session.post(f"{base_url}/ask", json={"query": text, "similarity_threshold": args.threshold},
+                              stream=True, timeout=300) as response:
+                response.raise_for_status()
+                chunks = response.iter_content(chunk_size=None)
+                next(chunks, None)
+                first_byte = time.perf_counter() - start
+                for _ in chunks:
+                    pass
+            return first_byte, time.perf_counter() - start
+
+        for text in texts[:WARMUP_QUERIES]:
+            ask(text)
+        levels = {}
+        position = WARMUP_QUERIES
+        for concurrency in args.ask_concurrency:
+            batch = texts[position:position + args.ask_requests]
+            position += args.ask_requests
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                timings = list(executor.map(ask, batch))
+            wall = time.perf_counter() - start
+            levels[str(concurrency)] = {
+                "requests_per_second": len(batch) / wall,
+                **latency_summary([first for first, _ in timings], "first_byte_"),
+                **latency_summary([total for _, total in timings]),
+            }
+        metrics["levels"] = levels
+    finally:
+        server.terminate()
+        server.wait()
+    return metrics
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def ingest_scenario(args, size: int) -> Dict[str, Any]:
+    """PDFProcessor throughput on generated PDFs served over local HTTP"""
+    pdf_dir = Path(tempfile.mkdtemp(prefix="orggist-bench-pdfs-"))
+    for i in range(args.pdf_files):
+        write_pdf(pdf_dir / f"doc-{i}.pdf", args.pdf_pages, seed=args.seed + 100 + i)
+    pdf_bytes = sum(path.stat().st_size for path in pdf_dir.iterdir())
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(_QuietHandler, directory=str(pdf_dir)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        from app import search
+        from app.config import INGEST_WORKERS
+        from app.pdf_processor import pdf_processor
+
+        search.load_store()
+        # Same number of files in flight as the background job queue runs
+        urls = [f"http://127.0.0.1:{server.server_port}/doc-{i}.pdf?X-Amz-Signature=bench"
+                for i in range(args.pdf_files)]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as executor:
+            succeeded = list(executor.map(
+                lambda i: pdf_processor.process_pdf(urls[i], f"doc-{i}.pdf"), range(args.pdf_files)
+            ))
+        seconds = time.perf_counter() - start
+        chunks = len(search.default_collection.doc_store)
+    finally:
+        server.shutdown()
+    return {
+        "files": args.pdf_files,
+        "pages_per_file": args.pdf_pages,
+        "files_failed": succeeded.count(False),
+        "seconds": seconds,
+        "chunks": chunks,
+        "pages_per_second": args.pdf_files * args.pdf_pages / seconds,
+        "chunks_per_second": chunks / seconds,
+        "mb_per_second": pdf_bytes / 2 ** 20 / seconds,
+    }
+
+
+def memory_scenario(args, size: int) -> Dict[str, Any]:
+    """Resident memory and on-disk footprint of a populated store"""
+    from app import search
+    from app.config import DATA_DIR
+    from app.index_factory import index_type_of
+
+    rss_before = current_rss_mb()
+    metrics = populate(size, args.seed)
+    rss_after = current_rss_mb()
+    index_bytes = sum(shard.path.stat().st_size for shard in search.default_collection.shards)
+    docs_bytes = sum(path.stat().st_size for path in DATA_DIR.glob("docs.db*"))
+    metrics.update({
+        "index_type": index_type_of(search.default_collection.shards[0].index),
+        "shards": len(search.default_collection.shards),
+        "rss_before_mb": rss_before,
+        "rss_after_mb": rss_after,
+        "rss_bytes_per_chunk": (rss_after - rss_before) * 2 ** 20 / size,
+        "index_file_mb": index_bytes / 2 ** 20,
+        "index_bytes_per_vector": index_bytes / size,
+        "docs_db_mb": docs_bytes / 2 ** 20,
+    })
+    return metrics
+
+
+def quantization_scenario(args, size: int) -> Dict[str, Any]:
+    """Index memory against vector recall for each of --index-types, built directly on the corpus vectors.
+
+    Compressed types are measured as they are and re-ranked with the
+    full-precision copies of the vectors search keeps for them on disk.
+    """
+    from app.config import DATA_DIR, EMBEDDING_DIM
+    from app.full_vectors import FullVectors
+    from app.index_factory import build_index, compressed, index_memory_bytes, min_training_vectors, prepare_vectors
+    from app.search import search_shard
+    from app.shards import Shard
+
+    _, query_vectors, truth = make_queries(args, EMBEDDING_DIM)
+    query_vectors = prepare_vectors(query_vectors[WARMUP_QUERIES:])
+    generator = VectorGenerator(EMBEDDING_DIM, args.seed)
+    parts = []
+    for start in range(0, size, POPULATE_BATCH):
+        vectors = prepare_vectors(generator.vectors(min(POPULATE_BATCH, size - start)))
+        truth.add(np.arange(start, start + len(vectors), dtype='int64'), vectors)
+        parts.append(vectors)
+    vectors = np.concatenate(parts)
+    ids = np.arange(size, dtype='int64')
+    full_vectors = FullVectors(DATA_DIR / "vectors.f32", EMBEDDING_DIM)
+    full_vectors.write(ids, vectors)
+
+    def measure(shard: Shard, rerank_with) -> Dict[str, float]:
+        results = [[] for _ in query_vectors]
+
+        def query(i: int):
+            hits = search_shard(shard, query_vectors[i:i + 1], args.top_k, args.threshold, None, None, None,
+                                rerank_with)[0]
+            results[i] = [doc_id for doc_id, _ in hits]
+
+        metrics = run_queries([partial(query, i) for i in range(len(query_vectors))], 1)
+        metrics[f"recall_at_{args.top_k}"] = truth.recall(results)
+        return metrics
+
+    float32_bytes = size * EMBEDDING_DIM * 4
+    report = {}
+    for index_type in [name.strip() for name in args.index_types.split(",") if name.strip()]:
+        if size < min_training_vectors(index_type):
+            report[index_type] = {"skipped": f"needs {min_training_vectors(index_type)} vectors to train"}
+            continue
+        start = time.perf_counter()
+        shard = Shard(0, None, build_index(vectors, ids, index_type))
+        memory = index_memory_bytes(shard.index)
+        report[index_type] = {
+            "build_seconds": time.perf_counter() - start,
+            "memory_mb": memory / 2 ** 20,
+            "bytes_per_vector": memory / size,
+            # How many times more vectors fit in the memory float32 vectors alone would take
+            "compression_ratio": float32_bytes / memory,
+            "search": measure(shard, None),
+        }
+        if compressed(index_type):
+            report[index_type]["reranked"] = measure(shard, full_vectors)
+    return {"float32_vectors_mb": float32_bytes / 2 ** 20, "index_types": report}
+
+
+SCENARIOS = {
+    "ingest": ingest_scenario,
+    "search": search_scenario,
+    "concurrency": concurrency_scenario,
+    "ask": ask_scenario,
+    "memory": memory_scenario,
+    "quantization": quantization_scenario,
+}
+# Scenarios that populate a synthetic corpus and so run once per --sizes entry
+SIZED_SCENARIOS = ("search", "concurrency", "ask", "memory", "quantization")